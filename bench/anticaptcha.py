@@ -0,0 +1,218 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Throughput and tail latency of the anticaptcha HTTP front:
+#
+#     python -m bench.anticaptcha [--tasks N] [--concurrency N] [--gui] ...
+#
+# Starts the aiohttp app of decaptcha.anticaptcha in a child process with a
+# stub solve function answering after --solve-latency seconds, or with
+# DeCaptcha on a FakeBackend if --gui is given, and drives it from this
+# process:
+#
+#  1. creates --tasks tasks with --concurrency requests in flight and reports
+#     the createTask requests per second and latency percentiles,
+#  2. collects every result with getTaskResult, polling every --poll-interval
+#     seconds or long-polling, and reports the latency percentiles of the
+#     getTaskResult requests,
+#  3. creates --hold tasks that are never solved and reports the growth of
+#     the server's resident memory per outstanding task.
+#
+# The peak number of open connections is sampled in the server. The result is
+# printed as JSON, to be compared between commits.
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import (
+	Any,
+	Dict,
+	List,
+	Optional,
+	Sequence,
+)
+
+import aiohttp # type: ignore
+from aiohttp import web # type: ignore
+
+from decaptcha.anticaptcha import add_routes, wrap_decaptcha_solve
+
+task = {
+	'type':       'RecaptchaV2TaskProxyless',
+	'websiteURL': 'https://decaptcha.test/',
+	'websiteKey': 'key',
+}
+
+# tasks with this websiteKey are never solved
+hold_key = 'hold'
+
+def rss() -> Optional[int]:
+	""" :returns: the resident memory of this process in bytes, if known """
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError):
+		return None
+
+def percentiles(latencies: Sequence[float]) -> Dict[str, float]:
+	latencies = sorted(latencies)
+	def percentile(p: float) -> float:
+		return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+	return {
+		'p50_ms': percentile(0.50),
+		'p99_ms': percentile(0.99),
+		'max_ms': latencies[-1] * 1000,
+	}
+
+async def serve(args: argparse.Namespace) -> None:
+	if args.gui:
+		from decaptcha import DeCaptcha, FakeBackend, ReCaptchaHTMLGenerator
+		decaptcha = DeCaptcha(ReCaptchaHTMLGenerator(), windows=args.windows,
+		                      backend=FakeBackend(solve_latency=args.solve_latency))
+		decaptcha.run()
+		solve = wrap_decaptcha_solve(decaptcha.solve)
+	else:
+		async def solve(task: Any) -> Any:
+			await asyncio.sleep(args.solve_latency)
+			return {'gRecaptchaResponse': 'token'}
+
+	async def solve_or_hold(task: Any) -> Any:
+		if task['websiteKey'] == hold_key:
+			await asyncio.get_running_loop().create_future()
+		return await solve(task)
+
+	peak_connections = 0
+
+	async def stats(request: web.Request) -> web.Response:
+		return web.json_response({'rss': rss(), 'peak_connections': peak_connections})
+
+	app = web.Application()
+	add_routes(app, solve_or_hold, max_tasks=args.tasks + args.hold + 1)
+	app.router.add_route('GET', '/bench', stats)
+	runner = web.AppRunner(app, access_log=None)
+	await runner.setup()
+	site = web.TCPSite(runner, '127.0.0.1', 0)
+	await site.start()
+	print(runner.addresses[0][1], flush=True)
+
+	server = runner.server
+	assert server is not None
+	while True:
+		await asyncio.sleep(0.005)
+		peak_connections = max(peak_connections, len(server.connections))
+
+async def post(session: aiohttp.ClientSession, url: str, data: Any, latencies: List[float]) -> Any:
+	start = time.perf_counter()
+	async with session.post(url, json=data) as resp:
+		result = await resp.json(content_type=None)
+	latencies.append(time.perf_counter() - start)
+	return result
+
+async def bounded(concurrency: int, coros: Sequence[Any]) -> List[Any]:
+	semaphore = asyncio.Semaphore(concurrency)
+	async def run(coro: Any) -> Any:
+		async with semaphore:
+			return await coro
+	return await asyncio.gather(*map(run, coros))
+
+async def drive(args: argparse.Namespace, base: str) -> Dict[str, Any]:
+	connector = aiohttp.TCPConnector(limit=0)
+	async with aiohttp.ClientSession(connector=connector) as session:
+		create_latencies = [] # type: List[float]
+		start = time.perf_counter()
+		created = await bounded(args.concurrency, [
+			post(session, base + '/createTask', {'task': task}, create_latencies)
+			for _ in range(args.tasks)
+		])
+		create_seconds = time.perf_counter() - start
+
+		result_latencies = [] # type: List[float]
+		async def collect(task_id: str) -> None:
+			while True:
+				result = await post(session, base + '/getTaskResult',
+				                    {'taskId': task_id, 'longPoll': args.long_poll}, result_latencies)
+				if result.get('status') != 'processing':
+					assert result.get('status') == 'ready', result
+					return
+				await asyncio.sleep(args.poll_interval)
+		start = time.perf_counter()
+		await bounded(args.concurrency, [collect(resp['taskId']) for resp in created])
+		collect_seconds = time.perf_counter() - start
+
+		async with session.get(base + '/bench') as resp:
+			before = (await resp.json())['rss']
+		await bounded(args.concurrency, [
+			post(session, base + '/createTask', {'task': dict(task, websiteKey=hold_key)}, [])
+			for _ in range(args.hold)
+		])
+		async with session.get(base + '/bench') as resp:
+			stats = await resp.json()
+
+	return {
+		'createTask': dict(percentiles(create_latencies),
+		                   requests_per_second=args.tasks / create_seconds),
+		'getTaskResult': dict(percentiles(result_latencies),
+		                      requests=len(result_latencies),
+		                      tasks_per_second=args.tasks / collect_seconds),
+		'peak_connections': stats['peak_connections'],
+		'memory_per_task_bytes': None if before is None or args.hold <= 0
+		                         else (stats['rss'] - before) / args.hold,
+	}
+
+async def amain(args: argparse.Namespace) -> None:
+	server = await asyncio.create_subprocess_exec(
+		sys.executable, '-m', 'bench.anticaptcha', '--serve', *sys.argv[1:],
+		stdout=asyncio.subprocess.PIPE,
+	)
+	try:
+		assert server.stdout is not None
+		port = int(await server.stdout.readline())
+		result = await drive(args, 'http://127.0.0.1:%d' % port)
+	finally:
+		server.terminate()
+		await server.wait()
+	config = {key: value for key, value in vars(args).items() if key != 'serve'}
+	print(json.dumps({'config': config, **result}, indent='\t'))
+
+def main() -> None:
+	parser = argparse.ArgumentParser(prog='python -m bench.anticaptcha')
+	parser.add_argument('--tasks', type=int, default=5000,
+	                    help="number of solved tasks (default: %(default)s)")
+	parser.add_argument('--concurrency', type=int, default=64,
+	                    help="requests in flight (default: %(default)s)")
+	parser.add_argument('--solve-latency', type=float, default=0.05, metavar='SECONDS',
+	                    help="seconds until a task is solved (default: %(default)s)")
+	parser.add_argument('--gui', action='store_true',
+	                    help="solve with DeCaptcha on a FakeBackend instead of the stub")
+	parser.add_argument('--windows', type=int, default=8,
+	                    help="windows of DeCaptcha with --gui (default: %(default)s)")
+	parser.add_argument('--long-poll', action='store_true',
+	                    help="collect results with long-polling getTaskResult requests")
+	parser.add_argument('--poll-interval', type=float, default=0.05, metavar='SECONDS',
+	                    help="seconds between polling getTaskResult requests (default: %(default)s)")
+	parser.add_argument('--hold', type=int, default=5000,
+	                    help="number of outstanding tasks memory is measured with (default: %(default)s)")
+	parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+	asyncio.run(serve(args) if args.serve else amain(args))
+
+if __name__ == '__main__':
+	main()
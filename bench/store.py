@@ -0,0 +1,84 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Overhead of the durable task store on the request path:
+#
+#     python -m bench.store [--tasks N]
+#
+# Enqueues and collects N tasks with a solve function returning immediately,
+# with and without a TaskStore, and reports the time per task. "flush" is the
+# time close() waits for the queued writes to be committed, which is not on
+# the request path.
+
+import argparse
+import asyncio
+import json
+import os.path
+import tempfile
+import time
+from typing import (
+	Any,
+	Dict,
+	Optional,
+)
+
+from decaptcha.anticaptcha import TaskQueue
+from decaptcha.anticaptcha.store import TaskStore
+
+task = {
+	'type':       'HCaptchaTaskProxyless',
+	'websiteURL': 'https://decaptcha.test/',
+	'websiteKey': 'key',
+}
+
+async def solve(task: Any) -> Any:
+	return {'gRecaptchaResponse': 'token'}
+
+async def run(tasks: int, store: Optional[TaskStore]) -> Dict[str, float]:
+	task_queue = TaskQueue(solve, max_tasks=tasks + 1, store=store)
+	await task_queue.start()
+	start = time.perf_counter()
+	task_ids = [await task_queue.enqueue_task(task) for _ in range(tasks)]
+	await asyncio.gather(*(task_queue[task_id] for task_id in task_ids))
+	await asyncio.sleep(0)
+	for task_id in task_ids:
+		task_queue.discard(task_id)
+	elapsed = time.perf_counter() - start
+	start = time.perf_counter()
+	await task_queue.stop()
+	return {
+		'us_per_task': elapsed / tasks * 1e6,
+		'flush_s':     time.perf_counter() - start,
+	}
+
+async def amain(args: argparse.Namespace) -> None:
+	with tempfile.TemporaryDirectory() as directory:
+		result = {
+			'memory': await run(args.tasks, None),
+			'sqlite': await run(args.tasks, TaskStore(os.path.join(directory, 'tasks.sqlite'))),
+		}
+	print(json.dumps(result, indent='\t'))
+
+def main() -> None:
+	parser = argparse.ArgumentParser(prog='python -m bench.store')
+	parser.add_argument('--tasks', type=int, default=10000,
+	                    help="number of tasks (default: %(default)s)")
+	asyncio.run(amain(parser.parse_args()))
+
+if __name__ == '__main__':
+	main()
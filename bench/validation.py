@@ -0,0 +1,86 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+# Micro-benchmark of the createTask validation step:
+#
+#     python -m bench.validation [--seconds N]
+#
+# "before" validates against a single anyOf schema of all task types with
+# jsonschema.validate, "after" is what the createTask handler does.
+
+import argparse
+import json
+import time
+from typing import (
+	Any,
+	Callable,
+	Dict,
+)
+
+import jsonschema # type: ignore
+
+from decaptcha.anticaptcha import schemas
+
+request = { # type: Dict[str, Any]
+	'task': {
+		'type':       'RecaptchaV2Task',
+		'websiteURL': 'https://decaptcha.test/',
+		'websiteKey': '6LeIxAcTAAAAAJcZVRqyHh71UMIEGNQ_MXjiZKhI',
+		'proxyType':    'http',
+		'proxyAddress': '127.0.0.1',
+		'proxyPort':    8080,
+		'userAgent':    'Mozilla/5.0',
+	},
+}
+
+anyof_schema = dict(schemas.createTask) # type: Dict[str, Any]
+anyof_schema['properties'] = dict(schemas.createTask['properties'], task={ # type: ignore
+	'anyOf': list(schemas.tasks.values()),
+})
+
+def before() -> None:
+	jsonschema.validate(request, anyof_schema)
+
+def after() -> None:
+	schemas.validators['createTask'].validate(request)
+	schemas.task_validators[request['task']['type']].validate(request['task'])
+
+def requests_per_second(func: Callable[[], None], seconds: float) -> float:
+	n = 0
+	start = time.perf_counter()
+	deadline = start + seconds
+	while True:
+		for _ in range(100):
+			func()
+		n += 100
+		now = time.perf_counter()
+		if now >= deadline:
+			return n / (now - start)
+
+def main() -> None:
+	parser = argparse.ArgumentParser(prog='python -m bench.validation')
+	parser.add_argument('--seconds', type=float, default=2.0,
+	                    help="duration of each measurement (default: %(default)s)")
+	args = parser.parse_args()
+	print(json.dumps({
+		'before': requests_per_second(before, args.seconds),
+		'after':  requests_per_second(after,  args.seconds),
+	}, indent='\t'))
+
+if __name__ == '__main__':
+	main()
@@ -1,33 +1,157 @@
 import asyncio
+import collections
 import functools
+import heapq
+import itertools
 import json
 import jsonschema # type: ignore
 import logging
+import time
 import uuid
 from aiohttp import web # type: ignore
 from typing import (
     Any,
     Awaitable,
     Callable,
+    cast,
+    Dict,
+    Iterator,
+    List,
     Mapping,
+    NamedTuple,
     Optional,
+    Sequence,
     Tuple,
 )
 from . import schemas
+from .callbacks import CallbackDispatcher
+from .clients import Client, FairScheduler, KeyDoesNotExist, NoSlotAvailable
+from .store import TaskStore
 from .errors import *
-from .. import CaptchaRequest, CaptchaSuccess
+from ..metrics import format_labelled, Histogram, Registry
+from ..request import CaptchaException, CaptchaRequest, CaptchaSuccess
 
 keep_alive = 25
 
-Task = 'Task'
+Task = Mapping[str, Any]
 TaskID = str
-Solution = 'Solution'
+# e.g. {"gRecaptchaResponse": ...}, or a Solved
+Solution = Any
 CaptchaSolveFunc = Callable[[Task], Awaitable[Solution]]
+CaptchaSolveManyFunc = Callable[[Sequence[Task]], Sequence[Awaitable[Solution]]]
+
+class Solved(NamedTuple):
+    """
+    Solution with the UNIX timestamps it was solved at and its token expires
+    at, solve functions may return it instead of the bare solution.
+    """
+    solution:   Any
+    solved_at:  Optional[float]
+    expires_at: Optional[float]
+
+class TokenExpired(CaptchaException):
+    pass
+
+class Ticker:
+    """
+    A single timer shared by all long-polling getTaskResult requests to know
+    when to send their next keep-alive byte.
+    """
+
+    def __init__(self, interval: float = keep_alive):
+        self.interval = interval
+        self._tick    = None # type: Optional[asyncio.Future]
+        self._ticker  = None # type: Optional[asyncio.Task]
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            tick, self._tick = self._tick, loop.create_future()
+            if tick is not None:
+                tick.set_result(None)
+
+    def next_tick(self) -> asyncio.Future:
+        """ :returns: a future resolved with the next tick """
+        if self._ticker is None:
+            self._ticker = asyncio.create_task(self._run())
+        if self._tick is None:
+            self._tick = asyncio.get_running_loop().create_future()
+        return self._tick
+
+    def stop(self) -> None:
+        if self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+        if self._tick is not None:
+            self._tick.cancel()
+            self._tick = None
 
 class TaskQueue:
-    def __init__(self, solve: CaptchaSolveFunc):
-        self.tasks = {}    # type: Mapping[TaskID, asyncio.Task]
-        self.solve = solve # type: CaptchaSolveFunc
+    logger = logging.getLogger('TaskQueue')
+
+    def __init__(self,
+                 solve:          CaptchaSolveFunc,
+                 result_ttl:     float = 300.0,
+                 max_tasks:      int   = 10000,
+                 sweep_interval: float = 30.0,
+                 long_poll:      bool  = False,
+                 callbacks:      Optional[CallbackDispatcher] = None,
+                 store:          Optional[TaskStore] = None,
+                 solve_many:     Optional[CaptchaSolveManyFunc] = None,
+                 scheduler:      Optional[FairScheduler] = None,
+                 expiry_margin:  float = 10.0,
+                 requeue_stale:  bool  = False):
+        """
+        :param solve:          function solving a task
+        :param result_ttl:     seconds a finished task's result is kept for
+                               collection
+        :param max_tasks:      maximum number of stored tasks, finished or not
+        :param sweep_interval: seconds between evictions of expired results
+        :param long_poll:      whether getTaskResult waits for the task to
+                               finish by default instead of returning
+                               status "processing"
+        :param callbacks:      dispatcher delivering results to the tasks'
+                               callbackUrl
+        :param store:          durable store tasks are recovered from by start
+        :param solve_many:     function solving several tasks, used by
+                               enqueue_tasks instead of calling solve for
+                               each task, e.g. wrap_decaptcha_solve_many
+        :param scheduler:      admission control and fair queueing of the
+                               tasks by clientKey, recovered tasks bypass it
+        :param expiry_margin:  seconds before its expiresAt a Solved token is
+                               refused with ERROR_TOKEN_EXPIRED
+        :param requeue_stale:  solve tasks whose token expired uncollected
+                               again under the same taskId instead of
+                               refusing it, bypassing the scheduler
+        """
+        self.tasks          = {}    # type: Dict[TaskID, asyncio.Future]
+        self.solve          = solve # type: CaptchaSolveFunc
+        self.solve_many     = solve_many
+        self.scheduler      = scheduler
+        self.result_ttl     = result_ttl
+        self.max_tasks      = max_tasks
+        self.sweep_interval = sweep_interval
+        self.long_poll      = long_poll
+        self.ticker         = Ticker()
+        self.callbacks      = callbacks or CallbackDispatcher()
+        self.store          = store
+        self.expiry_margin  = expiry_margin
+        self.requeue_stale  = requeue_stale
+        self.evicted        = 0
+        self.counters       = collections.Counter() # type: collections.Counter[str]
+        # seconds from createTask until the task is solved or failed
+        self.latency        = Histogram()
+        # finished task IDs in the order they finished, with the time they expire
+        self._finished      = collections.OrderedDict() # type: collections.OrderedDict[TaskID, float]
+        # heap of the finished tasks' token expiry (UNIX time), tie-breaker,
+        # task ID, result, task and callbackUrl, entries whose result was
+        # collected or replaced are skipped
+        self._expiring      = [] # type: List[Tuple[float, int, TaskID, asyncio.Future, Task, Optional[str]]]
+        self._seq           = itertools.count()
+        self._sweeper       = None # type: Optional[asyncio.Task]
+        # the server is shutting down, cancelled long polls keep their task
+        self.stopping       = False
 
     def create_task_id(self) -> TaskID:
         while True:
@@ -38,32 +162,312 @@ class TaskQueue:
     def create_task(self,
                     task_id:      TaskID,
                     task:         Task,
-                    callback_url: Optional[str] = None) -> asyncio.Task:
-        captcha_task = asyncio.create_task(self.solve(task))
+                    callback_url: Optional[str] = None,
+                    solution:     Optional[Awaitable[Solution]] = None) -> asyncio.Future:
+        """
+        :param solution: the task's solution if it is already being solved,
+                         otherwise solve is called
+        """
+        loop = asyncio.get_running_loop()
+        created = loop.time()
+        captcha_task = asyncio.ensure_future(self.solve(task) if solution is None else solution)
 
         @captcha_task.add_done_callback
-        def _(_: asyncio.Task) -> None:
+        def _(_: asyncio.Future) -> None:
             logger = logging.getLogger('CaptchaTask#%s' % task_id)
             logger.info('done')
-            # TODO call callbackUrl
+            if task_id not in self.tasks or captcha_task.cancelled():
+                # cancelled by the client, or on shutdown and still stored
+                return
+            self.latency.observe(loop.time() - created)
+            self.counters['failed' if captcha_task.exception() is not None else 'solved'] += 1
+            self._finished[task_id] = loop.time() + self.result_ttl
+            if captcha_task.exception() is None:
+                self._track_expiry(task_id, captcha_task, task, callback_url)
+            if self.store is not None:
+                if captcha_task.exception() is not None:
+                    self.store.finished(task_id, error=str(captcha_task.exception()))
+                else:
+                    solved = captcha_task.result() # type: Any
+                    if isinstance(solved, Solved):
+                        self.store.finished(task_id, solution=solved.solution, expires=solved.expires_at)
+                    else:
+                        self.store.finished(task_id, solution=solved)
             if callback_url is not None:
-                logger.error('callbackUrl not supported')
+                payload = dict(task_result(task_id, captcha_task), taskId=task_id)
+                delivery = self.callbacks.dispatch(callback_url, payload)
+
+                @delivery.add_done_callback
+                def _(_: asyncio.Future) -> None:
+                    if not delivery.cancelled() and delivery.result():
+                        logger.info('result delivered to callbackUrl')
+                        self.discard(task_id)
 
         return captcha_task
 
+    def _track_expiry(self,
+                      task_id:      TaskID,
+                      captcha_task: asyncio.Future,
+                      task:         Task,
+                      callback_url: Optional[str]) -> None:
+        solved = captcha_task.result()
+        if isinstance(solved, Solved) and solved.expires_at is not None:
+            heapq.heappush(self._expiring, (solved.expires_at, next(self._seq), task_id,
+                                            captcha_task, task, callback_url))
+
+    def expire(self) -> None:
+        """
+        Refuse the uncollected tokens expiring within expiry_margin seconds,
+        or solve their tasks again if requeue_stale.
+        """
+        now = time.time()
+        while self._expiring and self._expiring[0][0] <= now + self.expiry_margin:
+            _, _, task_id, captcha_task, task, callback_url = heapq.heappop(self._expiring)
+            if self.tasks.get(task_id) is not captcha_task:
+                # collected, cancelled or evicted
+                continue
+            self.counters['expired'] += 1
+            logger = logging.getLogger('CaptchaTask#%s' % task_id)
+            if self.requeue_stale:
+                logger.info('token expired unused, solving again')
+                self._finished.pop(task_id, None)
+                self.tasks[task_id] = self.create_task(task_id, task, callback_url)
+                self.counters['requeued'] += 1
+                if self.store is not None:
+                    self.store.created(task_id, task, callback_url)
+            else:
+                logger.info('token expired unused')
+                expired = asyncio.get_running_loop().create_future()
+                expired.set_exception(TokenExpired('the token expired before it was collected'))
+                # retrieved, asyncio would log it if the result is evicted uncollected
+                expired.exception()
+                self.tasks[task_id] = expired
+
     async def enqueue_task(self,
                            task:         Task,
-                           callback_url: Optional[str] = None) -> TaskID:
+                           callback_url: Optional[str] = None,
+                           client_key:   Optional[str] = None) -> TaskID:
+        """
+        :raises KeyDoesNotExist: if the scheduler does not accept client_key
+        :raises NoSlotAvailable: if the task is rejected
+        """
+        client = self.scheduler.client(client_key) if self.scheduler is not None else None
+        if self._make_room(1) < 1:
+            self.counters['rejected'] += 1
+            raise NoSlotAvailable('%d tasks stored' % len(self.tasks))
+        if client is not None:
+            self._admit(client, task)
+        return self._add_task(task, callback_url, self._schedule(client, task))
+
+    async def enqueue_tasks(self,
+                            tasks:        Sequence[Task],
+                            callback_url: Optional[str] = None,
+                            client_key:   Optional[str] = None) -> List[Optional[TaskID]]:
+        """
+        Enqueue the tasks that fit, all at once with solve_many if set and
+        there is no scheduler.
+
+        :returns: the tasks' IDs, None for the rejected tasks
+        :raises KeyDoesNotExist: if the scheduler does not accept client_key
+        """
+        client = self.scheduler.client(client_key) if self.scheduler is not None else None
+        room = self._make_room(len(tasks))
+        admitted = [] # type: List[Optional[Task]]
+        # admitted tasks of the batch, scheduled only after the whole batch
+        # was admitted, but queued ahead of the next one
+        pending  = 0
+        for i, task in enumerate(tasks):
+            if i >= room:
+                self.counters['rejected'] += 1
+                admitted.append(None)
+                continue
+            if client is not None:
+                try:
+                    self._admit(client, task, pending)
+                except NoSlotAvailable:
+                    admitted.append(None)
+                    continue
+                pending += 1
+            admitted.append(task)
+
+        batch = [task for task in admitted if task is not None]
+        if self.solve_many is not None and client is None and batch:
+            solutions = iter(self.solve_many(batch)) # type: Iterator[Optional[Awaitable[Solution]]]
+        else:
+            solutions = (self._schedule(client, task) for task in batch)
+        return [None if task is None else self._add_task(task, callback_url, next(solutions))
+                for task in admitted]
+
+    def _admit(self, client: Client, task: Task, pending: int = 0) -> None:
+        try:
+            cast(FairScheduler, self.scheduler).admit(client, task.get('deadline'), pending)
+        except NoSlotAvailable:
+            self.counters['rejected'] += 1
+            raise
+
+    def _schedule(self, client: Optional[Client], task: Task) -> Optional[Awaitable[Solution]]:
+        """ :returns: the solution of the task queued in the scheduler, None without one """
+        if client is None:
+            return None
+        return cast(FairScheduler, self.scheduler).schedule(client, functools.partial(self.solve, task))
+
+    def _make_room(self, count: int) -> int:
+        """
+        Evict the oldest finished tasks if there is no room for count more.
+
+        :returns: the number of tasks there is room for, at most count
+        """
+        if len(self.tasks) + count > self.max_tasks:
+            self.sweep(evict_oldest=len(self.tasks) + count - self.max_tasks)
+        return max(0, min(count, self.max_tasks - len(self.tasks)))
+
+    def _add_task(self,
+                  task:         Task,
+                  callback_url: Optional[str] = None,
+                  solution:     Optional[Awaitable[Solution]] = None) -> TaskID:
         task_id = self.create_task_id()
-        captcha_task = self.create_task(task_id, task, callback_url)
-        self.tasks[task_id] = captcha_task
+        self.tasks[task_id] = self.create_task(task_id, task, callback_url, solution)
+        self.counters['created'] += 1
+        if self.store is not None:
+            self.store.created(task_id, task, callback_url)
         return task_id
 
-    def __getitem__(self, task_id: TaskID) -> asyncio.Task:
+    def recover(self) -> None:
+        """
+        Restore the tasks of the store, pending tasks are solved again and
+        unexpired results can be collected.
+        """
+        if self.store is None:
+            return
+        loop = asyncio.get_running_loop()
+        stored = self.store.load()
+        finished = [(t.finished, t) for t in stored if t.finished is not None]
+        finished.sort(key=lambda finished_task: finished_task[0])
+        for finished_at, stored_task in finished:
+            expires = loop.time() + self.result_ttl - (time.time() - finished_at)
+            if expires <= loop.time():
+                self.store.removed(stored_task.task_id)
+                continue
+            result = loop.create_future()
+            if stored_task.error is not None:
+                result.set_exception(CaptchaException(stored_task.error))
+            elif stored_task.expires is not None:
+                result.set_result(Solved(stored_task.solution, finished_at, stored_task.expires))
+            else:
+                result.set_result(stored_task.solution)
+            self.tasks[stored_task.task_id] = result
+            self._finished[stored_task.task_id] = expires
+            if stored_task.error is None:
+                self._track_expiry(stored_task.task_id, result, stored_task.task, stored_task.callback_url)
+        for stored_task in stored:
+            if stored_task.finished is None:
+                self.tasks[stored_task.task_id] = self.create_task(
+                    stored_task.task_id, stored_task.task, stored_task.callback_url)
+        self.logger.info('recovered %d tasks, %d finished', len(self.tasks), len(self._finished))
+
+    def __getitem__(self, task_id: TaskID) -> asyncio.Future:
         return self.tasks[task_id]
 
     def __delitem__(self, task_id: TaskID) -> None:
         del self.tasks[task_id]
+        self._finished.pop(task_id, None)
+        if self.store is not None:
+            self.store.removed(task_id)
+
+    def discard(self, task_id: TaskID) -> None:
+        if self.tasks.pop(task_id, None) is not None and self.store is not None:
+            self.store.removed(task_id)
+        self._finished.pop(task_id, None)
+
+    def sweep(self, evict_oldest: int = 0) -> None:
+        """
+        Forget finished tasks whose result expired, and refuse expired tokens.
+
+        :param evict_oldest: number of finished tasks to forget even if their
+                             result did not expire yet, oldest first
+        """
+        self.expire()
+        now = asyncio.get_running_loop().time()
+        while self._finished:
+            task_id, expires = next(iter(self._finished.items()))
+            if expires > now and evict_oldest <= 0:
+                break
+            evict_oldest -= 1
+            logging.getLogger('CaptchaTask#%s' % task_id).info('result evicted')
+            self.discard(task_id)
+            self.evicted += 1
+
+    async def _sweep_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+
+    async def start(self, app: Optional[web.Application] = None) -> None:
+        """
+        Recover stored tasks and start evicting expired results, usable as
+        on_startup signal.
+        """
+        if self.store is not None:
+            self.recover()
+            self.store.open()
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_periodically())
+
+    async def shutdown(self, app: Optional[web.Application] = None) -> None:
+        """
+        Keep the tasks of the long polls cancelled by the shutdown, usable
+        as on_shutdown signal.
+        """
+        self.stopping = True
+
+    async def stop(self, app: Optional[web.Application] = None) -> None:
+        """ Stop evicting expired results, usable as on_cleanup signal. """
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        self.ticker.stop()
+        await self.callbacks.close()
+        if self.store is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.store.close)
+
+    def gauges(self) -> Dict[str, int]:
+        return {
+            'tasks':    len(self.tasks),
+            'pending':  len(self.tasks) - len(self._finished),
+            'finished': len(self._finished),
+            'evicted':  self.evicted,
+        }
+
+    def cancel(self, task_id: TaskID) -> bool:
+        """
+        Forget the task and cancel it, which also removes the CAPTCHA from the
+        GUI queue or skips it if it is currently displayed.
+
+        :returns: False if there is no such task
+        """
+        try:
+            captcha_task = self.tasks.pop(task_id)
+        except KeyError:
+            return False
+        self._finished.pop(task_id, None)
+        if self.store is not None:
+            self.store.removed(task_id)
+        logging.getLogger('CaptchaTask#%s' % task_id).info('cancelled')
+        self.counters['cancelled'] += 1
+        captcha_task.cancel()
+        return True
+
+    def collect_metrics(self) -> str:
+        """ :returns: the metrics in the Prometheus text format """
+        gauges = self.gauges()
+        return ''.join([
+            format_labelled('anticaptcha_tasks', 'gauge', 'stored tasks by state', 'state',
+                            {'pending': gauges['pending'], 'finished': gauges['finished']}),
+            format_labelled('anticaptcha_tasks_total', 'counter', 'tasks by outcome', 'event',
+                            dict(self.counters, evicted=self.evicted)),
+            self.latency.format('anticaptcha_task_seconds',
+                                'seconds from createTask until the task finished'),
+        ])
 
 def short_json(data):
     return json.dumps(data, separators=(',', ':'))
@@ -79,34 +483,98 @@ async def create_task(task_queue: TaskQueue,
     except json.decoder.JSONDecodeError:
         raise web.HTTPBadRequest(text='invalid JSON')
     try:
-        jsonschema.validate(data, schemas.createTask)
+        schemas.validators['createTask'].validate(data)
+        task = data['task']
+        try:
+            validator = schemas.task_validators[task['type']]
+        except KeyError:
+            return JsonResponse(ERROR_TASK_NOT_SUPPORTED)
+        validator.validate(task)
     except jsonschema.ValidationError as e:
         raise web.HTTPBadRequest(text='malformed request: ' + e.message)
 
-    task = data['task']
-    task_id = await task_queue.enqueue_task(task, data.get('callbackUrl'))
+    try:
+        task_id = await task_queue.enqueue_task(task, data.get('callbackUrl'), data.get('clientKey'))
+    except KeyDoesNotExist as e:
+        task_queue.logger.warning('rejecting task: %s', e)
+        return JsonResponse(ERROR_KEY_DOES_NOT_EXIST)
+    except NoSlotAvailable as e:
+        task_queue.logger.warning('rejecting task: %s', e)
+        return JsonResponse(ERROR_NO_SLOT_AVAILABLE)
     return JsonResponse({
         'errorId': 0,
         'taskId': task_id,
     })
 
+async def create_tasks(task_queue: TaskQueue,
+                       request:    web.Request) -> web.Response:
+    """
+    Batch createTask, the response lists a taskId or an error per task:
+    {"errorId": 0, "tasks": [{"errorId": 0, "taskId": ...}, {"errorId": 23, ...}]}
+    """
+    try:
+        data = await request.json()
+    except json.decoder.JSONDecodeError:
+        raise web.HTTPBadRequest(text='invalid JSON')
+    try:
+        schemas.validators['createTasks'].validate(data)
+    except jsonschema.ValidationError as e:
+        raise web.HTTPBadRequest(text='malformed request: ' + e.message)
+
+    results = [] # type: List[Mapping[str, Any]]
+    valid   = [] # type: List[Task]
+    for task in data['tasks']:
+        try:
+            schemas.task_validators[task['type']].validate(task)
+        except KeyError:
+            results.append(ERROR_TASK_NOT_SUPPORTED)
+        except jsonschema.ValidationError as e:
+            results.append(dict(ERROR_TASK_NOT_SUPPORTED, errorDescription='malformed task: ' + e.message))
+        else:
+            results.append({'errorId': 0})
+            valid.append(task)
+
+    try:
+        task_ids = iter(await task_queue.enqueue_tasks(valid, data.get('callbackUrl'), data.get('clientKey')))
+    except KeyDoesNotExist as e:
+        task_queue.logger.warning('rejecting tasks: %s', e)
+        return JsonResponse(ERROR_KEY_DOES_NOT_EXIST)
+    for i, result in enumerate(results):
+        if result['errorId'] == 0:
+            task_id = next(task_ids)
+            results[i] = ERROR_NO_SLOT_AVAILABLE if task_id is None else {'errorId': 0, 'taskId': task_id}
+    return JsonResponse({
+        'errorId': 0,
+        'tasks': results,
+    })
+
 async def get_task_result(task_queue: TaskQueue,
-                          request:    web.Request):
+                          request:    web.Request) -> web.StreamResponse:
     try:
         data = await request.json()
     except json.decoder.JSONDecodeError:
         raise web.HTTPBadRequest(text='invalid JSON')
     try:
-        jsonschema.validate(data, schemas.getTaskResult)
+        schemas.validators['getTaskResult'].validate(data)
     except jsonschema.ValidationError as e:
         raise web.HTTPBadRequest(text='malformed request: ' + e.message)
 
     task_id = data['taskId']
+    task_queue.expire()
     try:
         captcha_task = task_queue[task_id]
     except KeyError:
         return JsonResponse(ERROR_NO_SUCH_CAPCHA_ID)
 
+    if captcha_task.done():
+        task_queue.discard(task_id)
+        return JsonResponse(task_result(task_id, captcha_task))
+    if not data.get('longPoll', task_queue.long_poll):
+        return JsonResponse({
+            'errorId': 0,
+            'status': 'processing',
+        })
+
     response = web.StreamResponse()
     response.content_type = 'application/json'
     response.enable_chunked_encoding()
@@ -114,43 +582,181 @@ async def get_task_result(task_queue: TaskQueue,
 
     logger = logging.getLogger('CaptchaTask#%s' % task_id)
     logger.info('awaiting...')
-    # wait for the task to be done
-    while True:
-        await asyncio.wait([
-            asyncio.sleep(keep_alive),
-            captcha_task,
-        ], return_when=asyncio.FIRST_COMPLETED)
-        if captcha_task.done():
-            result = captcha_task.result()
-            break
-        # send keep-alive byte
-        await response.write(b' ')
-
-    await response.write(short_json({
-        'errorId': 0,
-        'status': 'ready',
-        'solution': result,
-    }).encode('utf-8'))
+    try:
+        # wait for the task to be done
+        while True:
+            await asyncio.wait([captcha_task, task_queue.ticker.next_tick()],
+                               return_when=asyncio.FIRST_COMPLETED)
+            if captcha_task.done():
+                break
+            if request.transport is None or request.transport.is_closing():
+                raise ConnectionResetError
+            # send keep-alive byte
+            await response.write(b' ')
+    except ConnectionResetError:
+        # noticed at the latest by the keep-alive write, nobody is going to
+        # collect the result
+        logger.info('client disconnected')
+        task_queue.cancel(task_id)
+        return response
+    except asyncio.CancelledError:
+        # a disconnect if the server cancels the handlers of disconnected
+        # clients (handler_cancellation), otherwise the server stops and the
+        # task is kept for the store
+        if not task_queue.stopping:
+            logger.info('client disconnected')
+            task_queue.cancel(task_id)
+        raise
+
+    await response.write(short_json(task_result(task_id, captcha_task)).encode('utf-8'))
     await response.write_eof()
-    del task_queue[task_id]
+    task_queue.discard(task_id)
+    return response
+
+async def get_task_results(task_queue: TaskQueue,
+                           request:    web.Request) -> web.Response:
+    """
+    Batch getTaskResult without long-polling, the response lists the
+    getTaskResult response of every task with its taskId:
+    {"errorId": 0, "tasks": [{"taskId": ..., "errorId": 0, "status": "processing"}, ...]}
+    """
+    try:
+        data = await request.json()
+    except json.decoder.JSONDecodeError:
+        raise web.HTTPBadRequest(text='invalid JSON')
+    try:
+        schemas.validators['getTaskResults'].validate(data)
+    except jsonschema.ValidationError as e:
+        raise web.HTTPBadRequest(text='malformed request: ' + e.message)
+
+    task_queue.expire()
+    results = []
+    for task_id in data['taskIds']:
+        try:
+            captcha_task = task_queue[task_id]
+        except KeyError:
+            result = ERROR_NO_SUCH_CAPCHA_ID # type: Mapping[str, Any]
+        else:
+            if captcha_task.done():
+                task_queue.discard(task_id)
+                result = task_result(task_id, captcha_task)
+            else:
+                result = {'errorId': 0, 'status': 'processing'}
+        results.append(dict(result, taskId=task_id))
+    return JsonResponse({
+        'errorId': 0,
+        'tasks': results,
+    })
 
-def add_routes(app:   web.Application,
-               solve: CaptchaSolveFunc) -> None:
-    task_queue = TaskQueue(solve)
+def task_result(task_id: TaskID, captcha_task: asyncio.Future) -> Mapping[str, Any]:
+    """ :returns: the getTaskResult response of a finished task """
+    if captcha_task.cancelled():
+        return ERROR_NO_SUCH_CAPCHA_ID
+    elif isinstance(captcha_task.exception(), TokenExpired):
+        return dict(ERROR_TOKEN_EXPIRED, errorDescription=str(captcha_task.exception()))
+    elif captcha_task.exception() is not None:
+        logging.getLogger('CaptchaTask#%s' % task_id).error('failed: %s', captcha_task.exception())
+        return ERROR_CAPTCHA_UNSOLVABLE
+    elif isinstance(captcha_task.result(), Solved):
+        solved = captcha_task.result()
+        result = {
+            'errorId': 0,
+            'status': 'ready',
+            'solution': solved.solution,
+        } # type: Dict[str, Any]
+        if solved.solved_at is not None:
+            result['solvedAt'] = solved.solved_at
+        if solved.expires_at is not None:
+            result['expiresAt'] = solved.expires_at
+        return result
+    else:
+        return {
+            'errorId': 0,
+            'status': 'ready',
+            'solution': captcha_task.result(),
+        }
+
+async def cancel_task(task_queue: TaskQueue,
+                      request:    web.Request) -> web.Response:
+    try:
+        data = await request.json()
+    except json.decoder.JSONDecodeError:
+        raise web.HTTPBadRequest(text='invalid JSON')
+    try:
+        schemas.validators['cancelTask'].validate(data)
+    except jsonschema.ValidationError as e:
+        raise web.HTTPBadRequest(text='malformed request: ' + e.message)
+
+    if not task_queue.cancel(data['taskId']):
+        return JsonResponse(ERROR_NO_SUCH_CAPCHA_ID)
+    return JsonResponse({'errorId': 0})
+
+async def metrics(registry: Registry,
+                  request:  web.Request) -> web.Response:
+    return web.Response(body=registry.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+def add_routes(app:      web.Application,
+               solve:    CaptchaSolveFunc,
+               registry: Optional[Registry] = None,
+               **kwargs) -> TaskQueue:
+    """
+    :param registry: metrics served on /metrics in addition to the
+                     TaskQueue's, e.g. DeCaptcha.collect_metrics
+    :param kwargs:   passed to TaskQueue
+    :returns:        the TaskQueue serving the routes
+    """
+    task_queue = TaskQueue(solve, **kwargs)
+    registry = registry or Registry()
+    registry.register(task_queue.collect_metrics)
+    if task_queue.scheduler is not None:
+        registry.register(task_queue.scheduler.collect_metrics)
+    app.on_startup.append(task_queue.start)
+    app.on_shutdown.append(task_queue.shutdown)
+    app.on_cleanup.append(task_queue.stop)
     app.router.add_route('POST', '/createTask',
                          functools.partial(create_task, task_queue))
+    app.router.add_route('POST', '/createTasks',
+                         functools.partial(create_tasks, task_queue))
     app.router.add_route('POST', '/getTaskResult',
                          functools.partial(get_task_result, task_queue))
+    app.router.add_route('POST', '/getTaskResults',
+                         functools.partial(get_task_results, task_queue))
+    app.router.add_route('POST', '/cancelTask',
+                         functools.partial(cancel_task, task_queue))
+    app.router.add_route('GET', '/metrics',
+                         functools.partial(metrics, registry))
+    return task_queue
+
+def task_request(task: Task) -> CaptchaRequest:
+    """ :returns: the DeCaptcha request solving the task """
+    options = {
+        'websiteKey': task['websiteKey'],
+        'sitekey':    task['websiteKey'],
+        'invisible':  task.get('isInvisible', False),
+    }
+    # scheduling hints, see decaptcha.get_priority and decaptcha.get_deadline
+    for option in ('priority', 'deadline'):
+        if option in task:
+            options[option] = task[option]
+    return {
+        'url':     task['websiteURL'],
+        'options': options,
+    }
+
+def _solved(response: CaptchaSuccess) -> Solved:
+    return Solved(response['response'], response.get('solvedAt'), response.get('expiresAt'))
+
+async def _solution(response: Awaitable[CaptchaSuccess]) -> Solved:
+    return _solved(await response)
+
+def wrap_decaptcha_solve(solve: Callable[[CaptchaRequest], Awaitable[CaptchaSuccess]]) -> Callable[[Task], Awaitable[Solved]]:
+    async def wrapped(task: Task) -> Solved:
+        return _solved(await solve(task_request(task)))
+    return wrapped
 
-def wrap_decaptcha_solve(solve: Callable[[CaptchaRequest], Awaitable[CaptchaSuccess]]) -> Callable[[Task], Awaitable[Solution]]:
-    async def wrapped(task: Task) -> Solution:
-        request = {
-            'url': task['websiteURL'],
-            'options': {
-                'websiteKey': task['websiteKey'],
-                'invisible':  task.get('isInvisible', False),
-            }
-        } # type: CaptchaRequest
-        response = await solve(request)
-        return response['response']
+def wrap_decaptcha_solve_many(solve_many: Callable[[Sequence[CaptchaRequest]], Sequence[Awaitable[CaptchaSuccess]]]) -> CaptchaSolveManyFunc:
+    """ Wrap e.g. DeCaptcha.solve_many for TaskQueue's solve_many. """
+    def wrapped(tasks: Sequence[Task]) -> List[Awaitable[Solved]]:
+        return [_solution(response) for response in solve_many([task_request(task) for task in tasks])]
     return wrapped
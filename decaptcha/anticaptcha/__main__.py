@@ -1,32 +1,190 @@
+import argparse
 import asyncio
+import functools
+import json
 import logging
+import os.path
+import random
 import sys
+from typing import Optional
 from aiohttp import web # type: ignore
-from .  import add_routes, wrap_decaptcha_solve
-from .. import DeCaptcha, ReCaptchaHTMLGenerator
+from .  import add_routes, wrap_decaptcha_solve, wrap_decaptcha_solve_many
+from .clients import ClientLimits, FairScheduler
+from .nodes import add_node_routes, NodePool
+from .store import TaskStore
+from .. import DeCaptcha, DisplayBackend, FakeBackend, ReCaptchaHTMLGenerator, WebKitBackend
+from ..metrics import Registry
+from ..reservoir import TokenReservoir
+from ..workers import WorkerPool
 
-async def amain():
-    htmlgen = ReCaptchaHTMLGenerator()
-    decaptcha = DeCaptcha(htmlgen)
+def load_scheduler(args: argparse.Namespace) -> Optional[FairScheduler]:
+    if args.clients is None and args.max_wait is None:
+        return None
+    clients = {}
+    default = ClientLimits() # type: Optional[ClientLimits]
+    if args.clients is not None:
+        with open(args.clients) as f:
+            clients = {key: ClientLimits.from_json(limits) for key, limits in json.load(f).items()}
+        # other clientKeys are rejected unless there are limits for "*"
+        default = clients.pop('*', None)
+    # only the interactive windows, tasks beyond them would wait in
+    # DeCaptcha's queue instead of in the fair order
+    capacity = args.capacity or args.windows * max(1, args.workers)
+    return FairScheduler(capacity, clients, default, max_wait=args.max_wait)
 
-    app = web.Application()
-    add_routes(app, solve=wrap_decaptcha_solve(decaptcha.solve))
+def load_reservoir(args: argparse.Namespace, solve) -> Optional[TokenReservoir]:
+    if args.reservoir is None:
+        return None
+    with open(args.reservoir) as f:
+        pairs = json.load(f)
+    # evicted a while before the front refuses them, so the clients have
+    # time to use the tokens they are handed
+    reservoir = TokenReservoir(solve, lifetime=ReCaptchaHTMLGenerator.token_lifetime,
+                               margin=args.expiry_margin + 10.0)
+    for pair in pairs:
+        reservoir.keep({'url': pair['url'], 'options': pair.get('options', {})}, pair['target'])
+    return reservoir
+
+async def serve(args: argparse.Namespace, solve, app=None, registry=None, solve_many=None, until=None) -> None:
+    """Serve the anti-captcha API until ``until`` is done, or forever."""
+    app = app or web.Application()
+    registry = registry or Registry()
+    reservoir = load_reservoir(args, solve)
+    if reservoir is not None:
+        registry.register(reservoir.collect_metrics)
+
+        async def close_reservoir(app: web.Application) -> None:
+            reservoir.close()
+        app.on_cleanup.append(close_reservoir)
+        # batches are solved one by one, so they are served from the stock
+        solve, solve_many = reservoir.solve, None
+    add_routes(app, solve=wrap_decaptcha_solve(solve), registry=registry,
+               solve_many=wrap_decaptcha_solve_many(solve_many) if solve_many else None,
+               result_ttl=args.result_ttl, max_tasks=args.max_tasks,
+               long_poll=args.long_poll, requeue_stale=args.requeue_stale,
+               expiry_margin=args.expiry_margin,
+               store=TaskStore(args.store) if args.store else None,
+               scheduler=load_scheduler(args))
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, '127.0.0.1', 8100)
+    try:
+        site = web.TCPSite(runner, args.host, args.port)
+        await site.start()
+        await (until if until is not None else asyncio.Event().wait())
+    finally:
+        # runs the on_cleanup handlers, which flush the store
+        await runner.cleanup()
+
+async def amain(args: argparse.Namespace):
+    if args.nodes:
+        # remote solver nodes connect to /nodes
+        nodes = NodePool()
+        app = web.Application()
+        add_node_routes(app, nodes)
+        registry = Registry()
+        registry.register(nodes.collect_metrics)
+        await serve(args, nodes.solve, app, registry)
+    elif args.workers > 0:
+        # supervisor mode, every worker process runs its own GUI loop
+        worker_args = ['--idle-timeout', str(args.idle_timeout), '--preload-timeout', str(args.preload_timeout),
+                       '--offscreen', str(args.offscreen)]
+        if args.max_loads is not None:
+            worker_args += ['--max-loads', str(args.max_loads)]
+        if args.max_memory is not None:
+            worker_args += ['--max-memory', str(args.max_memory)]
+        if args.fake is not None:
+            worker_args += ['--fake', str(args.fake)]
+        if args.cache_dir is not None:
+            # one cache per worker process
+            worker_args += ['--cache-dir', os.path.join(args.cache_dir, 'worker{index}')]
+        pool = WorkerPool.spawn(args.workers, args.display, windows=args.windows,
+                                args=worker_args)
+        await pool.start()
+        try:
+            await serve(args, pool.solve)
+        finally:
+            await pool.stop()
+    else:
+        htmlgen = ReCaptchaHTMLGenerator()
+        if args.fake is not None:
+            backend = FakeBackend(solve_latency=functools.partial(random.expovariate, 1 / args.fake) if args.fake > 0 else 0.0) # type: DisplayBackend
+        else:
+            backend = WebKitBackend.in_directory(args.cache_dir)
+        decaptcha = DeCaptcha(htmlgen, windows=args.windows,
+                              idle_timeout=args.idle_timeout, backend=backend,
+                              preload_timeout=args.preload_timeout, max_loads=args.max_loads,
+                              max_memory=args.max_memory * 2**20 if args.max_memory is not None else None,
+                              offscreen=args.offscreen)
+        registry = Registry()
+        registry.register(decaptcha.collect_metrics)
+        # started first, the reservoir starts solving right away
+        gui = decaptcha.run()
+        await serve(args, decaptcha.solve, registry=registry, solve_many=decaptcha.solve_many, until=gui)
 
-    await site.start()
-    await decaptcha.run()
+parser = argparse.ArgumentParser(prog='python -m decaptcha.anticaptcha')
+parser.add_argument('--host', default='127.0.0.1',
+                    help="address to listen on (default: %(default)s)")
+parser.add_argument('--port', type=int, default=8100,
+                    help="port to listen on (default: %(default)s)")
+parser.add_argument('--windows', type=int, default=1, metavar='N',
+                    help="number of WebKit windows CAPTCHAs are displayed in concurrently, per worker (default: %(default)s)")
+parser.add_argument('--idle-timeout', type=float, default=30.0, metavar='SECONDS',
+                    help="seconds an idle WebKit window is kept hidden for reuse (default: %(default)s)")
+parser.add_argument('--preload-timeout', type=float, default=60.0, metavar='SECONDS',
+                    help="seconds the next CAPTCHA is kept loaded in a hidden WebKit window before it is reloaded, 0 disables preloading (default: %(default)s)")
+parser.add_argument('--offscreen', type=int, default=2, metavar='N',
+                    help="number of offscreen WebKit windows invisible CAPTCHAs are run in without waiting for the interactive windows, per worker (default: %(default)s)")
+parser.add_argument('--max-loads', type=int, metavar='N',
+                    help="replace a WebKit window's webview and web process after it loaded N pages")
+parser.add_argument('--max-memory', type=int, metavar='MB',
+                    help="replace the webview and web process of the WebKit window that loaded the most pages between two CAPTCHAs while the web processes use more than MB MiB each on average")
+parser.add_argument('--result-ttl', type=float, default=300.0, metavar='SECONDS',
+                    help="seconds a finished task's result is kept for collection (default: %(default)s)")
+parser.add_argument('--max-tasks', type=int, default=10000, metavar='N',
+                    help="maximum number of stored tasks (default: %(default)s)")
+parser.add_argument('--long-poll', action='store_true',
+                    help="let getTaskResult wait for the task to finish instead of returning status processing")
+parser.add_argument('--expiry-margin', type=float, default=10.0, metavar='SECONDS',
+                    help="refuse tokens expiring within SECONDS with ERROR_TOKEN_EXPIRED, stocked tokens are evicted 10 seconds before that (default: %(default)s)")
+parser.add_argument('--requeue-stale', action='store_true',
+                    help="solve a task again if its token expires before it is collected instead of answering ERROR_TOKEN_EXPIRED")
+parser.add_argument('--workers', type=int, default=0, metavar='N',
+                    help="run N worker processes with their own GUI loop instead of one in this process")
+parser.add_argument('--display', action='append', default=[], metavar='DISPLAY',
+                    help="X display for the worker processes, may be repeated to distribute them round robin")
+parser.add_argument('--nodes', action='store_true',
+                    help="dispatch tasks to remote solver nodes (python -m decaptcha.node ws://HOST:PORT/nodes) instead of displaying them")
+parser.add_argument('--store', metavar='FILE',
+                    help="SQLite database queued tasks and uncollected results are kept in across restarts")
+parser.add_argument('--clients', metavar='FILE',
+                    help="JSON object of the accepted clientKeys and their limits, e.g. "
+                         "{\"KEY\": {\"weight\": 2, \"max_tasks\": 50, \"rate\": 1, \"burst\": 10}, \"*\": {}}, "
+                         "where \"*\" holds the limits of other clientKeys, which are rejected without it")
+parser.add_argument('--max-wait', type=float, metavar='SECONDS',
+                    help="reject new tasks if they are expected to wait longer than this before they are displayed")
+parser.add_argument('--capacity', type=int, metavar='N',
+                    help="tasks solved concurrently when --clients or --max-wait is given (default: windows times workers, required with --nodes)")
+parser.add_argument('--reservoir', metavar='FILE',
+                    help="JSON list of the CAPTCHAs to keep solved tokens of in stock, e.g. "
+                         "[{\"url\": \"https://example.com/\", \"options\": {\"sitekey\": \"KEY\"}, \"target\": 2}]")
+parser.add_argument('--cache-dir', metavar='DIR',
+                    help="directory WebKit's HTTP disk cache (DIR/cache) and website data, e.g. cookies (DIR/data), are kept in across restarts")
+parser.add_argument('--fake', type=float, metavar='SECONDS',
+                    help="solve every CAPTCHA by itself after on average SECONDS instead of displaying it, for load tests without a display")
+args = parser.parse_args()
+if args.nodes and (args.clients is not None or args.max_wait is not None) and args.capacity is None:
+    # --windows and --workers do not apply to the remote nodes
+    parser.error('--clients and --max-wait require --capacity with --nodes')
 
 print(r'''
 curl -d '{"task":{"type":"HCaptchaTaskProxyless","websiteURL":"https://decaptcha.test/","websiteKey":"6LeIxAcTAAAAAJcZVRqyHh71UMIEGNQ_MXjiZKhI"}}' http://127.0.0.1:8100/createTask && echo && \
 curl -d '{"task":{"type":"HCaptchaTaskProxyless","websiteURL":"https://decaptcha.test/","websiteKey":"6LeIxAcTAAAAAJcZVRqyHh71UMIEGNQ_MXjiZKhI"}}' http://127.0.0.1:8100/createTask && echo && \
 printf 'Enter first task id: ' && read taskid1 && \
 printf 'Enter second task id: ' && read taskid2 && \
-curl -d '{"taskId":"'"$taskid2"'"}' http://127.0.0.1:8100/getTaskResult && echo && \
-curl -d '{"taskId":"'"$taskid1"'"}' http://127.0.0.1:8100/getTaskResult && echo
+curl -d '{"taskId":"'"$taskid2"'","longPoll":true}' http://127.0.0.1:8100/getTaskResult && echo && \
+curl -d '{"taskId":"'"$taskid1"'","longPoll":true}' http://127.0.0.1:8100/getTaskResult && echo
 ''')
 
 logging.basicConfig(format='[%(asctime)s] %(levelname)-8s %(name)-48s %(message)s',
                     level=logging.DEBUG, stream=sys.stderr)
-asyncio.run(amain())
+asyncio.run(amain(args))
@@ -0,0 +1,109 @@
+import asyncio
+import collections
+import json
+import logging
+from typing import (
+    Any,
+    Deque,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+)
+
+import aiohttp # type: ignore
+
+class DeadLetter(NamedTuple):
+    url:     str
+    payload: Mapping[str, Any]
+    error:   str
+
+class CallbackDispatcher:
+    """
+    POST task results to their callbackUrl through one pooled
+    aiohttp.ClientSession, retrying failed deliveries with exponential
+    backoff. Deliveries that failed every attempt are kept in dead_letters.
+    """
+
+    logger = logging.getLogger('CallbackDispatcher')
+
+    def __init__(self,
+                 concurrency:  int   = 16,
+                 attempts:     int   = 5,
+                 backoff:      float = 1.0,
+                 max_backoff:  float = 60.0,
+                 timeout:      float = 10.0,
+                 dead_letters: int   = 1000):
+        """
+        :param concurrency:  maximum number of concurrent deliveries
+        :param attempts:     number of delivery attempts per callback
+        :param backoff:      seconds to wait after the first failed attempt,
+                             doubled after every further one
+        :param max_backoff:  maximum seconds to wait between attempts
+        :param timeout:      seconds an attempt may take
+        :param dead_letters: number of failed deliveries kept
+        """
+        self.concurrency  = concurrency
+        self.attempts     = attempts
+        self.backoff      = backoff
+        self.max_backoff  = max_backoff
+        self.timeout      = timeout
+        self.dead_letters = collections.deque(maxlen=dead_letters) # type: Deque[DeadLetter]
+        self.delivered    = 0
+        self._session     = None  # type: Optional[aiohttp.ClientSession]
+        self._semaphore   = None  # type: Optional[asyncio.Semaphore]
+        self._pending     = set() # type: Set[asyncio.Task]
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                json_serialize=lambda data: json.dumps(data, separators=(',', ':')),
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def _post(self, url: str, payload: Mapping[str, Any]) -> None:
+        session = self._get_session()
+        async with self._semaphore: # type: ignore
+            async with session.post(url, json=payload) as response:
+                response.raise_for_status()
+
+    async def deliver(self, url: str, payload: Mapping[str, Any]) -> bool:
+        """
+        :returns: whether payload was delivered
+        """
+        backoff = self.backoff
+        error = None # type: Optional[BaseException]
+        for attempt in range(1, self.attempts + 1):
+            try:
+                await self._post(url, payload)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+                self.logger.warning('delivering callback to %s failed (attempt %d/%d): %r',
+                                    url, attempt, self.attempts, e)
+            else:
+                self.delivered += 1
+                return True
+            if attempt < self.attempts:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+        self.logger.error('giving up delivering callback to %s', url)
+        self.dead_letters.append(DeadLetter(url, payload, repr(error)))
+        return False
+
+    def dispatch(self, url: str, payload: Mapping[str, Any]) -> asyncio.Task:
+        """ Deliver payload in the background. """
+        task = asyncio.create_task(self.deliver(url, payload))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return task
+
+    async def close(self) -> None:
+        """ Cancel pending deliveries and close the session. """
+        for task in list(self._pending):
+            task.cancel()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
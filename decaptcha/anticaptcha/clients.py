@@ -0,0 +1,251 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import time
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+)
+from ..metrics import format_gauge, format_labelled
+
+class NoSlotAvailable(Exception):
+    pass
+
+class KeyDoesNotExist(Exception):
+    pass
+
+class ClientLimits(NamedTuple):
+    # share of the solvers relative to other clients with queued tasks
+    weight:    float           = 1.0
+    # unfinished tasks, queued or being solved
+    max_tasks: Optional[int]   = None
+    # tasks per second, with bursts of up to burst tasks
+    rate:      Optional[float] = None
+    burst:     int             = 10
+
+    @classmethod
+    def from_json(cls, data: Mapping[str, Any]) -> 'ClientLimits':
+        return cls(**{key: data[key] for key in cls._fields if key in data})
+
+class Client:
+    __slots__ = ('key', 'limits', 'tasks', 'tokens', 'refilled', 'finish')
+
+    def __init__(self, key: str, limits: ClientLimits, now: float):
+        self.key      = key
+        self.limits   = limits
+        self.tasks    = 0
+        self.tokens   = float(limits.burst)
+        self.refilled = now
+        # virtual finish time of the client's last queued task
+        self.finish   = 0.0
+
+    def idle(self, now: float) -> bool:
+        """ :returns: whether the client has no unfinished tasks and a full token bucket """
+        rate = self.limits.rate
+        return self.tasks == 0 and (rate is None or self.tokens + (now - self.refilled) * rate >= self.limits.burst)
+
+    def take_token(self, now: float) -> bool:
+        rate = self.limits.rate
+        if rate is None:
+            return True
+        self.tokens   = min(float(self.limits.burst), self.tokens + (now - self.refilled) * rate)
+        self.refilled = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class FairScheduler:
+    """
+    Admission control and weighted fair queueing of tasks by clientKey.
+
+    At most capacity tasks are being solved at once, the others wait in the
+    scheduler and are started in the order of their virtual finish time, so
+    every client with queued tasks gets a share of the solvers proportional
+    to its weight.
+
+    A task is rejected with NoSlotAvailable if its client exceeds its limits,
+    or if the estimated wait exceeds max_wait or the task's deadline.
+    """
+
+    logger = logging.getLogger('FairScheduler')
+
+    def __init__(self,
+                 capacity:   int,
+                 clients:    Optional[Mapping[str, ClientLimits]] = None,
+                 default:    Optional[ClientLimits] = ClientLimits(),
+                 max_wait:   Optional[float] = None,
+                 solve_time: float = 20.0):
+        """
+        :param capacity:   number of tasks solved concurrently
+        :param clients:    limits by clientKey
+        :param default:    limits of clientKeys not in clients, None rejects
+                           them with KeyDoesNotExist
+        :param max_wait:   seconds a new task may be expected to wait before
+                           it is started
+        :param solve_time: initial estimate of the seconds a task is solved
+                           in, refined with every solved task
+        """
+        self.capacity   = capacity
+        self.limits     = dict(clients or {}) # type: Dict[str, ClientLimits]
+        self.default    = default
+        self.max_wait   = max_wait
+        self.solve_time = solve_time
+        self.running    = 0
+        self.rejected   = collections.Counter() # type: collections.Counter[str]
+        self._clients   = {} # type: Dict[str, Client]
+        # [virtual finish time, seq, client, result future, start], start is
+        # None once the task was started
+        self._heap      = [] # type: List[List[Any]]
+        self._seq       = itertools.count()
+        self._vtime     = 0.0
+        # tasks in the heap that were cancelled before they were started
+        self._cancelled = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self._heap) - self._cancelled
+
+    def estimated_wait(self, pending: int = 0) -> float:
+        """
+        :param pending: admitted tasks that are not scheduled yet, e.g. the
+                        previous tasks of a batch
+        :returns:       seconds a task queued now is expected to wait
+        """
+        ahead = self.queued + pending - (self.capacity - self.running)
+        if ahead < 0:
+            return 0.0
+        return (ahead + 1) * self.solve_time / self.capacity
+
+    def client(self, key: Optional[str]) -> Client:
+        """
+        :raises KeyDoesNotExist: if the clientKey is not accepted
+        """
+        key = key or ''
+        try:
+            return self._clients[key]
+        except KeyError:
+            pass
+        limits = self.limits.get(key, self.default)
+        if limits is None:
+            self.rejected['unknown_key'] += 1
+            raise KeyDoesNotExist('unknown clientKey %r' % key)
+        client = self._clients[key] = Client(key, limits, time.monotonic())
+        return client
+
+    def admit(self, client: Client, deadline: Optional[float] = None, pending: int = 0) -> None:
+        """
+        Account for a new task of the client.
+
+        :param deadline: UNIX timestamp the task must be started by
+        :param pending:  tasks admitted before that are not scheduled yet and
+                         will be queued ahead of this one
+        :raises NoSlotAvailable: if the task is rejected
+        """
+        limits = client.limits
+        if limits.max_tasks is not None and client.tasks >= limits.max_tasks:
+            self.rejected['max_tasks'] += 1
+            raise NoSlotAvailable('client %r has %d unfinished tasks' % (client.key, client.tasks))
+        wait = self.estimated_wait(pending)
+        if self.max_wait is not None and wait > self.max_wait:
+            self.rejected['max_wait'] += 1
+            raise NoSlotAvailable('estimated wait of %.1fs exceeds %.1fs' % (wait, self.max_wait))
+        if deadline is not None and time.time() + wait > deadline:
+            self.rejected['deadline'] += 1
+            raise NoSlotAvailable('estimated wait of %.1fs exceeds the deadline' % wait)
+        if not client.take_token(time.monotonic()):
+            self.rejected['rate'] += 1
+            raise NoSlotAvailable('client %r exceeds %s tasks per second' % (client.key, limits.rate))
+        client.tasks += 1
+
+    def schedule(self, client: Client, start: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """
+        Queue an admitted task, start is called once it is its turn.
+
+        :returns: a future resolved with the result of start's awaitable,
+                  cancelling it cancels the task
+        """
+        result = asyncio.get_running_loop().create_future()
+        client.finish = max(self._vtime, client.finish) + 1 / client.limits.weight
+        entry = [client.finish, next(self._seq), client, result, start]
+        heapq.heappush(self._heap, entry)
+
+        @result.add_done_callback
+        def _(_: asyncio.Future) -> None:
+            client.tasks -= 1
+            if entry[4] is not None:
+                self._cancelled += 1
+
+        self._dispatch()
+        return result
+
+    def _dispatch(self) -> None:
+        while self.running < self.capacity and self._heap:
+            entry = heapq.heappop(self._heap)
+            finish, _, client, result, start = entry
+            if result.done():
+                # cancelled while queued
+                self._cancelled -= 1
+                continue
+            entry[4] = None
+            self._vtime = finish
+            self._start(result, start)
+        if not self._heap and self.running == 0:
+            # idle, forget the virtual time so it does not grow forever, and
+            # the clients that are idle as well
+            self._vtime = 0.0
+            now = time.monotonic()
+            for key, client in list(self._clients.items()):
+                client.finish = 0.0
+                if client.idle(now):
+                    del self._clients[key]
+
+    def _start(self, result: asyncio.Future, start: Callable[[], Awaitable[Any]]) -> None:
+        self.running += 1
+        started = asyncio.get_running_loop().time()
+        inner = asyncio.ensure_future(start())
+
+        @inner.add_done_callback
+        def _(_: asyncio.Future) -> None:
+            self.running -= 1
+            if inner.cancelled():
+                result.cancel()
+                self._dispatch()
+                return
+            e = inner.exception()
+            if e is not None:
+                if not result.done():
+                    result.set_exception(e)
+            else:
+                # exponentially weighted moving average of solved tasks
+                elapsed = asyncio.get_running_loop().time() - started
+                self.solve_time += (elapsed - self.solve_time) / 8
+                if not result.done():
+                    result.set_result(inner.result())
+            self._dispatch()
+
+        @result.add_done_callback
+        def _(_: asyncio.Future) -> None:
+            if result.cancelled():
+                inner.cancel()
+
+    def collect_metrics(self) -> str:
+        return ''.join([
+            format_gauge('anticaptcha_scheduler_queued', 'tasks waiting for a solver', self.queued),
+            format_gauge('anticaptcha_scheduler_running', 'tasks being solved', self.running),
+            format_gauge('anticaptcha_scheduler_estimated_wait_seconds', 'estimated wait of a new task',
+                         self.estimated_wait()),
+            # clientKeys are credentials, they are not used as labels
+            format_gauge('anticaptcha_scheduler_clients', 'clients with unfinished tasks or rate limit state',
+                         len(self._clients)),
+            format_labelled('anticaptcha_rejected_total', 'counter', 'tasks rejected by reason', 'reason',
+                            self.rejected),
+        ])
@@ -0,0 +1,191 @@
+import asyncio
+import collections
+import itertools
+import json
+import logging
+from aiohttp import web # type: ignore
+from typing import (
+    Any,
+    Awaitable,
+    Deque,
+    Dict,
+    Final,
+    Mapping,
+    Optional,
+    Set,
+)
+from ..metrics import format_gauge
+from ..request import CaptchaException, CaptchaRequest, CaptchaSuccess
+
+# Remote solver nodes (python -m decaptcha.node) connect to the WebSocket
+# route added by add_node_routes, announce how many CAPTCHAs they solve
+# concurrently, and are sent requests up to that capacity. The messages are
+# those of the worker protocol (see decaptcha.workers) plus the announcement:
+#
+#   <- {"hello": {"capacity": 2}}
+#   -> {"id": 1, "request": {"url": ..., "options": {...}}}
+#   -> {"id": 1, "cancel": true}
+#   <- {"id": 1, "response": {...}, "solvedAt": ..., "expiresAt": ...}
+#   <- {"id": 1, "error": "reason"}
+#
+# Requests of nodes that disconnect or miss heartbeats are requeued.
+
+class PendingRequest:
+    __slots__ = ('id', 'request', 'future', 'node')
+
+    def __init__(self, id: int, request: CaptchaRequest, future: asyncio.Future):
+        self.id      = id
+        self.request = request
+        self.future  = future
+        self.node    = None # type: Optional[RemoteNode]
+
+class RemoteNode:
+    def __init__(self, name: str, ws: web.WebSocketResponse, capacity: int):
+        self.name     = name
+        self.ws       = ws
+        self.capacity = capacity
+        self.requests = {} # type: Dict[int, PendingRequest]
+        self.logger   = logging.getLogger('NodePool.%s' % name)
+        self._sending = set() # type: Set[asyncio.Future]
+
+    @property
+    def free(self) -> int:
+        return self.capacity - len(self.requests)
+
+    def send(self, msg: Mapping[str, Any], pending: Optional[PendingRequest] = None) -> None:
+        """
+        Send msg in the background.
+
+        :param pending: request failed if msg cannot be sent
+        """
+        fut = asyncio.ensure_future(self.ws.send_str(json.dumps(msg, separators=(',', ':'))))
+        self._sending.add(fut)
+
+        @fut.add_done_callback
+        def _(fut: asyncio.Future) -> None:
+            self._sending.discard(fut)
+            if fut.cancelled() or fut.exception() is None:
+                return
+            self.logger.error('sending %r failed: %r', msg, fut.exception())
+            if pending is not None and self.requests.pop(pending.id, None) is not None \
+                    and not pending.future.done():
+                pending.future.set_exception(CaptchaException('sending to %s failed' % self.name))
+
+class NodePool:
+    """
+    Solve function dispatching requests to remote solver nodes.
+    """
+
+    logger = logging.getLogger('NodePool')
+
+    def __init__(self, heartbeat: float = 10.0):
+        """
+        :param heartbeat: seconds between WebSocket pings, a node that does
+                          not answer within half of it is considered dead
+        """
+        self.heartbeat = heartbeat
+        self.nodes     = set() # type: Final[Set[RemoteNode]]
+        self._queue    = collections.deque() # type: Deque[PendingRequest]
+        self._ids      = itertools.count(1)
+        self._names    = itertools.count(1)
+
+    @property
+    def capacity(self) -> int:
+        return sum(node.capacity for node in self.nodes)
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def collect_metrics(self) -> str:
+        return ''.join([
+            format_gauge('anticaptcha_nodes', 'connected solver nodes', len(self.nodes)),
+            format_gauge('anticaptcha_nodes_capacity', 'CAPTCHAs the connected nodes solve concurrently',
+                         self.capacity),
+            format_gauge('anticaptcha_nodes_busy', 'CAPTCHAs the connected nodes are solving',
+                         sum(len(node.requests) for node in self.nodes)),
+            format_gauge('anticaptcha_nodes_queued', 'CAPTCHAs waiting for a free node', self.queued),
+        ])
+
+    def _dispatch(self) -> None:
+        while self._queue:
+            node = max(self.nodes, key=lambda node: node.free, default=None)
+            if node is None or node.free <= 0:
+                break
+            pending = self._queue.popleft()
+            pending.node = node
+            node.requests[pending.id] = pending
+            node.send({'id': pending.id, 'request': pending.request}, pending)
+
+    def solve(self, req: CaptchaRequest) -> Awaitable[CaptchaSuccess]:
+        fut = asyncio.get_running_loop().create_future()
+        pending = PendingRequest(next(self._ids), req, fut)
+        self._queue.append(pending)
+
+        @fut.add_done_callback
+        def _(fut: asyncio.Future) -> None:
+            if not fut.cancelled():
+                return
+            node = pending.node
+            if node is None:
+                try:
+                    self._queue.remove(pending)
+                except ValueError:
+                    pass
+            elif node.requests.pop(pending.id, None) is not None:
+                node.send({'id': pending.id, 'cancel': True})
+                self._dispatch()
+
+        self._dispatch()
+        return fut
+
+    def _on_message(self, node: RemoteNode, msg: Mapping[str, Any]) -> None:
+        pending = node.requests.pop(msg['id'], None)
+        if pending is None or pending.future.done():
+            return
+        if 'error' in msg:
+            pending.future.set_exception(CaptchaException(msg['error']))
+        else:
+            pending.future.set_result({key: value for key, value in msg.items() if key != 'id'})
+
+    async def handle(self, request: web.Request) -> web.WebSocketResponse:
+        """ WebSocket handler remote nodes connect to. """
+        ws = web.WebSocketResponse(heartbeat=self.heartbeat)
+        await ws.prepare(request)
+        logger = self.logger
+        node = None # type: Optional[RemoteNode]
+        try:
+            async for message in ws:
+                if message.type != web.WSMsgType.TEXT:
+                    continue
+                try:
+                    msg = json.loads(message.data)
+                    if node is None:
+                        capacity = int(msg['hello']['capacity'])
+                        node = RemoteNode('node#%d' % next(self._names), ws, capacity)
+                        logger = node.logger
+                        logger.info('connected from %s with capacity %d', request.remote, capacity)
+                        self.nodes.add(node)
+                    else:
+                        self._on_message(node, msg)
+                except (ValueError, KeyError, TypeError):
+                    # one bad message does not cost the node its requests
+                    logger.error('malformed message: %r', message.data)
+                    continue
+                self._dispatch()
+        finally:
+            if node is not None:
+                self.nodes.discard(node)
+                requeue = [pending for pending in node.requests.values() if not pending.future.done()]
+                logger.warning('disconnected, requeueing %d requests', len(requeue))
+                for pending in reversed(requeue):
+                    pending.node = None
+                    self._queue.appendleft(pending)
+                node.requests.clear()
+                self._dispatch()
+        return ws
+
+def add_node_routes(app:  web.Application,
+                    pool: NodePool,
+                    path: str = '/nodes') -> None:
+    app.router.add_route('GET', path, pool.handle)
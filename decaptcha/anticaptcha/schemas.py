@@ -1,3 +1,5 @@
+import jsonschema # type: ignore
+
 def _update(a, b, *args):
 	""" Recursively update dicts and join lists like sets. """
 	if args:
@@ -26,6 +28,9 @@ HCaptchaTaskProxyless = {
 		'type':       {'const': 'HCaptchaTaskProxyless'},
 		'websiteURL': {'type': 'string'},
 		'websiteKey': {'type': 'string'},
+		# decaptcha extensions
+		'priority':   {'type': 'integer'},
+		'deadline':   {'type': 'number'},
 	},
 	'required': [
 		'type',
@@ -60,7 +65,7 @@ RecaptchaV2TaskProxyless = _update(HCaptchaTaskProxyless, {
 		# optional
 		'websiteSToken':       {'type': 'string'},
 		'recaptchaDataSValue': {'type': 'string'},
-		'isInvisible':         {'type': 'string'},
+		'isInvisible':         {'type': 'boolean'},
 	},
 })
 
@@ -70,26 +75,83 @@ RecaptchaV2Task = _update(HCaptchaTask, RecaptchaV2TaskProxyless, {
 	},
 })
 
+tasks = {
+	'HCaptchaTaskProxyless':    HCaptchaTaskProxyless,
+	'HCaptchaTask':             HCaptchaTask,
+	'RecaptchaV2TaskProxyless': RecaptchaV2TaskProxyless,
+	'RecaptchaV2Task':          RecaptchaV2Task,
+}
+
+# the task itself is validated against tasks[task['type']], see task_validators
+task_envelope = {
+	'type': 'object',
+	'properties': {
+		'type': {'type': 'string'},
+	},
+	'required': ['type'],
+}
+
 createTask = {
 	'type': 'object',
 	'properties': {
-		'task': {
-			'anyOf': [
-				HCaptchaTaskProxyless,
-				HCaptchaTask,
-				RecaptchaV2TaskProxyless,
-				RecaptchaV2Task,
-			],
-		},
+		'task': task_envelope,
 		'callbackUrl': {
 			'type': 'string',
 		},
+		'clientKey': {
+			'type': 'string',
+		},
 	},
 	'required': ['task'],
 	'additionalProperties': True,  # ignore other properties
 }
 
+createTasks = {
+	'type': 'object',
+	'properties': {
+		'tasks': {
+			'type': 'array',
+			'items': task_envelope,
+			'minItems': 1,
+			'maxItems': 1000,
+		},
+		'callbackUrl': {
+			'type': 'string',
+		},
+		'clientKey': {
+			'type': 'string',
+		},
+	},
+	'required': ['tasks'],
+	'additionalProperties': True,  # ignore other properties
+}
+
 getTaskResult = {
+	'type': 'object',
+	'properties': {
+		'taskId': {'type': 'string'},
+		# decaptcha extension, wait for the task to finish
+		'longPoll': {'type': 'boolean'},
+	},
+	'required': ['taskId'],
+	'additionalProperties': True,  # ignore other properties
+}
+
+getTaskResults = {
+	'type': 'object',
+	'properties': {
+		'taskIds': {
+			'type': 'array',
+			'items': {'type': 'string'},
+			'minItems': 1,
+			'maxItems': 1000,
+		},
+	},
+	'required': ['taskIds'],
+	'additionalProperties': True,  # ignore other properties
+}
+
+cancelTask = {
 	'type': 'object',
 	'properties': {
 		'taskId': {'type': 'string'},
@@ -104,5 +166,17 @@ all = {
 	'RecaptchaV2TaskProxyless': RecaptchaV2TaskProxyless,
 	'RecaptchaV2Task':          RecaptchaV2Task,
 	'createTask':               createTask,
+	'createTasks':              createTasks,
 	'getTaskResult':            getTaskResult,
+	'getTaskResults':           getTaskResults,
+	'cancelTask':               cancelTask,
 }
+
+def compile_validator(schema):
+	""" Check the schema once and return a reusable validator for it. """
+	cls = jsonschema.validators.validator_for(schema)
+	cls.check_schema(schema)
+	return cls(schema)
+
+validators      = {name: compile_validator(schema) for name, schema in all.items()}
+task_validators = {name: validators[name] for name in tasks}
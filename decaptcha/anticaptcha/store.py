@@ -0,0 +1,144 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from typing import (
+    Any,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+class StoredTask(NamedTuple):
+    task_id:      str
+    task:         Any
+    callback_url: Optional[str]
+    created:      float
+    # set once finished, either the solution or an error
+    finished:     Optional[float]
+    solution:     Any
+    error:        Optional[str]
+    # UNIX time the solution's token expires at, if known
+    expires:      Optional[float] = None
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id      TEXT PRIMARY KEY,
+    task         TEXT NOT NULL,
+    callback_url TEXT,
+    created      REAL NOT NULL,
+    finished     REAL,
+    solution     TEXT,
+    error        TEXT,
+    expires      REAL
+)
+'''
+
+class TaskStore:
+    """
+    SQLite store of TaskQueue's tasks, so queued tasks and uncollected
+    results survive a restart.
+
+    Writes are queued and committed in batches by a background thread, so
+    they never block the event loop.
+    """
+
+    logger = logging.getLogger('TaskStore')
+
+    def __init__(self,
+                 path:           str,
+                 batch_interval: float = 0.05,
+                 batch_size:     int   = 1000):
+        """
+        :param path:           SQLite database file
+        :param batch_interval: seconds writes are collected before they are
+                               committed together
+        :param batch_size:     maximum number of writes per commit
+        """
+        self.path           = path
+        self.batch_interval = batch_interval
+        self.batch_size     = batch_size
+        self._queue         = queue.SimpleQueue() # type: queue.SimpleQueue[Optional[Tuple[str, Tuple[Any, ...]]]]
+        self._writer        = None # type: Optional[threading.Thread]
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(_schema)
+        try:
+            # databases created before expires was added
+            db.execute('ALTER TABLE tasks ADD COLUMN expires REAL')
+        except sqlite3.OperationalError:
+            pass
+        db.commit()
+        return db
+
+    def load(self) -> List[StoredTask]:
+        """ Read all stored tasks, oldest first. Blocking. """
+        db = self._connect()
+        try:
+            rows = db.execute('SELECT task_id, task, callback_url, created, finished, solution, error, expires'
+                              ' FROM tasks ORDER BY created').fetchall()
+        finally:
+            db.close()
+        return [StoredTask(task_id, json.loads(task), callback_url, created, finished,
+                           None if solution is None else json.loads(solution), error, expires)
+                for task_id, task, callback_url, created, finished, solution, error, expires in rows]
+
+    def open(self) -> None:
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write, args=(self._connect(),),
+                                            name='TaskStore', daemon=True)
+            self._writer.start()
+
+    def close(self) -> None:
+        """ Commit all queued writes and stop the writer thread. Blocking. """
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def _write(self, db: sqlite3.Connection) -> None:
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                if batch[-1] is None:
+                    break
+            try:
+                with db:
+                    for op in batch:
+                        if op is None:
+                            running = False
+                        else:
+                            db.execute(*op)
+            except sqlite3.Error:
+                self.logger.exception('writing %d operations failed', len(batch))
+        db.close()
+
+    def created(self, task_id: str, task: Any, callback_url: Optional[str]) -> None:
+        self._queue.put(('INSERT OR REPLACE INTO tasks (task_id, task, callback_url, created) VALUES (?, ?, ?, ?)',
+                         (task_id, json.dumps(task), callback_url, time.time())))
+
+    def finished(self,
+                 task_id:  str,
+                 solution: Any = None,
+                 error:    Optional[str] = None,
+                 expires:  Optional[float] = None) -> None:
+        self._queue.put(('UPDATE tasks SET finished = ?, solution = ?, error = ?, expires = ? WHERE task_id = ?',
+                         (time.time(), None if error is not None else json.dumps(solution), error, expires, task_id)))
+
+    def removed(self, task_id: str) -> None:
+        self._queue.put(('DELETE FROM tasks WHERE task_id = ?', (task_id,)))
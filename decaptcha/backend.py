@@ -0,0 +1,345 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import heapq
+import itertools
+import queue
+import time
+from typing import (
+	Any,
+	Callable,
+	List,
+	Optional,
+	Sequence,
+	Union,
+)
+
+# DeCaptcha's request loop runs on the thread of a DisplayBackend's main loop
+# and displays the CAPTCHAs in the backend's windows. The WebKit backend lives
+# in decaptcha.gui, FakeBackend below solves every CAPTCHA by itself after a
+# configurable latency, e.g. to test or benchmark everything but WebKit
+# without a display.
+
+class Window:
+	"""
+	A window displaying CAPTCHA pages, its methods are called on the thread of
+	the backend's main loop.
+	"""
+
+	def show(self) -> None:
+		raise NotImplementedError
+
+	def hide(self) -> None:
+		raise NotImplementedError
+
+	def destroy(self) -> None:
+		""" Close the window without calling its on_closed callback. """
+		raise NotImplementedError
+
+	def set_resources(self, css: str, js: str) -> None:
+		""" Inject css and js into every page loaded afterwards. """
+		raise NotImplementedError
+
+	def load_html(self, html: str, base_uri: str) -> None:
+		raise NotImplementedError
+
+	def load_blank(self) -> None:
+		raise NotImplementedError
+
+	def recycle(self) -> None:
+		"""
+		Replace the webview, and with it its web process, by a new one with
+		the same resources, keeping the window.
+		"""
+		raise NotImplementedError
+
+
+class DisplayBackend:
+	"""
+	Main loop and windows DeCaptcha displays CAPTCHAs in.
+	"""
+
+	def load(self) -> None:
+		""" Import the libraries required by the backend, may be called repeatedly. """
+
+	def run(self) -> None:
+		""" Run the main loop until quit is called. Blocking. """
+		raise NotImplementedError
+
+	def quit(self) -> None:
+		""" Make run return, called on the main loop's thread. """
+		raise NotImplementedError
+
+	def idle_add(self, callback: Callable[[], Any]) -> None:
+		"""
+		Safe to call from another thread.
+
+		Call callback once on the main loop's thread.
+		"""
+		raise NotImplementedError
+
+	def timeout_add(self, seconds: float, callback: Callable[[], Any]) -> Any:
+		"""
+		Call callback once after seconds.
+
+		:returns: a handle for source_remove
+		"""
+		raise NotImplementedError
+
+	def source_remove(self, source: Any) -> None:
+		raise NotImplementedError
+
+	def warm_up(self, urls: Sequence[str]) -> None:
+		"""
+		Resolve the hosts of and fetch urls, which will be loaded by every
+		page, so they are cached when the first page is displayed. Called on
+		the main loop's thread.
+		"""
+
+	def collect_metrics(self) -> str:
+		""" :returns: the backend's metrics in the Prometheus text format """
+		return ''
+
+	def memory_usage(self) -> Optional[int]:
+		"""
+		Safe to call from another thread.
+
+		:returns: bytes of resident memory of the processes rendering the
+		          windows' pages, None if unknown
+		"""
+		return None
+
+	def create_window(self,
+	                  title:            str,
+	                  on_message:       Callable[[Any], None],
+	                  on_closed:        Callable[[], None],
+	                  on_load_finished: Callable[[], None],
+	                  on_load_failed:   Callable[[str, str], None],
+	                  visible:          bool = True,
+	                  offscreen:        bool = False) -> Window:
+		"""
+		Create a window, shown unless visible is False.
+
+		:param on_message:       called with the JSON value a page posted
+		:param on_closed:        called when the user closed the window
+		:param on_load_finished: called when a page loaded by load_html finished
+		                         loading
+		:param on_load_failed:   called with the URI and the error if loading a
+		                         page failed
+		:param offscreen:        render the pages as if the window was shown,
+		                         without ever showing it
+		"""
+		raise NotImplementedError
+
+
+Latency = Union[float, Callable[[], float]]
+
+def _seconds(latency: Latency) -> float:
+	return latency() if callable(latency) else latency
+
+
+class FakeWindow(Window):
+	def __init__(self,
+	             backend:          'FakeBackend',
+	             on_message:       Callable[[Any], None],
+	             on_closed:        Callable[[], None],
+	             on_load_finished: Callable[[], None],
+	             visible:          bool):
+		self.backend          = backend
+		self.on_message       = on_message
+		self.on_closed        = on_closed
+		self.on_load_finished = on_load_finished
+		self.visible          = visible
+		self.destroyed        = False
+		self.loads            = 0
+		# pages loaded since the window was created or recycled
+		self.pages            = 0
+		self.recycled         = 0
+		self.base_uri         = ''
+		# the page finished loading and waits to be solved
+		self.loaded           = False
+		# the page waits for a user, it is not an invisible CAPTCHA solving
+		# itself
+		self.interactive      = True
+		self._started         = 0.0
+		self._timer           = None # type: Optional[List[Any]]
+
+	def _cancel(self) -> None:
+		if self._timer is not None:
+			self.backend.source_remove(self._timer)
+			self._timer = None
+
+	def _start_solving(self) -> None:
+		# like a user, only solve interactive pages that are shown
+		if self.loaded and (self.visible or not self.interactive) and self._timer is None:
+			self._timer = self.backend.timeout_add(_seconds(self.backend.solve_latency), self._solved)
+
+	def _mark(self, name: str) -> None:
+		""" Post a timing mark like recaptcha.js. """
+		self.on_message({'type': 'timing', 'mark': name, 'time': (time.monotonic() - self._started) * 1000})
+
+	def _solved(self) -> None:
+		self._timer  = None
+		self.loaded  = False
+		self._mark('submit')
+		self.on_message({'type': 'response', 'response': self.backend.response(self.base_uri)})
+
+	def show(self) -> None:
+		self.visible = True
+		self._start_solving()
+
+	def hide(self) -> None:
+		self.visible = False
+		if self.loaded and self.interactive:
+			self._cancel()
+
+	def destroy(self) -> None:
+		self._cancel()
+		self.loaded    = False
+		self.visible   = False
+		self.destroyed = True
+
+	def close(self) -> None:
+		""" Close the window like a user would. """
+		self.destroy()
+		self.on_closed()
+
+	def set_resources(self, css: str, js: str) -> None:
+		pass
+
+	def load_html(self, html: str, base_uri: str) -> None:
+		self._cancel()
+		self.loads   += 1
+		self.pages   += 1
+		self.loaded   = False
+		self.base_uri = base_uri
+		self._started = time.monotonic()
+		# like recaptcha.js, an invisible CAPTCHA is executed once it loaded
+		self.interactive = 'data-size="invisible"' not in html
+
+		def loaded() -> None:
+			self._timer = None
+			self.loaded = True
+			self.on_load_finished()
+			self._mark('api')
+			self._mark('onload')
+			if not self.interactive and self.backend.challenge(base_uri):
+				self.interactive = True
+				self._mark('challenge')
+				self.on_message({'type': 'challenge'})
+			self._start_solving()
+
+		self._timer = self.backend.timeout_add(_seconds(self.backend.load_latency), loaded)
+
+	def load_blank(self) -> None:
+		self._cancel()
+		self.loaded = False
+
+	def recycle(self) -> None:
+		self._cancel()
+		self.loaded    = False
+		self.pages     = 0
+		self.recycled += 1
+
+
+class FakeBackend(DisplayBackend):
+	"""
+	Backend without a display, every page loads after load_latency and is
+	solved with response(url) after it was shown for solve_latency.
+	Invisible CAPTCHAs are solved after solve_latency even if they are not
+	shown, unless challenge(url) pops up a challenge.
+	"""
+
+	def __init__(self,
+	             load_latency:  Latency = 0.0,
+	             solve_latency: Latency = 0.0,
+	             response:      Callable[[str], Any] = lambda url: 'fake-token',
+	             page_memory:   Optional[int] = None,
+	             challenge:     Callable[[str], bool] = lambda url: False):
+		"""
+		:param load_latency:  seconds, or a function returning them, a page
+		                      takes to load, e.g.
+		                      functools.partial(random.expovariate, 10)
+		:param solve_latency: seconds, or a function returning them, from a
+		                      loaded page until it is solved
+		:param response:      function returning the response for a page's URL
+		:param page_memory:   bytes of memory every page loaded in a window
+		                      leaks until the window is recycled or destroyed,
+		                      memory_usage is unknown if None
+		:param challenge:     function returning whether an invisible CAPTCHA
+		                      at a URL needs a user
+		"""
+		self.load_latency  = load_latency
+		self.solve_latency = solve_latency
+		self.response      = response
+		self.page_memory   = page_memory
+		self.challenge     = challenge
+		self.windows       = [] # type: List[FakeWindow]
+		self._callbacks    = queue.SimpleQueue() # type: queue.SimpleQueue[Callable[[], Any]]
+		# [when, seq, callback], callback is None if removed
+		self._timers       = [] # type: List[List[Any]]
+		self._seq          = itertools.count()
+		self._running      = False
+
+	def run(self) -> None:
+		self._running = True
+		while self._running:
+			now = time.monotonic()
+			while self._timers and self._timers[0][0] <= now:
+				_, _, callback = heapq.heappop(self._timers)
+				if callback is not None:
+					callback()
+					if not self._running:
+						return
+			timeout = self._timers[0][0] - now if self._timers else None
+			try:
+				callback = self._callbacks.get(timeout=timeout)
+			except queue.Empty:
+				continue
+			callback()
+
+	def quit(self) -> None:
+		self._running = False
+
+	def idle_add(self, callback: Callable[[], Any]) -> None:
+		self._callbacks.put(callback)
+
+	def timeout_add(self, seconds: float, callback: Callable[[], Any]) -> List[Any]:
+		timer = [time.monotonic() + seconds, next(self._seq), callback]
+		heapq.heappush(self._timers, timer)
+		return timer
+
+	def source_remove(self, source: List[Any]) -> None:
+		source[2] = None
+
+	def memory_usage(self) -> Optional[int]:
+		if self.page_memory is None:
+			return None
+		return self.page_memory * sum(window.pages for window in self.windows if not window.destroyed)
+
+	def create_window(self,
+	                  title:            str,
+	                  on_message:       Callable[[Any], None],
+	                  on_closed:        Callable[[], None],
+	                  on_load_finished: Callable[[], None],
+	                  on_load_failed:   Callable[[str, str], None],
+	                  visible:          bool = True,
+	                  offscreen:        bool = False) -> FakeWindow:
+		window = FakeWindow(self, on_message, on_closed, on_load_finished, visible and not offscreen)
+		self.windows.append(window)
+		return window
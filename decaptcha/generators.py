@@ -0,0 +1,173 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import functools
+import os
+from typing import (
+	Dict,
+	List,
+	Mapping,
+	Optional,
+	Tuple,
+)
+
+from .request import CaptchaException, CaptchaRequest
+
+
+def read_resource(name: str) -> str:
+	with open(os.path.join(os.path.dirname(__file__), name), 'r', encoding='utf-8') as fp:
+		return fp.read()
+
+class HTMLGenerator:
+	js = ''
+	# seconds a token is accepted by the CAPTCHA provider after it was solved,
+	# None if unknown
+	token_lifetime = None # type: Optional[float]
+
+	_xml_escapes = str.maketrans({
+		'&': '&amp;',
+		'<': '&lt;',
+		'>': '&gt;',
+		'"': '&quot;',
+		"'": '&#39;',
+	})
+
+	def __init__(self):
+		self.css = read_resource('index.css')
+
+	@staticmethod
+	def escape_xml(x: str) -> str:
+		return x.translate(HTMLGenerator._xml_escapes)
+
+	@staticmethod
+	def xml_attrs(attrs: Mapping[str, str]) -> str:
+		return ' '.join('%s="%s"' % (k, HTMLGenerator.escape_xml(v)) for k, v in attrs.items())
+
+	def generate(self, req: CaptchaRequest, inline: bool = True) -> str:
+		"""
+		:param inline: inline css and js into the page, otherwise they have to
+		               be injected into the webview separately
+		"""
+		raise NotImplementedError
+
+	def resource_urls(self) -> List[str]:
+		""" :returns: the URLs every generated page loads """
+		return []
+
+	def is_invisible(self, req: CaptchaRequest) -> bool:
+		""" :returns: whether the page usually resolves without the user """
+		return False
+
+class ReCaptchaHTMLGenerator(HTMLGenerator):
+	# reCAPTCHA tokens are valid for two minutes
+	token_lifetime   = 120.0
+	#  testing site key, see https://developers.google.com/recaptcha/docs/faq#id-like-to-run-automated-tests-with-recaptcha.-what-should-i-do
+	fallback_sitekey = '6LeIxAcTAAAAAJcZVRqyHh71UMIEGNQ_MXjiZKhI'
+	api_url          = 'https://www.recaptcha.net/recaptcha/api.js'
+	html_attributes  = {
+		'class':         'g-recaptcha',
+		'data-badge':    'inline',
+		'data-callback': 'onSubmit',
+	}
+
+	def __init__(self, cache_size: int = 128):
+		"""
+		:param cache_size: number of rendered pages cached per generator
+		"""
+		super().__init__()
+		self.js         = read_resource('recaptcha.js')
+		self.htmlbase   = read_resource('recaptcha.html')
+		self._templates = {} # type: Dict[bool, Tuple[str, str]]
+		self._render    = functools.lru_cache(maxsize=cache_size)(self._render_uncached)
+
+	@property
+	def script_url(self) -> str:
+		return self.api_url + '?onload=onLoad'
+
+	def resource_urls(self) -> List[str]:
+		return [self.script_url]
+
+	def get_sitekey(self, req: CaptchaRequest) -> str:
+		try:
+			sitekey = req['options']['sitekey']
+		except KeyError:
+			return self.fallback_sitekey
+		if isinstance(sitekey, str):
+			return sitekey
+		else:
+			raise CaptchaException('options.sitekey must be a string')
+
+	def is_invisible(self, req: CaptchaRequest) -> bool:
+		try:
+			invisible = req['options']['invisible']
+		except KeyError:
+			return False
+		if isinstance(invisible, bool):
+			return invisible
+		else:
+			raise CaptchaException('options.invisible must be a boolean')
+
+	def _compile(self, inline: bool) -> Tuple[str, str]:
+		"""
+		Format everything but the CAPTCHA's attributes into htmlbase once.
+
+		:returns: the page's parts before and after the attributes
+		"""
+		try:
+			return self._templates[inline]
+		except KeyError:
+			pass
+		marker = '\0attrs\0'
+		head, tail = self.htmlbase.format(
+			css  =self.css if inline else '',
+			js   =self.js  if inline else '',
+			api  =self.script_url,
+			attrs=marker,
+		).split(marker)
+		self._templates[inline] = (head, tail)
+		return head, tail
+
+	def _render_uncached(self, sitekey: str, invisible: bool, inline: bool) -> str:
+		options = {}
+		options.update(self.html_attributes)
+		options['data-sitekey'] = sitekey
+		if invisible:
+			options['data-size'] = 'invisible'
+		head, tail = self._compile(inline)
+		return head + self.xml_attrs(options) + tail
+
+	def generate(self, req: CaptchaRequest, inline: bool = True) -> str:
+		return self._render(self.get_sitekey(req), self.is_invisible(req), inline)
+
+class HCaptchaHTMLGenerator(ReCaptchaHTMLGenerator):
+	# so are hCaptcha tokens
+	token_lifetime  = 120.0
+	api_url         = 'https://hcaptcha.com/1/api.js'
+	html_attributes = {
+		'class':         'h-captcha',
+		'data-callback': 'onSubmit',
+	}
+
+	def __init__(self, cache_size: int = 128):
+		super().__init__(cache_size)
+		self.js = self.js.replace('grecaptcha', 'hcaptcha')
+
+	@property
+	def fallback_sitekey(self):
+		""" hackishly require options.sitekey """
+		raise CaptchaException('options.sitekey is missing') from None
@@ -0,0 +1,1216 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import collections
+import email.utils
+import functools
+import itertools
+import json
+import logging
+import os
+import time
+import urllib.parse
+from typing import (
+	Any,
+	Awaitable,
+	Callable,
+	cast,
+	Dict,
+	Final,
+	List,
+	Mapping,
+	Optional,
+	Sequence,
+	Set,
+	Tuple,
+)
+
+from .backend import DisplayBackend, Window
+from .generators import HTMLGenerator
+from .metrics import format_gauge, format_histograms, format_labelled, Histogram
+from .request import (
+	CaptchaException,
+	CaptchaRequest,
+	CaptchaSuccess,
+	get_deadline,
+	get_priority,
+	RequestTuple,
+)
+from .scheduler import QueueEntry, RequestQueue
+
+# GObject introspection is slow to import and requires GTK and WebKit to be
+# installed, it is only loaded by load_gui, when DeCaptcha.run is called first
+glib   = None # type: Any
+gtk    = None # type: Any
+webkit = None # type: Any
+
+def random_user_agent() -> Optional[str]:
+	return None
+
+def load_gui() -> None:
+	"""
+	Import glib, GTK, WebKit, and youtube-dl.utils.random_user_agent if
+	available.
+	"""
+	global glib, gtk, webkit, random_user_agent
+	if glib is not None:
+		return
+
+	import gi # type: ignore
+	gi.require_version('GLib',    '2.0')
+	gi.require_version('Gtk',     '3.0')
+	gi.require_version('WebKit2', '4.0')
+	from gi.repository import GLib    # type: ignore
+	from gi.repository import Gtk     # type: ignore
+	from gi.repository import WebKit2 # type: ignore
+	glib, gtk, webkit = GLib, Gtk, WebKit2
+
+	try:
+		from youtube_dl.utils import random_user_agent as ua # type: ignore
+	except ImportError:
+		pass
+	else:
+		random_user_agent = ua
+
+
+def _children(pid: int) -> List[int]:
+	"""
+	:raises OSError: if the process exited or the kernel does not list
+	                 children in /proc
+	"""
+	children = [] # type: List[int]
+	for tid in os.listdir('/proc/%d/task' % pid):
+		with open('/proc/%d/task/%s/children' % (pid, tid)) as f:
+			children.extend(map(int, f.read().split()))
+	return children
+
+def web_process_memory() -> Optional[int]:
+	"""
+	:returns: bytes of resident memory of this process' WebKit web processes,
+	          None if /proc does not tell
+	"""
+	try:
+		pids = _children(os.getpid())
+	except OSError:
+		return None
+	page_size = os.sysconf('SC_PAGE_SIZE')
+	total = 0
+	while pids:
+		pid = pids.pop()
+		try:
+			pids.extend(_children(pid))
+			# comm is truncated to 15 characters
+			with open('/proc/%d/comm' % pid) as f:
+				if not f.read().startswith('WebKitWebProces'):
+					continue
+			with open('/proc/%d/statm' % pid) as f:
+				total += int(f.read().split()[1]) * page_size
+		except OSError:
+			pass # exited meanwhile
+	return total
+
+
+class WebKitWindow(Window):
+	"""
+	A GTK window with a WebKit webview.
+	"""
+
+	def __init__(self,
+	             backend:          'WebKitBackend',
+	             title:            str,
+	             on_message:       Callable[[Any], None],
+	             on_closed:        Callable[[], None],
+	             on_load_finished: Callable[[], None],
+	             on_load_failed:   Callable[[str, str], None],
+	             visible:          bool = True,
+	             offscreen:        bool = False):
+		"""
+		Create GTK window with a WebKit webview, add the necessary signal
+		handlers, and set the User-Agent with youtube-dl.utils.random_user_agent
+		if available.
+		"""
+		self.backend          = backend
+		self.on_message       = on_message
+		self.on_closed        = on_closed
+		self.on_load_finished = on_load_finished
+		self.on_load_failed   = on_load_failed
+		self.offscreen        = offscreen
+
+		# an offscreen window is mapped, so its pages are neither throttled
+		# nor suspended like those of a hidden window
+		self.window = gtk.OffscreenWindow() if offscreen else gtk.Window(title=title)
+		self.window.resize(1280, 720)
+		self.window.set_position(gtk.WindowPosition.CENTER)
+		self.window.set_accept_focus(False)
+		self.window.connect('delete-event', self._on_window_closed)
+
+		self.scroll = gtk.ScrolledWindow()
+		self.window.add(self.scroll)
+
+		# load_html's pages, not about:blank
+		self._loading_page = False
+		self._resources    = None # type: Optional[Tuple[str, str]]
+		self._create_webview()
+
+		if visible or offscreen:
+			self.window.show_all()
+		else:
+			# realized, so pages load and render while the window is hidden
+			self.scroll.show_all()
+			self.window.realize()
+
+	def _create_webview(self) -> None:
+		self.webview = webkit.WebView(web_context=self.backend.web_context())
+		self.webview.connect('load-changed', self._on_load_changed)
+		self.webview.connect('load-failed', self._on_load_failed)
+		self.webview.connect('resource-load-started', self._on_resource_load_started)
+
+		props = self.webview.get_settings().props
+		props.enable_developer_extras = True
+		ua = random_user_agent()
+		if ua:
+			props.user_agent = ua
+
+		content_manager = self.webview.get_user_content_manager()
+		content_manager.connect('script-message-received::decaptcha', self._on_script_message)
+		content_manager.register_script_message_handler('decaptcha')
+
+		self.scroll.add(self.webview)
+
+	def _on_load_changed(self, webview, load_event) -> None:
+		if load_event == webkit.LoadEvent.FINISHED and self._loading_page and webview is self.webview:
+			self._loading_page = False
+			self.on_load_finished()
+
+	def _on_load_failed(self, webview, load_event, failing_uri, error) -> bool:
+		self.on_load_failed(failing_uri, str(error))
+		return False
+
+	def _on_resource_load_started(self, webview, resource, request) -> None:
+		if request.get_uri() in self.backend.warm_urls:
+			resource.connect('finished', self.backend._on_warm_resource_loaded, time.monotonic(), time.time())
+
+	def _on_script_message(self, content_manager, message: 'webkit.JavascriptResult') -> None:
+		try:
+			response = json.loads(message.get_js_value().to_json(0))
+		except:
+			DeCaptcha.logger.exception('cannot parse javascript message: %r', message)
+			return
+		self.on_message(response)
+
+	def _on_window_closed(self, widget, event) -> None:
+		self.on_closed()
+
+	def show(self) -> None:
+		if not self.offscreen:
+			self.window.show_all()
+
+	def hide(self) -> None:
+		if not self.offscreen:
+			self.window.hide()
+
+	def destroy(self) -> None:
+		self.window.destroy()
+
+	def set_resources(self, css: str, js: str) -> None:
+		"""
+		Inject css and js into every page loaded in the webview, so they need
+		not be inlined into every page.
+		"""
+		self._resources = (css, js)
+		content_manager = self.webview.get_user_content_manager()
+		content_manager.remove_all_style_sheets()
+		content_manager.remove_all_scripts()
+		content_manager.add_style_sheet(webkit.UserStyleSheet(
+			css,
+			webkit.UserContentInjectedFrames.TOP_FRAME,
+			webkit.UserStyleLevel.USER,
+			None,
+			None,
+		))
+		content_manager.add_script(webkit.UserScript(
+			js,
+			webkit.UserContentInjectedFrames.TOP_FRAME,
+			webkit.UserScriptInjectionTime.START,
+			None,
+			None,
+		))
+
+	def load_html(self, html: str, base_uri: str) -> None:
+		self._loading_page = True
+		self.webview.load_html(html, base_uri)
+
+	def load_blank(self) -> None:
+		self._loading_page = False
+		self.webview.load_uri('about:blank')
+
+	def recycle(self) -> None:
+		"""
+		Destroy the webview, WebKit terminates its web process once no other
+		webview uses it.
+		"""
+		self._loading_page = False
+		webview = self.webview
+		self.scroll.remove(webview)
+		webview.destroy()
+		self._create_webview()
+		if self._resources is not None:
+			self.set_resources(*self._resources)
+		self.webview.show()
+
+
+class WebKitBackend(DisplayBackend):
+	"""
+	GTK main loop and WebKit windows.
+
+	All windows share one WebContext, and thus HTTP cache and connections.
+	"""
+
+	def __init__(self,
+	             cache_dir: Optional[str] = None,
+	             data_dir:  Optional[str] = None):
+		"""
+		:param cache_dir: directory of the HTTP disk cache, kept across
+		                  restarts, WebKit's default if None
+		:param data_dir:  directory of cookies and local storage, WebKit's
+		                  default if None
+		"""
+		self.cache_dir = cache_dir
+		self.data_dir  = data_dir
+		# the URLs warmed up, their loads are measured
+		self.warm_urls = set() # type: Set[str]
+		self.counters  = collections.Counter() # type: Final[collections.Counter[str]]
+		self.load_time = Histogram()
+		self._context  = None # type: Any
+		self._warm_up  = None # type: Any
+
+	@classmethod
+	def in_directory(cls, directory: Optional[str]) -> 'WebKitBackend':
+		"""
+		:param directory: directory the HTTP cache (cache/) and the website
+		                  data (data/) are kept in across restarts, WebKit's
+		                  defaults if None
+		"""
+		if directory is None:
+			return cls()
+		return cls(cache_dir=os.path.join(directory, 'cache'),
+		           data_dir=os.path.join(directory, 'data'))
+
+	def load(self) -> None:
+		load_gui()
+
+	def web_context(self) -> 'webkit.WebContext':
+		if self._context is None:
+			if self.cache_dir is None and self.data_dir is None:
+				context = webkit.WebContext.get_default()
+			else:
+				manager = webkit.WebsiteDataManager(base_cache_directory=self.cache_dir,
+				                                    base_data_directory=self.data_dir)
+				context = webkit.WebContext.new_with_website_data_manager(manager)
+			context.set_cache_model(webkit.CacheModel.WEB_BROWSER)
+			self._context = context
+		return self._context
+
+	def warm_up(self, urls: Sequence[str]) -> None:
+		"""
+		Prefetch the DNS of the urls' hosts and load them in a hidden webview,
+		which opens connections to the hosts and fills the disk cache.
+		"""
+		urls = [url for url in urls if url not in self.warm_urls]
+		if not urls:
+			return
+		context = self.web_context()
+		for url in urls:
+			self.warm_urls.add(url)
+			context.prefetch_dns(urllib.parse.urlsplit(url).hostname)
+		if self._warm_up is not None:
+			self._warm_up.destroy()
+		self._warm_up = webkit.WebView(web_context=context)
+		self._warm_up.connect('load-changed', self._on_warm_up_loaded)
+		self._warm_up.load_html(''.join('<script async src="%s"></script>' % HTMLGenerator.escape_xml(url)
+		                                for url in urls), urls[0])
+
+	def _on_warm_up_loaded(self, webview, load_event) -> None:
+		if load_event == webkit.LoadEvent.FINISHED and webview is self._warm_up:
+			self._warm_up = None
+			webview.destroy()
+
+	def _on_warm_resource_loaded(self, resource, started: float, requested: float) -> None:
+		"""
+		Count a load of a warmed up URL as cached if the response's Date
+		header is older than the request, WebKit tells no better.
+		"""
+		self.load_time.observe(time.monotonic() - started)
+		response = resource.get_response()
+		headers = response.get_http_headers() if response is not None else None
+		date = headers.get_one('Date') if headers is not None else None
+		try:
+			cached = date is not None and email.utils.parsedate_to_datetime(date).timestamp() < requested - 2
+		except (TypeError, ValueError):
+			cached = False
+		self.counters['cached' if cached else 'network'] += 1
+
+	def collect_metrics(self) -> str:
+		return ''.join([
+			format_labelled('decaptcha_webkit_script_loads_total', 'counter',
+			                'loads of the scripts every page loads, by source', 'source', self.counters),
+			self.load_time.format('decaptcha_webkit_script_load_seconds',
+			                      'seconds the scripts every page loads took to load'),
+		])
+
+	def memory_usage(self) -> Optional[int]:
+		return web_process_memory()
+
+	def run(self) -> None:
+		gtk.main()
+
+	def quit(self) -> None:
+		gtk.main_quit()
+
+	def idle_add(self, callback: Callable[[], Any]) -> None:
+		def once() -> bool:
+			callback()
+			return False # remove idle source
+		glib.idle_add(once)
+
+	def timeout_add(self, seconds: float, callback: Callable[[], Any]) -> int:
+		def once() -> bool:
+			callback()
+			return False # remove timeout source
+		return glib.timeout_add(int(seconds * 1000), once)
+
+	def source_remove(self, source: int) -> None:
+		glib.source_remove(source)
+
+	def create_window(self,
+	                  title:            str,
+	                  on_message:       Callable[[Any], None],
+	                  on_closed:        Callable[[], None],
+	                  on_load_finished: Callable[[], None],
+	                  on_load_failed:   Callable[[str, str], None],
+	                  visible:          bool = True,
+	                  offscreen:        bool = False) -> WebKitWindow:
+		return WebKitWindow(self, title, on_message, on_closed, on_load_finished, on_load_failed,
+		                    visible, offscreen)
+
+
+def _set_result(fut: asyncio.Future, result: Any) -> None:
+	if not fut.done():
+		fut.set_result(result)
+
+def _set_exception(fut: asyncio.Future, exception: BaseException) -> None:
+	if not fut.done():
+		fut.set_exception(exception)
+
+
+class CaptchaView:
+	"""
+	A window of the display backend and the CAPTCHA request currently
+	displayed in it.
+	"""
+
+	def __init__(self, index: int, offscreen: bool = False):
+		self.index           = index     # type: Final[int]
+		# runs invisible CAPTCHAs in an offscreen window
+		self.offscreen       = offscreen # type: Final[bool]
+		self.window          = None  # type: Optional[Window]
+		self.current_request = None  # type: Optional[RequestTuple]
+		self.idle_timer      = None  # type: Any
+		self.generator       = None  # type: Optional[HTMLGenerator]
+		# time.monotonic() the current CAPTCHA's page was requested and loaded
+		self.load_started    = None  # type: Optional[float]
+		self.load_finished   = None  # type: Optional[float]
+		# pages loaded since the window was created or recycled
+		self.loads           = 0
+		# seconds since the current page started loading by the performance
+		# marks it posted
+		self.marks           = {}    # type: Dict[str, float]
+		# the queued request whose page is loaded ahead of time in the hidden
+		# window, and the timer invalidating it
+		self.preloaded       = None  # type: Optional[QueueEntry[RequestTuple]]
+		self.preload_timer   = None  # type: Any
+		# the offscreen view's current queue entry, to queue it for the
+		# interactive views, and the timer doing so
+		self.entry           = None  # type: Optional[QueueEntry[RequestTuple]]
+		self.escalate_timer  = None  # type: Any
+
+	def __repr__(self) -> str:
+		return '<CaptchaView %s#%d>' % ('offscreen ' if self.offscreen else '', self.index)
+
+
+class DeCaptcha:
+	"""
+	.. |CAPTCHA loop| image:: ../captcha-display-loop.svg
+	"""
+
+	logger = logging.getLogger('DeCaptcha')
+
+	memory_buckets = tuple(2**20 * mb for mb in (64, 128, 256, 512, 1024, 2048, 4096, 8192))
+
+	# the performance marks pages post, in the order they are reached
+	stages       = ('api', 'onload', 'challenge', 'submit')
+	# sitekeys the stages are measured by, the others are measured as 'other'
+	max_sitekeys = 100
+
+	def __init__(self,
+	             html_generator:    HTMLGenerator,
+	             windows:           int   = 1,
+	             idle_timeout:      float = 30.0,
+	             backend:           Optional[DisplayBackend] = None,
+	             preload_timeout:   float = 60.0,
+	             max_loads:         Optional[int] = None,
+	             max_memory:        Optional[int] = None,
+	             offscreen:         int   = 2,
+	             offscreen_timeout: float = 30.0):
+		"""
+		:param html_generator:    generator for the pages displaying the CAPTCHAs
+		:param windows:           number of WebKit windows CAPTCHAs are displayed
+		                          in concurrently
+		:param idle_timeout:      seconds an idle WebKit window is kept hidden
+		                          for reuse before it is destroyed, 0 destroys it
+		                          immediately
+		:param backend:           main loop and windows, a WebKitBackend if None
+		:param preload_timeout:   seconds the next queued CAPTCHA is kept loaded
+		                          in a hidden window before it is reloaded, so
+		                          the widget does not expire before it is shown,
+		                          0 disables preloading
+		:param max_loads:         pages a window's webview loads before it is
+		                          replaced by a new one, with a new web process
+		:param max_memory:        bytes of resident memory per web process,
+		                          on average, above which the webview of the
+		                          window that loaded the most pages is replaced
+		                          before its next CAPTCHA is loaded
+		:param offscreen:         number of offscreen windows invisible CAPTCHAs
+		                          are run in concurrently, without waiting for
+		                          the interactive windows, 0 displays them in the
+		                          interactive windows
+		:param offscreen_timeout: seconds an invisible CAPTCHA may take
+		                          offscreen before it is queued for the
+		                          interactive windows, like one that pops up a
+		                          challenge
+		"""
+		if windows < 1:
+			raise ValueError('at least one window is required')
+		self.html_generator    = html_generator # type: Final[HTMLGenerator]
+		self.backend           = backend or WebKitBackend() # type: Final[DisplayBackend]
+		self.idle_timeout      = idle_timeout
+		self.preload_timeout   = preload_timeout
+		self.max_loads         = max_loads
+		self.max_memory        = max_memory
+		self.offscreen_timeout = offscreen_timeout
+		self.counters          = collections.Counter() # type: Final[collections.Counter[str]]
+		# seconds spent queued, loading the page, and waiting for the user
+		self.histograms        = {
+			'queue':          Histogram(),
+			'page_load':      Histogram(),
+			'solve':          Histogram(),
+			# bytes of the web processes sampled before recycling a webview
+			'recycle_memory': Histogram(self.memory_buckets),
+		} # type: Final[Dict[str, Histogram]]
+		# seconds of the pages' stages by stage and sitekey
+		self.stage_histograms  = {} # type: Final[Dict[Tuple[str, ...], Histogram]]
+		self._sitekeys         = set() # type: Set[str]
+		self._async_loop       = None # type: Optional[asyncio.AbstractEventLoop]
+		self._views            = [CaptchaView(i) for i in range(windows)] # type: Final[List[CaptchaView]]
+		# hidden view the next queued CAPTCHA is loaded in while all views are
+		# busy, it takes the place of the view that resolves its CAPTCHA first
+		self._spare            = CaptchaView(windows) if preload_timeout > 0 else None
+		self._seq              = itertools.count()
+		self._requests         = RequestQueue(self._seq) # type: RequestQueue[RequestTuple]
+		# views running invisible CAPTCHAs, their queue, and the entries of
+		# _requests escalated from it, which keep their place as both queues
+		# share the insertion counter
+		self._offscreen        = [CaptchaView(windows + 1 + i, offscreen=True)
+		                          for i in range(offscreen)] # type: Final[List[CaptchaView]]
+		self._invisible        = RequestQueue(self._seq) # type: RequestQueue[RequestTuple]
+		self._escalated        = set() # type: Set[QueueEntry[RequestTuple]]
+
+	def _create_window(self, view: CaptchaView, visible: bool = True):
+		"""
+		Create the view's window with the necessary callbacks.
+		"""
+		self.logger.debug('create new WebKit window for %r', view)
+		self.counters['windows_created'] += 1
+		if len(self._views) == 1 and self._spare is None:
+			title = 'webkitgtk'
+		else:
+			title = 'webkitgtk #%d' % (view.index + 1)
+		view.window = self.backend.create_window(
+			title,
+			functools.partial(self._on_script_message, view),
+			functools.partial(self._on_window_closed, view),
+			functools.partial(self._on_load_finished, view),
+			functools.partial(self._on_load_failed, view),
+			visible and not view.offscreen,
+			offscreen=view.offscreen,
+		)
+		view.loads = 0
+		self._inject_resources(view)
+
+	def _inject_resources(self, view: CaptchaView):
+		"""
+		Inject the HTML generator's css and js into every page loaded in the
+		view's window, so they need not be inlined into every page.
+		"""
+		generator = self.html_generator
+		cast(Window, view.window).set_resources(generator.css, generator.js)
+		view.generator = generator
+
+	def _all_views(self) -> List[CaptchaView]:
+		""" :returns: the views, the spare view, and the offscreen views """
+		return self._views + ([self._spare] if self._spare is not None else []) + self._offscreen
+
+	def _on_load_finished(self, view: CaptchaView) -> None:
+		if (view.current_request is not None or view.preloaded is not None) \
+				and view.load_started is not None and view.load_finished is None:
+			view.load_finished = time.monotonic()
+			# a preloaded page's load is observed when it is shown
+			if view.current_request is not None:
+				self.histograms['page_load'].observe(view.load_finished - view.load_started)
+
+	def _on_load_failed(self, view: CaptchaView, failing_uri: str, error: str) -> None:
+		self.logger.error('loading %s in %r failed: %s', failing_uri, view, error)
+		self.counters['load_failed'] += 1
+
+	def _on_script_message(self, view: CaptchaView, message: Any) -> None:
+		"""
+		Resolve the view's current CAPTCHA with the response sent from inside
+		its window, or escalate its invisible CAPTCHA that popped up a
+		challenge.
+
+		Process next queued CAPTCHA.
+		"""
+		kind = message.get('type') if isinstance(message, dict) else None
+		if kind == 'timing':
+			self._on_timing(view, message)
+			return
+		if kind == 'challenge':
+			if view.offscreen:
+				self._escalate(view, 'challenge')
+			return
+		if kind != 'response':
+			self.logger.warning('unknown message from %r: %r', view, message)
+			return
+		response = message.get('response')
+		if view.preloaded is not None:
+			# e.g. an invisible CAPTCHA solved while it was preloaded
+			self._resolve_preloaded(view, response)
+		elif view.current_request is None:
+			self.logger.warning('CAPTCHA response received, but no request currently processed in %r', view)
+		else:
+			if view.load_finished is not None:
+				self.histograms['solve'].observe(time.monotonic() - view.load_finished)
+			self.counters['solved'] += 1
+			if view.offscreen:
+				self.counters['solved_offscreen'] += 1
+			view.current_request.set_result(self._success(view, view.current_request.request, response))
+			view.current_request = None
+			view.entry           = None
+			self._cancel_escalate_timer(view)
+		self._try_show_captcha()
+
+	def _on_timing(self, view: CaptchaView, message: Dict[str, Any]) -> None:
+		mark = message.get('mark')
+		ms   = message.get('time')
+		if mark not in self.stages or not isinstance(ms, (int, float)) or isinstance(ms, bool):
+			self.logger.warning('invalid timing message from %r: %r', view, message)
+			return
+		view.marks[mark] = ms / 1000
+
+	@classmethod
+	def stage_timings(cls, marks: Mapping[str, float]) -> Dict[str, float]:
+		"""
+		:param marks: seconds since the page started loading by performance
+		              mark
+		:returns:     seconds of every stage the page went through, named
+		              after the mark ending it
+		"""
+		timings  = {} # type: Dict[str, float]
+		previous = 0.0
+		for stage in cls.stages:
+			if stage in marks:
+				timings[stage] = max(0.0, marks[stage] - previous)
+				previous = marks[stage]
+		return timings
+
+	def _success(self, view: CaptchaView, request: CaptchaRequest, response: Any) -> CaptchaSuccess:
+		"""
+		:returns: the result of the view's CAPTCHA with the time it was solved
+		          at, when its token expires and the timings of its page's
+		          stages, which are measured by sitekey
+		"""
+		result = {'response': response, 'solvedAt': time.time()} # type: CaptchaSuccess
+		lifetime = self.html_generator.token_lifetime
+		if lifetime is not None:
+			result['expiresAt'] = result['solvedAt'] + lifetime
+		timings = self.stage_timings(view.marks)
+		if not timings:
+			return result
+		result['timings'] = timings
+		self.logger.info('request %r solved in %r, stages: %r', request, view, timings)
+		sitekey = request.get('options', {}).get('sitekey')
+		if not isinstance(sitekey, str):
+			sitekey = ''
+		if sitekey not in self._sitekeys:
+			if len(self._sitekeys) < self.max_sitekeys:
+				self._sitekeys.add(sitekey)
+			else:
+				sitekey = 'other'
+		for stage, seconds in timings.items():
+			try:
+				histogram = self.stage_histograms[stage, sitekey]
+			except KeyError:
+				histogram = self.stage_histograms[stage, sitekey] = Histogram()
+			histogram.observe(seconds)
+		return result
+
+	def _on_window_closed(self, view: CaptchaView):
+		"""
+		Cancel the view's current CAPTCHA if possible.
+
+		Process next queued CAPTCHA.
+		"""
+		self.logger.debug('Webkit window of %r closed', view)
+		self.counters['windows_closed'] += 1
+		if view.current_request:
+			view.current_request.set_exception(CaptchaException('WebKit window closed by user'))
+			view.current_request = None
+			view.entry           = None
+		self._cancel_idle_timer(view)
+		self._cancel_preload(view)
+		self._cancel_escalate_timer(view)
+		view.window = None
+		self._try_show_captcha()
+
+	def _close(self, view: CaptchaView):
+		"""
+		Close the view's WebKit window without calling _on_window_closed and
+		subsequentially cancelling its current CAPTCHA.
+		"""
+		self._cancel_idle_timer(view)
+		self._cancel_preload(view)
+		self._cancel_escalate_timer(view)
+		if view.window is not None:
+			view.window.destroy()
+		view.window = None
+
+	def _cancel_idle_timer(self, view: CaptchaView):
+		if view.idle_timer is not None:
+			self.backend.source_remove(view.idle_timer)
+			view.idle_timer = None
+
+	def _cancel_preload(self, view: CaptchaView):
+		if view.preload_timer is not None:
+			self.backend.source_remove(view.preload_timer)
+			view.preload_timer = None
+		view.preloaded = None
+
+	def _cancel_escalate_timer(self, view: CaptchaView):
+		if view.escalate_timer is not None:
+			self.backend.source_remove(view.escalate_timer)
+			view.escalate_timer = None
+
+	def _release(self, view: CaptchaView):
+		"""
+		Hide the view's WebKit window and blank its webview, the window is
+		destroyed by _on_idle_timeout if it is not reused within idle_timeout.
+		"""
+		if self.idle_timeout <= 0:
+			self.logger.debug('no more requests queued, close WebKit window of %r', view)
+			self._close(view)
+			return
+		self.logger.debug('no more requests queued, hide WebKit window of %r', view)
+		window = cast(Window, view.window)
+		window.hide()
+		window.load_blank()
+		view.idle_timer = self.backend.timeout_add(self.idle_timeout, functools.partial(self._on_idle_timeout, view))
+
+	def _on_idle_timeout(self, view: CaptchaView) -> None:
+		"""
+		Close the view's hidden WebKit window after it was idle for
+		idle_timeout.
+		"""
+		view.idle_timer = None
+		if view.current_request is None and view.window:
+			self.logger.debug('WebKit window of %r idle for %ss, close it', view, self.idle_timeout)
+			self._close(view)
+
+	def _show_current_captcha(self, view: CaptchaView):
+		"""
+		Display the view's current CAPTCHA. If its WebKit window is closed,
+		open a new one.
+		"""
+		request = cast(RequestTuple, view.current_request).request
+		self.logger.info('processing request %r in %r', request, view)
+		html = self.html_generator.generate(request, inline=False)
+		if not view.window:
+			self._create_window(view)
+		elif view.idle_timer is not None:
+			self.logger.debug('reuse hidden WebKit window of %r', view)
+			self.counters['windows_reused'] += 1
+			self._cancel_idle_timer(view)
+			if not view.offscreen:
+				view.window.show()
+		if view.generator is not self.html_generator:
+			self._inject_resources(view)
+		self._recycle_if_worn(view)
+		view.loads        += 1
+		view.marks         = {}
+		view.load_started  = time.monotonic()
+		view.load_finished = None
+		cast(Window, view.window).load_html(html, request['url'])
+		if view.offscreen:
+			self._cancel_escalate_timer(view)
+			view.escalate_timer = self.backend.timeout_add(self.offscreen_timeout,
+			                                               functools.partial(self._on_offscreen_timeout, view))
+
+	def _recycle_if_worn(self, view: CaptchaView) -> None:
+		"""
+		Replace the view's webview, and thus its web process, if it loaded
+		max_loads pages, or if the web processes use more than max_memory
+		each on average and no other view loaded more pages since it was
+		recycled. Only called between two requests of the view.
+		"""
+		if view.loads == 0:
+			return # a new webview
+		if self.max_loads is not None and view.loads >= self.max_loads:
+			reason = 'loads'
+			memory = self.backend.memory_usage()
+		elif self.max_memory is not None:
+			memory = self.backend.memory_usage()
+			# only the sum over all web processes is known, so the most worn
+			# view is recycled, not the one that happens to load next
+			live = [v for v in self._all_views() if v.window is not None]
+			if memory is None or memory <= self.max_memory * len(live) or \
+			   view.loads < max(v.loads for v in live):
+				return
+			reason = 'memory'
+		else:
+			return
+		self.logger.info('recycle webview of %r after %d loads, web processes use %s bytes',
+		                 view, view.loads, memory)
+		self.counters['recycled_' + reason] += 1
+		if memory is not None:
+			self.histograms['recycle_memory'].observe(memory)
+		cast(Window, view.window).recycle()
+		view.loads = 0
+
+	def _try_show_current_captcha(self):
+		"""
+		Display the current CAPTCHAs of all views, and start the CAPTCHA loop
+		for the views without one.
+		"""
+		for view in self._views + self._offscreen:
+			if view.current_request is not None:
+				self._show_current_captcha(view)
+		self._try_show_captcha()
+
+	def _try_show_captcha(self):
+		"""
+		For every view: if a CAPTCHA is currently being processed do nothing.
+
+		If no more CAPTCHAs are queued close its WebKit window.
+
+		Otherwise start processing a new CAPTCHA in it.
+		"""
+		for index in range(len(self._views)):
+			while self._views[index].current_request is None:
+				entry = self._pop(self._requests)
+				if entry is None:
+					break
+				self._escalated.discard(entry)
+				view = self._views[index]
+				if self._spare is not None and entry is self._spare.preloaded:
+					self._show_preloaded(index)
+					continue
+				view.current_request = entry.item
+				try:
+					self._show_current_captcha(view)
+				except Exception as e:
+					self.logger.exception('error displaying the CAPTCHA')
+					view.current_request.set_exception(e)
+					view.current_request = None
+					self.logger.info('skipping current request')
+			view = self._views[index]
+			if view.current_request is not None:
+				self.logger.debug('request processing loop of %r already running', view)
+			elif view.window and view.idle_timer is None:
+				self._release(view)
+		self._run_offscreen()
+		self._preload()
+
+	def _pop(self, queue: RequestQueue[RequestTuple]) -> Optional[QueueEntry[RequestTuple]]:
+		"""
+		Pop the next request, dropping those whose deadline has passed.
+
+		:returns: None if the queue is empty
+		"""
+		while queue:
+			entry = queue.pop()
+			if entry.expired(time.time()):
+				self.logger.info('dropping request %r, its deadline has passed', entry.item.request)
+				entry.item.set_exception(CaptchaException('deadline passed before the CAPTCHA was displayed'))
+				self.counters['expired'] += 1
+				continue
+			self.histograms['queue'].observe(time.monotonic() - entry.enqueued)
+			return entry
+		return None
+
+	def _run_offscreen(self):
+		"""
+		Run queued invisible CAPTCHAs in the offscreen views without one.
+		"""
+		for view in self._offscreen:
+			while view.current_request is None:
+				entry = self._pop(self._invisible)
+				if entry is None:
+					break
+				view.current_request = entry.item
+				view.entry           = entry
+				try:
+					self._show_current_captcha(view)
+				except Exception as e:
+					self.logger.exception('error running the invisible CAPTCHA')
+					view.current_request.set_exception(e)
+					view.current_request = None
+					view.entry           = None
+			if view.current_request is None and view.window and view.idle_timer is None:
+				self._release(view)
+
+	def _on_offscreen_timeout(self, view: CaptchaView) -> None:
+		view.escalate_timer = None
+		self._escalate(view, 'timeout')
+
+	def _escalate(self, view: CaptchaView, reason: str) -> None:
+		"""
+		Queue the offscreen view's invisible CAPTCHA for the interactive
+		views, in its original place, it needs a user.
+		"""
+		entry = view.entry
+		if entry is None or view.current_request is not entry.item:
+			return
+		self.logger.info('escalating invisible request %r in %r to the interactive windows: %s',
+		                 entry.item.request, view, reason)
+		self.counters['escalated_' + reason] += 1
+		self._cancel_escalate_timer(view)
+		view.current_request = None
+		view.entry           = None
+		self._escalated.add(entry)
+		self._requests.requeue(entry)
+		self._try_show_captcha()
+
+	def _show_preloaded(self, index: int):
+		"""
+		Swap the spare view, whose preloaded CAPTCHA was just popped, with the
+		idle view at index. The idle view becomes the spare.
+		"""
+		spare = cast(CaptchaView, self._spare)
+		view  = self._views[index]
+		entry = cast(QueueEntry[RequestTuple], spare.preloaded)
+		self.logger.info('processing preloaded request %r in %r', entry.item.request, spare)
+		self.counters['preloads_shown'] += 1
+		self._cancel_preload(spare)
+		spare.current_request = entry.item
+		self._views[index], self._spare = spare, view
+		# the page load the user waits for is what remains of it
+		now = time.monotonic()
+		if spare.load_finished is not None:
+			spare.load_finished = now
+			self.histograms['page_load'].observe(0.0)
+		spare.load_started = now
+		cast(Window, spare.window).show()
+		if view.window:
+			self._cancel_idle_timer(view)
+			view.window.hide()
+
+	def _preload(self):
+		"""
+		While all views are busy, load the next queued CAPTCHA in the hidden
+		window of the spare view, so it is displayed as soon as a view is free.
+
+		A preloaded CAPTCHA that is no longer next in the queue is replaced,
+		one that was not displayed within preload_timeout is reloaded.
+		"""
+		spare = self._spare
+		if spare is None:
+			return
+		entry = self._requests.peek() if self._requests else None
+		if entry is not None and entry is spare.preloaded:
+			return
+		if spare.preloaded is not None:
+			self.logger.debug('discarding preloaded request %r in %r, it is no longer next',
+			                  spare.preloaded.item.request, spare)
+			self.counters['preloads_discarded'] += 1
+			self._cancel_preload(spare)
+		html = None
+		if entry is not None:
+			try:
+				html = self.html_generator.generate(entry.item.request, inline=False)
+			except Exception:
+				# it fails again and is skipped when it is displayed
+				self.logger.exception('error preloading the CAPTCHA')
+		if entry is None or html is None:
+			if spare.window and spare.idle_timer is None:
+				self._release(spare)
+			return
+
+		self.logger.debug('preloading request %r in %r', entry.item.request, spare)
+		self.counters['preloads_started'] += 1
+		if not spare.window:
+			self._create_window(spare, visible=False)
+		else:
+			self._cancel_idle_timer(spare)
+		if spare.generator is not self.html_generator:
+			self._inject_resources(spare)
+		self._recycle_if_worn(spare)
+		spare.loads        += 1
+		spare.marks         = {}
+		spare.preloaded     = entry
+		spare.load_started  = time.monotonic()
+		spare.load_finished = None
+		cast(Window, spare.window).load_html(html, entry.item.request['url'])
+		spare.preload_timer = self.backend.timeout_add(self.preload_timeout,
+		                                               functools.partial(self._on_preload_timeout, spare))
+
+	def _on_preload_timeout(self, view: CaptchaView) -> None:
+		"""
+		Reload the view's preloaded CAPTCHA, it was not displayed within
+		preload_timeout and may have expired.
+		"""
+		view.preload_timer = None
+		if view is not self._spare or view.preloaded is None:
+			return
+		self.logger.debug('preloaded request %r in %r not displayed for %ss, reload it',
+		                  view.preloaded.item.request, view, self.preload_timeout)
+		self.counters['preloads_expired'] += 1
+		view.preloaded = None
+		self._preload()
+
+	def _resolve_preloaded(self, view: CaptchaView, response: Any) -> None:
+		"""
+		Resolve the view's preloaded CAPTCHA, which was solved before it was
+		displayed, with the message sent from inside its window.
+		"""
+		entry = cast(QueueEntry[RequestTuple], view.preloaded)
+		self._cancel_preload(view)
+		if not self._requests.remove(entry):
+			return
+		self.logger.debug('preloaded request %r in %r solved before it was displayed', entry.item.request, view)
+		self.histograms['queue'].observe(time.monotonic() - entry.enqueued)
+		self.counters['solved'] += 1
+		self.counters['preloads_solved'] += 1
+		entry.item.set_result(self._success(view, entry.item.request, response))
+
+	def run(self, loop=None, executor=None) -> Awaitable[None]:
+		"""
+		Safe to call from another thread.
+
+		Start the GUI loop and start displaying CAPTCHAs.
+
+		:param loop:     event loop to use, syncio.get_running_loop() if None
+		:param executor: executor to use, default executor if None
+		:returns:        a future that resolves when the GUI loop ends
+		"""
+		def proc():
+			self.logger.debug('GUI loop starting...')
+			self.backend.run()
+			# GUI loop done
+			self._async_loop = None
+			self.logger.debug('GUI loop finished')
+
+		self.backend.load()
+		self._async_loop = loop or asyncio.get_running_loop()
+		fut = self._async_loop.run_in_executor(executor, proc)
+		self.backend.idle_add(functools.partial(self.backend.warm_up, self.html_generator.resource_urls()))
+		self.backend.idle_add(self._try_show_current_captcha) # start event loop on start
+		return fut
+
+	def stop(self) -> None:
+		"""
+		Schedule a callback on the GUI loop that closes the windows and stops it.
+		"""
+		self.backend.load()
+		@self.backend.idle_add
+		def _():
+			for view in self._all_views():
+				if view.window:
+					self._close(view)
+			self.backend.quit()
+
+	def solve(self, req: CaptchaRequest) -> Awaitable[CaptchaSuccess]:
+		"""
+		Queue the CaptchaRequest for display in a WebKit window.
+
+		Cancelling the returned future removes the request from the queue, or
+		skips it if it is currently displayed.
+
+		:returns: a future that is done when the CAPTCHA was displayed and
+		          solved or cancelled by the user
+		"""
+		return self.solve_many([req])[0]
+
+	def solve_many(self, reqs: Sequence[CaptchaRequest]) -> List[Awaitable[CaptchaSuccess]]:
+		"""
+		Queue several CaptchaRequests with a single callback on the GUI loop,
+		see solve.
+
+		:returns: a future per request
+		"""
+		loop = self._async_loop
+		if loop is None:
+			raise RuntimeError('GUI loop is not started')
+		futures = [] # type: List[Awaitable[CaptchaSuccess]]
+		pushes  = [] # type: List[Callable[[], None]]
+		for req in reqs:
+			fut = loop.create_future()
+			futures.append(fut)
+			try:
+				priority  = get_priority(req)
+				deadline  = get_deadline(req)
+				offscreen = bool(self._offscreen) and self.html_generator.is_invisible(req)
+			except CaptchaException as e:
+				fut.set_exception(e)
+				continue
+			pushes.append(self._prepare(loop, fut, req, priority, deadline, offscreen))
+
+		if pushes:
+			@self.backend.idle_add
+			def _():
+				for push in pushes:
+					push()
+				self._try_show_captcha() # start event loop if necessary
+
+		return futures
+
+	def _prepare(self,
+	             loop:     asyncio.AbstractEventLoop,
+	             fut:      asyncio.Future,
+	             req:      CaptchaRequest,
+	             priority:  int,
+	             deadline:  Optional[float],
+	             offscreen: bool) -> Callable[[], None]:
+		"""
+		Resolve fut with the request's result and withdraw the request if fut
+		is cancelled.
+
+		:param offscreen: queue the request for the offscreen views
+
+		:returns: a function queueing the request, called on the GUI thread
+		"""
+		def set_result(ret: CaptchaSuccess) -> None:
+			loop.call_soon_threadsafe(_set_result, fut, ret)
+
+		def set_exception(e: CaptchaException) -> None:
+			loop.call_soon_threadsafe(_set_exception, fut, e)
+
+		request = RequestTuple(req, set_result, set_exception)
+		entry = None # type: Optional[QueueEntry[RequestTuple]]
+
+		def push() -> None:
+			nonlocal entry
+			self.logger.debug('queueing CAPTCHA request %r...', req)
+			queue = self._invisible if offscreen else self._requests
+			entry = queue.push(request, priority, deadline)
+
+		@fut.add_done_callback
+		def _(fut: asyncio.Future) -> None:
+			if fut.cancelled():
+				# entry is read on the GUI thread after it was queued
+				self.backend.idle_add(lambda: self._withdraw(request, entry, offscreen))
+
+		return push
+
+	def _withdraw(self,
+	              request:   RequestTuple,
+	              entry:     Optional[QueueEntry[RequestTuple]],
+	              offscreen: bool) -> None:
+		"""
+		Remove a cancelled request from its queue, or stop displaying it and
+		process the next queued CAPTCHA.
+		"""
+		if entry is not None:
+			queue = self._invisible if offscreen and entry not in self._escalated else self._requests
+			if queue.remove(entry):
+				self.logger.debug('removed cancelled CAPTCHA request %r from queue', request.request)
+				self.counters['cancelled'] += 1
+				self._escalated.discard(entry)
+				self._preload()
+				return
+		for view in self._all_views():
+			if view.current_request is request:
+				self.logger.debug('skipping cancelled CAPTCHA request %r in %r', request.request, view)
+				self.counters['cancelled'] += 1
+				view.current_request = None
+				view.entry           = None
+				self._cancel_escalate_timer(view)
+				self._try_show_captcha()
+				return
+
+	def cancel_current(self) -> None:
+		"""
+		Cancel the CAPTCHAs currently displayed in the WebKit windows.
+		"""
+		self.backend.load()
+		@self.backend.idle_add
+		def _():
+			current = [view for view in self._views if view.current_request is not None]
+			if not current:
+				self.logger.debug('no CAPTCHA request to cancel')
+			for view in current:
+				self.logger.debug('canceling CAPTCHA request %r in %r', view.current_request, view)
+				view.current_request.set_exception(CaptchaException('# TODO #'))
+				view.current_request = None
+			self._try_show_captcha()
+
+	def collect_metrics(self) -> str:
+		"""
+		Safe to call from another thread.
+
+		:returns: the queue depth, the windows' state, counters, and timings in
+		          the Prometheus text format, see decaptcha.metrics.Registry
+		"""
+		memory = self.backend.memory_usage()
+		return ''.join([
+			format_gauge('decaptcha_queued_requests', 'CAPTCHA requests waiting for a window',
+			             len(self._requests)),
+			format_gauge('decaptcha_displayed_requests', 'CAPTCHA requests currently displayed',
+			             sum(view.current_request is not None for view in self._views)),
+			format_gauge('decaptcha_queued_invisible_requests', 'invisible CAPTCHA requests waiting for an offscreen window',
+			             len(self._invisible)),
+			format_gauge('decaptcha_offscreen_requests', 'invisible CAPTCHA requests currently run offscreen',
+			             sum(view.current_request is not None for view in self._offscreen)),
+			format_gauge('decaptcha_open_windows', 'WebKit windows, shown, preloading, or hidden for reuse',
+			             sum(view.window is not None for view in self._all_views())),
+			format_labelled('decaptcha_events_total', 'counter', 'GUI events by kind', 'event',
+			                self.counters),
+			self.histograms['queue'].format('decaptcha_queue_seconds',
+			                                'seconds CAPTCHA requests spent queued'),
+			self.histograms['page_load'].format('decaptcha_page_load_seconds',
+			                                    'seconds until a CAPTCHA page finished loading'),
+			self.histograms['solve'].format('decaptcha_solve_seconds',
+			                                'seconds from a loaded CAPTCHA page until it was solved'),
+			format_histograms('decaptcha_page_stage_seconds',
+			                  'seconds CAPTCHA pages spent in each stage, ending with the performance mark of its name, by sitekey',
+			                  ['stage', 'sitekey'], self.stage_histograms),
+			self.histograms['recycle_memory'].format('decaptcha_recycle_memory_bytes',
+			                                         'bytes of the web processes before a webview was recycled'),
+			format_gauge('decaptcha_web_process_memory_bytes', 'bytes of resident memory of the web processes',
+			             memory) if memory is not None else '',
+			self.backend.collect_metrics(),
+		])
@@ -0,0 +1,120 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import bisect
+from typing import (
+	Callable,
+	Final,
+	List,
+	Mapping,
+	Optional,
+	Sequence,
+	Tuple,
+)
+
+# Metrics are plain attributes updated by a single thread (e.g. the glib
+# thread) without locking and rendered in the Prometheus text format by
+# another. A rendering may therefore be off by the observations made while
+# it runs.
+
+def format_labels(labels: Optional[Mapping[str, str]]) -> str:
+	if not labels:
+		return ''
+	return '{%s}' % ','.join('%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+	                         for k, v in labels.items())
+
+def format_metric(name: str, type: str, help: str, samples: Sequence[str]) -> str:
+	return '# HELP %s %s\n# TYPE %s %s\n%s' % (name, help, name, type, ''.join(samples))
+
+def format_sample(name: str, value: float, labels: Optional[Mapping[str, str]] = None) -> str:
+	return '%s%s %s\n' % (name, format_labels(labels), repr(float(value)))
+
+def format_labelled(name: str, type: str, help: str, label: str, values: Mapping[str, float]) -> str:
+	"""
+	Render a mapping, e.g. a collections.Counter, as one metric with a label
+	per key.
+	"""
+	# copying a dict is atomic under the GIL, iterating it while another
+	# thread adds keys is not
+	return format_metric(name, type, help, [
+		format_sample(name, value, {label: key}) for key, value in sorted(dict(values).items())
+	])
+
+def format_gauge(name: str, help: str, value: float) -> str:
+	return format_metric(name, 'gauge', help, [format_sample(name, value)])
+
+
+class Histogram:
+	default_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+	__slots__ = ('buckets', 'counts', 'count', 'sum')
+
+	def __init__(self, buckets: Sequence[float] = default_buckets):
+		self.buckets = tuple(buckets)
+		self.counts  = [0] * (len(self.buckets) + 1) # last one is +Inf
+		self.count   = 0
+		self.sum     = 0.0
+
+	def observe(self, value: float) -> None:
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.count += 1
+		self.sum   += value
+
+	def samples(self, name: str, labels: Optional[Mapping[str, str]] = None) -> List[str]:
+		labels = dict(labels or {})
+		samples = []
+		cumulative = 0
+		for le, count in zip(self.buckets + (float('inf'),), self.counts):
+			cumulative += count
+			samples.append(format_sample(name + '_bucket', cumulative, dict(labels, le='+Inf' if le == float('inf') else repr(le))))
+		samples.append(format_sample(name + '_sum',   self.sum,   labels))
+		samples.append(format_sample(name + '_count', self.count, labels))
+		return samples
+
+	def format(self, name: str, help: str) -> str:
+		return format_metric(name, 'histogram', help, self.samples(name))
+
+
+def format_histograms(name:       str,
+                      help:       str,
+                      labels:     Sequence[str],
+                      histograms: Mapping[Tuple[str, ...], Histogram]) -> str:
+	"""
+	Render histograms keyed by their label values as one metric.
+	"""
+	return format_metric(name, 'histogram', help, [
+		sample
+		for values, histogram in sorted(dict(histograms).items())
+		for sample in histogram.samples(name, dict(zip(labels, values)))
+	])
+
+
+class Registry:
+	"""
+	Collects the metrics of several sources, each a function returning its
+	metrics in the Prometheus text format.
+	"""
+
+	def __init__(self) -> None:
+		self.collectors = [] # type: Final[List[Callable[[], str]]]
+
+	def register(self, collector: Callable[[], str]) -> None:
+		self.collectors.append(collector)
+
+	def render(self) -> str:
+		return ''.join(collector() for collector in self.collectors)
@@ -0,0 +1,125 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import sys
+from typing import (
+	Awaitable,
+	Callable,
+	Dict,
+)
+
+import aiohttp # type: ignore
+
+from .request import CaptchaRequest, CaptchaSuccess
+
+# A remote solver node connects to the /nodes WebSocket of a central
+# anticaptcha server (see decaptcha.anticaptcha.nodes) and solves the requests
+# it is sent.
+
+logger = logging.getLogger('SolverNode')
+
+async def run_node(url:             str,
+                   solve:           Callable[[CaptchaRequest], Awaitable[CaptchaSuccess]],
+                   capacity:        int   = 1,
+                   heartbeat:       float = 10.0,
+                   reconnect_delay: float = 5.0) -> None:
+	"""
+	Solve requests sent by the server at url, reconnecting if the connection
+	is lost. Runs until cancelled.
+
+	:param capacity:  number of requests solved concurrently
+	:param heartbeat: seconds between WebSocket pings
+	"""
+	async with aiohttp.ClientSession() as session:
+		while True:
+			futures = {} # type: Dict[int, asyncio.Future]
+			try:
+				async with session.ws_connect(url, heartbeat=heartbeat) as ws:
+					logger.info('connected to %s', url)
+
+					def reply(msg_id: int, fut: asyncio.Future) -> None:
+						futures.pop(msg_id, None)
+						if fut.cancelled() or ws.closed:
+							return
+						e = fut.exception()
+						if e is None:
+							msg = dict(fut.result(), id=msg_id)
+						else:
+							msg = {'id': msg_id, 'error': str(e)}
+						asyncio.ensure_future(ws.send_str(json.dumps(msg, separators=(',', ':'))))
+
+					await ws.send_json({'hello': {'capacity': capacity}})
+					async for message in ws:
+						if message.type != aiohttp.WSMsgType.TEXT:
+							continue
+						msg = json.loads(message.data)
+						msg_id = msg['id']
+						if msg.get('cancel'):
+							fut = futures.pop(msg_id, None)
+							if fut is not None:
+								fut.cancel()
+							continue
+						fut = asyncio.ensure_future(solve(msg['request']))
+						futures[msg_id] = fut
+						fut.add_done_callback(functools.partial(reply, msg_id))
+				logger.warning('connection to %s closed', url)
+			except aiohttp.ClientError as e:
+				logger.warning('connection to %s failed: %s', url, e)
+			finally:
+				# the server requeues them
+				for fut in futures.values():
+					fut.cancel()
+			await asyncio.sleep(reconnect_delay)
+
+async def amain(args: argparse.Namespace) -> None:
+	from .generators import HCaptchaHTMLGenerator, ReCaptchaHTMLGenerator
+	from .gui import DeCaptcha, WebKitBackend
+	htmlgen = HCaptchaHTMLGenerator() if args.hcaptcha else ReCaptchaHTMLGenerator()
+	decaptcha = DeCaptcha(htmlgen, windows=args.windows, idle_timeout=args.idle_timeout,
+	                      backend=WebKitBackend.in_directory(args.cache_dir),
+	                      preload_timeout=args.preload_timeout, max_loads=args.max_loads,
+	                      max_memory=args.max_memory * 2**20 if args.max_memory is not None else None,
+	                      offscreen=args.offscreen)
+	gui = decaptcha.run()
+	try:
+		await run_node(args.url, decaptcha.solve, capacity=args.windows)
+	finally:
+		decaptcha.stop()
+		await gui
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(prog='python -m decaptcha.node')
+	parser.add_argument('url', help="WebSocket URL of the server, e.g. ws://example.com:8100/nodes")
+	parser.add_argument('--windows', type=int, default=1, metavar='N')
+	parser.add_argument('--idle-timeout', type=float, default=30.0, metavar='SECONDS')
+	parser.add_argument('--preload-timeout', type=float, default=60.0, metavar='SECONDS')
+	parser.add_argument('--max-loads', type=int, metavar='N')
+	parser.add_argument('--offscreen', type=int, default=2, metavar='N')
+	parser.add_argument('--max-memory', type=int, metavar='MB')
+	parser.add_argument('--hcaptcha', action='store_true')
+	parser.add_argument('--cache-dir', metavar='DIR',
+	                    help="directory of WebKit's HTTP disk cache (DIR/cache) and website data (DIR/data)")
+	args = parser.parse_args()
+	logging.basicConfig(format='[%(asctime)s] %(levelname)-8s %(name)-48s %(message)s',
+	                    level=logging.DEBUG, stream=sys.stderr)
+	asyncio.run(amain(args))
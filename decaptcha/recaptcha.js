@@ -1,13 +1,67 @@
 "use strict";
-function postResponse(data) {
+function postDecaptcha(data) {
 	webkit.messageHandlers.decaptcha.postMessage(data);
 }
 
+function postResponse(resp) {
+	postDecaptcha({type: 'response', response: resp});
+}
+
+// Timing telemetry: every mark is posted with its milliseconds since the page
+// started loading.
+function postMark(name) {
+	const mark = performance.mark(name);
+	postDecaptcha({type: 'timing', mark: name, time: mark ? mark.startTime : performance.now()});
+}
+
+function postApiLoaded() {
+	for (const entry of performance.getEntriesByType('resource')) {
+		if (entry.initiatorType === 'script' && /\/api\.js/.test(entry.name)) {
+			postDecaptcha({type: 'timing', mark: 'api', time: entry.responseEnd});
+			return;
+		}
+	}
+}
+
+// If the challenge iframe (reCAPTCHA's bframe, hCaptcha's frame=challenge)
+// becomes visible, a human is needed. An invisible CAPTCHA usually resolves
+// without one.
+let challengeTimer = null;
+
+function unwatchChallenge() {
+	if (challengeTimer !== null) {
+		clearInterval(challengeTimer);
+		challengeTimer = null;
+	}
+}
+
+function watchChallenge(invisible) {
+	unwatchChallenge();
+	challengeTimer = setInterval(function() {
+		for (const frame of document.querySelectorAll('iframe')) {
+			if (/\/bframe|frame=challenge/.test(frame.src) && getComputedStyle(frame).visibility === 'visible') {
+				unwatchChallenge();
+				postMark('challenge');
+				if (invisible) {
+					postDecaptcha({type: 'challenge'});
+				}
+				return;
+			}
+		}
+	}, 200);
+}
+
 function onLoad() {
+	postApiLoaded();
+	postMark('onload');
 	grecaptcha.execute();
+	watchChallenge(document.querySelector('[data-size="invisible"]') !== null);
 }
 
 function onSubmit() {
+	// solved without the challenge becoming visible
+	unwatchChallenge();
+	postMark('submit');
 	const resp = grecaptcha.getResponse();
 
 	const main    = document.querySelector('#main');
@@ -0,0 +1,99 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+from typing import (
+	Any,
+	Callable,
+	Literal,
+	Mapping,
+	NamedTuple,
+	Optional,
+	TypedDict,
+	Union,
+)
+
+import jsonschema # type: ignore
+
+
+class CaptchaRequest(TypedDict):
+	url:     str
+	options: Mapping[str, Any]
+_captcha_request_validator = jsonschema.Draft7Validator({
+	'type': 'object',
+	'required': ['url'],
+	'properties': {
+		'url':     {'type': 'string'},
+		'options': {'type': 'object'},
+	},
+	'additionalProperties': True,
+})
+def parse_captcha_request(data: str) -> CaptchaRequest:
+	req = json.loads(data)
+	_captcha_request_validator.validate(req)
+	req.setdefault('options', {})
+	return req
+
+class _CaptchaSuccess(TypedDict):
+#	error:    Optional[Literal[False]] # Optional[T] is only an alias for Union[T, None], so not applicable here
+	response: Mapping[str, Any]
+class CaptchaSuccess(_CaptchaSuccess, total=False):
+	# seconds the page spent in each stage, see DeCaptcha.stage_timings
+	timings:   Mapping[str, float]
+	# UNIX timestamps the CAPTCHA was solved at and its token is estimated to
+	# expire at, see HTMLGenerator.token_lifetime
+	solvedAt:  float
+	expiresAt: float
+class CaptchaError(TypedDict):
+	error:  Literal[True]
+	reason: str
+CaptchaResponse = Union[CaptchaSuccess, CaptchaError]
+
+class CaptchaException(Exception):
+	def to_dict(self) -> CaptchaError:
+		return {'error': True, 'reason': str(self)}
+
+class RequestTuple(NamedTuple):
+	request:       CaptchaRequest
+	set_result:    Callable[[CaptchaSuccess],   None]
+	set_exception: Callable[[CaptchaException], None]
+
+def get_priority(req: CaptchaRequest) -> int:
+	""" Requests with a higher options.priority are displayed first. """
+	try:
+		priority = req['options']['priority']
+	except KeyError:
+		return 0
+	if isinstance(priority, int) and not isinstance(priority, bool):
+		return priority
+	else:
+		raise CaptchaException('options.priority must be an integer')
+
+def get_deadline(req: CaptchaRequest) -> Optional[float]:
+	"""
+	options.deadline is a UNIX timestamp after which the request is dropped
+	instead of being displayed.
+	"""
+	try:
+		deadline = req['options']['deadline']
+	except KeyError:
+		return None
+	if isinstance(deadline, (int, float)) and not isinstance(deadline, bool):
+		return float(deadline)
+	else:
+		raise CaptchaException('options.deadline must be a number')
@@ -0,0 +1,204 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import collections
+import logging
+import math
+import time
+from typing import (
+	Any,
+	Awaitable,
+	Callable,
+	Counter,
+	Deque,
+	Dict,
+	Final,
+	Optional,
+	Set,
+	Tuple,
+)
+
+from .metrics import format_metric, format_sample
+from .request import CaptchaRequest, CaptchaSuccess
+
+ReservoirKey = Tuple[str, Optional[str]]
+
+def reservoir_key(req: CaptchaRequest) -> ReservoirKey:
+	return (req['url'], req['options'].get('sitekey'))
+
+def _sort_key(item: Tuple[ReservoirKey, Any]) -> Tuple[str, str]:
+	(url, sitekey), _ = item
+	return (url, sitekey or '')
+
+
+class TokenReservoir:
+	"""
+	Keep a stock of solved CAPTCHAs for hot (url, sitekey) pairs in front of
+	a solve function like DeCaptcha.solve.
+
+	The stock is refilled with requests of priority refill_priority, so they
+	are only displayed when no other CAPTCHA is queued. Tokens are handed out
+	at most once and evicted margin seconds before their expiresAt, or
+	before the end of lifetime if they have none.
+	"""
+
+	logger = logging.getLogger('TokenReservoir')
+
+	def __init__(self,
+	             solve:           Callable[[CaptchaRequest], Awaitable[CaptchaSuccess]],
+	             lifetime:        Optional[float] = None,
+	             margin:          float = 20.0,
+	             refill_priority: int   = -1000):
+		"""
+		:param solve:           solve function the reservoir is in front of
+		:param lifetime:        seconds a solved token without expiresAt is
+		                        valid, see HTMLGenerator.token_lifetime,
+		                        None if they do not expire
+		:param margin:          seconds before it expires a token is evicted,
+		                        it has to cover the expiry margin of whoever
+		                        hands it out, e.g. TaskQueue.expiry_margin,
+		                        and the time it takes to use it
+		:param refill_priority: options.priority of the requests refilling
+		                        the stock
+		"""
+		self._solve          = solve
+		self.lifetime        = lifetime
+		self.margin          = margin
+		self.refill_priority = refill_priority
+		self.stats           = {} # type: Final[Dict[ReservoirKey, Counter[str]]]
+		self._templates      = {} # type: Dict[ReservoirKey, Tuple[CaptchaRequest, int]]
+		self._stock          = {} # type: Dict[ReservoirKey, Deque[Tuple[float, CaptchaSuccess]]]
+		self._refills        = {} # type: Dict[ReservoirKey, Set[asyncio.Future]]
+		self._timers         = set() # type: Set[asyncio.TimerHandle]
+
+	def keep(self, req: CaptchaRequest, target: int) -> None:
+		"""
+		Keep target solved tokens for req's (url, sitekey) in stock, a target
+		of 0 cancels the pending refills and discards the stock.
+		"""
+		key = reservoir_key(req)
+		if target > 0:
+			self._templates[key] = (req, target)
+			self._stock.setdefault(key, collections.deque())
+			self._refills.setdefault(key, set())
+			self.stats.setdefault(key, collections.Counter())
+			self._refill(key)
+		else:
+			self._templates.pop(key, None)
+			for fut in self._refills.pop(key, set()):
+				fut.cancel()
+			stock = self._stock.pop(key, None)
+			if stock:
+				self.stats[key]['discarded'] += len(stock)
+
+	def _evict(self, key: ReservoirKey) -> None:
+		stock = self._stock[key]
+		now = asyncio.get_running_loop().time()
+		while stock and stock[0][0] <= now:
+			stock.popleft()
+			self.logger.debug('token for %r expired unused', key)
+			self.stats[key]['expired'] += 1
+
+	def _refill(self, key: ReservoirKey) -> None:
+		try:
+			template, target = self._templates[key]
+		except KeyError:
+			return
+		self._evict(key)
+		refills = self._refills[key]
+		missing = target - len(self._stock[key]) - len(refills)
+		for _ in range(missing):
+			req = {
+				'url':     template['url'],
+				'options': dict(template['options'], priority=self.refill_priority),
+			} # type: CaptchaRequest
+			fut = asyncio.ensure_future(self._solve(req))
+			refills.add(fut)
+			fut.add_done_callback(lambda fut: self._on_refilled(key, fut))
+
+	def _on_refilled(self, key: ReservoirKey, fut: asyncio.Future) -> None:
+		self._refills.get(key, set()).discard(fut)
+		if fut.cancelled() or key not in self._stock:
+			# no longer kept
+			return
+		if fut.exception() is not None:
+			# do not refill right away, the next solve() will try again
+			self.logger.warning('refilling %r failed: %s', key, fut.exception())
+			return
+		loop = asyncio.get_running_loop()
+		if 'expiresAt' in fut.result():
+			ttl = fut.result()['expiresAt'] - time.time() - self.margin
+		elif self.lifetime is not None:
+			ttl = self.lifetime - self.margin
+		else:
+			ttl = math.inf
+		self._stock[key].append((loop.time() + ttl, fut.result()))
+		self.stats[key]['solved'] += 1
+		if ttl == math.inf:
+			return
+
+		def on_expired() -> None:
+			self._timers.discard(timer)
+			self._refill(key)
+		timer = loop.call_later(ttl, on_expired)
+		self._timers.add(timer)
+
+	async def solve(self, req: CaptchaRequest) -> CaptchaSuccess:
+		"""
+		Hand out a token from stock if available, otherwise solve req.
+		"""
+		key = reservoir_key(req)
+		stock = self._stock.get(key)
+		if stock is None:
+			return await self._solve(req)
+		self._evict(key)
+		if stock:
+			self.stats[key]['hits'] += 1
+			_, token = stock.popleft()
+			self._refill(key)
+			return token
+		self.stats[key]['misses'] += 1
+		self._refill(key)
+		return await self._solve(req)
+
+	def collect_metrics(self) -> str:
+		""" :returns: the stock and the token events by pair in the Prometheus text format """
+		stats = dict(self.stats)
+		return ''.join([
+			format_metric('decaptcha_reservoir_stock', 'gauge', 'solved tokens in stock', [
+				format_sample('decaptcha_reservoir_stock', len(stock), {'url': url, 'sitekey': sitekey or ''})
+				for (url, sitekey), stock in sorted(dict(self._stock).items(), key=_sort_key)
+			]),
+			format_metric('decaptcha_reservoir_tokens_total', 'counter', 'stocked tokens by event', [
+				format_sample('decaptcha_reservoir_tokens_total', value,
+				              {'url': url, 'sitekey': sitekey or '', 'event': event})
+				for (url, sitekey), counter in sorted(stats.items(), key=_sort_key)
+				for event, value in sorted(counter.items())
+			]),
+		])
+
+	def close(self) -> None:
+		""" Stop refilling and cancel all pending refills. """
+		self._templates.clear()
+		for timer in self._timers:
+			timer.cancel()
+		self._timers.clear()
+		for refills in self._refills.values():
+			for fut in refills:
+				fut.cancel()
@@ -0,0 +1,125 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import heapq
+import itertools
+import math
+import time
+from typing import (
+	Final,
+	Generic,
+	Iterator,
+	List,
+	Optional,
+	TypeVar,
+)
+
+T = TypeVar('T')
+
+
+class QueueEntry(Generic[T]):
+	"""
+	An item queued in a RequestQueue. Entries are ordered by descending
+	priority, then ascending deadline, then insertion order.
+	"""
+
+	__slots__ = ('item', 'priority', 'deadline', 'queued', 'enqueued', '_key')
+
+	def __init__(self, item: T, priority: int, deadline: Optional[float], seq: int):
+		self.item     = item     # type: Final[T]
+		self.priority = priority # type: Final[int]
+		self.deadline = deadline # type: Final[Optional[float]]
+		self.queued   = True
+		self.enqueued = time.monotonic() # type: Final[float]
+		self._key     = (-priority, math.inf if deadline is None else deadline, seq)
+
+	def __lt__(self, other: 'QueueEntry[T]') -> bool:
+		return self._key < other._key
+
+	def expired(self, now: float) -> bool:
+		return self.deadline is not None and self.deadline < now
+
+
+class RequestQueue(Generic[T]):
+	"""
+	Priority queue serving the highest priority first and the earliest
+	deadline first within a priority. Items without a deadline are served
+	after those with one, in insertion order.
+
+	Removing an entry only marks it, it is discarded once it reaches the top
+	of the heap.
+	"""
+
+	def __init__(self, seq: Optional[Iterator[int]] = None) -> None:
+		"""
+		:param seq: insertion counter, shared by queues whose entries are
+		            requeued into each other so they keep their order
+		"""
+		self._heap  = [] # type: List[QueueEntry[T]]
+		self._seq   = seq if seq is not None else itertools.count()
+		self._count = 0
+
+	def push(self, item: T, priority: int = 0, deadline: Optional[float] = None) -> QueueEntry[T]:
+		entry = QueueEntry(item, priority, deadline, next(self._seq))
+		heapq.heappush(self._heap, entry)
+		self._count += 1
+		return entry
+
+	def _discard_removed(self) -> None:
+		while self._heap and not self._heap[0].queued:
+			heapq.heappop(self._heap)
+
+	def peek(self) -> QueueEntry[T]:
+		""" :raises IndexError: if the queue is empty """
+		self._discard_removed()
+		return self._heap[0]
+
+	def pop(self) -> QueueEntry[T]:
+		""" :raises IndexError: if the queue is empty """
+		self._discard_removed()
+		entry = heapq.heappop(self._heap)
+		entry.queued = False
+		self._count -= 1
+		return entry
+
+	def requeue(self, entry: QueueEntry[T]) -> None:
+		"""
+		Queue a popped entry again, possibly popped from another queue sharing
+		this one's insertion counter, in its original order.
+		"""
+		assert not entry.queued
+		entry.queued = True
+		heapq.heappush(self._heap, entry)
+		self._count += 1
+
+	def remove(self, entry: QueueEntry[T]) -> bool:
+		"""
+		:returns: False if the entry was already removed or popped
+		"""
+		if not entry.queued:
+			return False
+		entry.queued = False
+		self._count -= 1
+		return True
+
+	def __len__(self) -> int:
+		return self._count
+
+	def __iter__(self) -> Iterator[T]:
+		""" Iterate over the queued items in the order they are served. """
+		return (entry.item for entry in sorted(self._heap) if entry.queued)
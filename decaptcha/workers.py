@@ -0,0 +1,308 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import asyncio
+import functools
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+from typing import (
+	Any,
+	Awaitable,
+	Callable,
+	Dict,
+	Final,
+	List,
+	Mapping,
+	Optional,
+	Sequence,
+)
+
+from .request import CaptchaException, CaptchaRequest, CaptchaSuccess
+
+# GTK allows only one main loop per process, so DeCaptcha instances are run in
+# worker processes (python -m decaptcha.workers) to drive several GUI loops,
+# possibly on different displays. The supervisor talks to the workers with one
+# JSON object per line on their stdin and stdout:
+#
+#   -> {"id": 1, "request": {"url": ..., "options": {...}}}
+#   -> {"id": 1, "cancel": true}
+#   <- {"id": 1, "response": {...}, "solvedAt": ..., "expiresAt": ...}
+#   <- {"id": 1, "error": "reason"}
+#
+# A worker exits when its stdin is closed.
+
+def encode_message(msg: Mapping[str, Any]) -> bytes:
+	return json.dumps(msg, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class WorkerProcess:
+	"""
+	A worker process solving CAPTCHAs, restarted if it exits unexpectedly.
+	"""
+
+	restart_delay     = 1.0
+	max_restart_delay = 60.0
+
+	def __init__(self,
+	             index:    int,
+	             command:  Sequence[str],
+	             capacity: int = 1,
+	             env:      Optional[Mapping[str, str]] = None):
+		"""
+		:param index:    index used in log messages
+		:param command:  command line starting the worker
+		:param capacity: number of CAPTCHAs the worker solves concurrently
+		:param env:      environment variables set in addition to os.environ
+		"""
+		self.index     = index
+		self.command   = list(command)
+		self.capacity  = capacity
+		self.env       = dict(os.environ, **(env or {})) # type: Final[Dict[str, str]]
+		self.logger    = logging.getLogger('WorkerProcess#%d' % index)
+		self._process  = None # type: Optional[asyncio.subprocess.Process]
+		self._reader   = None # type: Optional[asyncio.Task]
+		self._ids      = itertools.count(1)
+		self._pending  = {} # type: Dict[int, asyncio.Future]
+		self._stopping = asyncio.Event()
+
+	@property
+	def load(self) -> float:
+		return len(self._pending) / self.capacity
+
+	async def start(self) -> None:
+		self._stopping.clear()
+		self.logger.debug('starting %r', self.command)
+		self._process = await asyncio.create_subprocess_exec(
+			*self.command,
+			stdin=asyncio.subprocess.PIPE,
+			stdout=asyncio.subprocess.PIPE,
+			env=self.env,
+		)
+		self._reader = asyncio.create_task(self._read(self._process))
+
+	async def _read(self, process: asyncio.subprocess.Process) -> None:
+		assert process.stdout is not None
+		async for line in process.stdout:
+			try:
+				msg = json.loads(line)
+				fut = self._pending.pop(msg['id'], None)
+			except (ValueError, KeyError, TypeError):
+				self.logger.error('unexpected message from worker: %r', line)
+				continue
+			if fut is None:
+				# the request was cancelled while the worker answered it
+				self.logger.debug('reply to unknown request: %r', line)
+			elif fut.done():
+				pass
+			elif 'error' in msg:
+				fut.set_exception(CaptchaException(msg['error']))
+			else:
+				fut.set_result({key: value for key, value in msg.items() if key != 'id'})
+
+		returncode = await process.wait()
+		# requests are rejected until the worker is restarted
+		if self._process is process:
+			self._process = None
+		pending, self._pending = self._pending, {}
+		for fut in pending.values():
+			if not fut.done():
+				fut.set_exception(CaptchaException('worker exited'))
+		if not self._stopping.is_set():
+			self.logger.error('exited with %d, restarting...', returncode)
+			await self._restart()
+
+	async def _restart(self) -> None:
+		delay = self.restart_delay
+		while True:
+			try:
+				await asyncio.wait_for(self._stopping.wait(), delay)
+				return
+			except asyncio.TimeoutError:
+				pass
+			try:
+				await self.start()
+				return
+			except Exception:
+				delay = min(2 * delay, self.max_restart_delay)
+				self.logger.exception('restarting failed, retrying in %g seconds...', delay)
+
+	def _send(self, msg: Mapping[str, Any]) -> None:
+		if self._process is None or self._process.stdin is None:
+			raise CaptchaException('worker not running')
+		self._process.stdin.write(encode_message(msg))
+
+	def solve(self, req: CaptchaRequest) -> Awaitable[CaptchaSuccess]:
+		"""
+		Let the worker solve req, cancelling the returned future cancels the
+		request in the worker.
+		"""
+		fut = asyncio.get_running_loop().create_future()
+		msg_id = next(self._ids)
+		try:
+			self._send({'id': msg_id, 'request': req})
+		except CaptchaException as e:
+			fut.set_exception(e)
+			return fut
+		self._pending[msg_id] = fut
+
+		@fut.add_done_callback
+		def _(fut: asyncio.Future) -> None:
+			if fut.cancelled() and self._pending.pop(msg_id, None) is not None:
+				try:
+					self._send({'id': msg_id, 'cancel': True})
+				except CaptchaException:
+					pass
+
+		return fut
+
+	async def stop(self) -> None:
+		self._stopping.set()
+		while self._reader is not None:
+			reader = self._reader
+			if self._process is not None and self._process.stdin is not None:
+				self._process.stdin.close()
+			await reader
+			# unless a restart finished in the meantime
+			if self._reader is reader:
+				self._reader = None
+		self._process = None
+
+
+class WorkerPool:
+	"""
+	Dispatch CAPTCHA requests to the least loaded of several worker
+	processes.
+	"""
+
+	def __init__(self, workers: Sequence[WorkerProcess]):
+		if not workers:
+			raise ValueError('at least one worker is required')
+		self.workers = list(workers) # type: Final[List[WorkerProcess]]
+
+	@classmethod
+	def spawn(cls,
+	          count:    int,
+	          displays: Sequence[str] = (),
+	          windows:  int = 1,
+	          args:     Sequence[str] = ()) -> 'WorkerPool':
+		"""
+		Create count DeCaptcha worker processes, assigned to displays round
+		robin.
+
+		:param windows: WebKit windows per worker
+		:param args:    additional arguments for python -m decaptcha.workers,
+		                {index} is replaced with the worker's index
+		"""
+		workers = []
+		for i in range(count):
+			env = {'DISPLAY': displays[i % len(displays)]} if displays else {}
+			command = [sys.executable, '-m', 'decaptcha.workers', '--windows', str(windows),
+			           *(arg.replace('{index}', str(i)) for arg in args)]
+			workers.append(WorkerProcess(i, command, capacity=windows, env=env))
+		return cls(workers)
+
+	async def start(self) -> None:
+		await asyncio.gather(*(worker.start() for worker in self.workers))
+
+	async def stop(self) -> None:
+		await asyncio.gather(*(worker.stop() for worker in self.workers))
+
+	def solve(self, req: CaptchaRequest) -> Awaitable[CaptchaSuccess]:
+		worker = min(self.workers, key=lambda worker: worker.load)
+		return worker.solve(req)
+
+
+async def serve(solve: Callable[[CaptchaRequest], Awaitable[CaptchaSuccess]]) -> None:
+	"""
+	Answer requests read from stdin until it is closed.
+	"""
+	loop = asyncio.get_running_loop()
+	stdin = asyncio.StreamReader()
+	await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stdin), sys.stdin)
+	stdout = sys.stdout.buffer
+	futures = {} # type: Dict[int, asyncio.Future]
+
+	def reply(msg_id: int, fut: asyncio.Future) -> None:
+		futures.pop(msg_id, None)
+		if fut.cancelled():
+			return
+		e = fut.exception()
+		if e is None:
+			msg = dict(fut.result(), id=msg_id)
+		else:
+			msg = {'id': msg_id, 'error': str(e)}
+		stdout.write(encode_message(msg))
+		stdout.flush()
+
+	async for line in stdin:
+		msg = json.loads(line)
+		msg_id = msg['id']
+		if msg.get('cancel'):
+			fut = futures.pop(msg_id, None)
+			if fut is not None:
+				fut.cancel()
+			continue
+		fut = asyncio.ensure_future(solve(msg['request']))
+		futures[msg_id] = fut
+		fut.add_done_callback(functools.partial(reply, msg_id))
+
+	for fut in list(futures.values()):
+		fut.cancel()
+
+async def amain(args: argparse.Namespace) -> None:
+	from .backend import DisplayBackend, FakeBackend
+	from .generators import HCaptchaHTMLGenerator, ReCaptchaHTMLGenerator
+	from .gui import DeCaptcha, WebKitBackend
+	htmlgen = HCaptchaHTMLGenerator() if args.hcaptcha else ReCaptchaHTMLGenerator()
+	if args.fake is not None:
+		backend = FakeBackend(solve_latency=functools.partial(random.expovariate, 1 / args.fake) if args.fake > 0 else 0.0) # type: DisplayBackend
+	else:
+		backend = WebKitBackend.in_directory(args.cache_dir)
+	decaptcha = DeCaptcha(htmlgen, windows=args.windows, idle_timeout=args.idle_timeout, backend=backend,
+	                      preload_timeout=args.preload_timeout, max_loads=args.max_loads,
+	                      max_memory=args.max_memory * 2**20 if args.max_memory is not None else None,
+	                      offscreen=args.offscreen)
+	gui = decaptcha.run()
+	try:
+		await serve(decaptcha.solve)
+	finally:
+		decaptcha.stop()
+		await gui
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(prog='python -m decaptcha.workers')
+	parser.add_argument('--windows', type=int, default=1, metavar='N')
+	parser.add_argument('--idle-timeout', type=float, default=30.0, metavar='SECONDS')
+	parser.add_argument('--preload-timeout', type=float, default=60.0, metavar='SECONDS')
+	parser.add_argument('--max-loads', type=int, metavar='N')
+	parser.add_argument('--offscreen', type=int, default=2, metavar='N')
+	parser.add_argument('--max-memory', type=int, metavar='MB')
+	parser.add_argument('--hcaptcha', action='store_true')
+	parser.add_argument('--fake', type=float, metavar='SECONDS',
+	                    help="solve every CAPTCHA by itself after on average SECONDS")
+	parser.add_argument('--cache-dir', metavar='DIR',
+	                    help="directory of WebKit's HTTP disk cache (DIR/cache) and website data (DIR/data)")
+	args = parser.parse_args()
+	logging.basicConfig(format='[%(asctime)s] %(levelname)-8s %(name)-48s %(message)s',
+	                    level=logging.DEBUG, stream=sys.stderr)
+	asyncio.run(amain(args))
@@ -0,0 +1,428 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import json
+import os.path
+import tempfile
+import time
+import unittest
+
+from aiohttp import web # type: ignore
+from aiohttp.test_utils import TestClient, TestServer # type: ignore
+
+from decaptcha.anticaptcha import (
+	add_routes,
+	NoSlotAvailable,
+	Solved,
+	TaskQueue,
+)
+from decaptcha.anticaptcha.callbacks import CallbackDispatcher
+from decaptcha.anticaptcha.clients import ClientLimits, FairScheduler
+from decaptcha.anticaptcha.store import TaskStore
+from decaptcha.anticaptcha.errors import (
+	ERROR_KEY_DOES_NOT_EXIST,
+	ERROR_NO_SLOT_AVAILABLE,
+	ERROR_NO_SUCH_CAPCHA_ID,
+	ERROR_TASK_NOT_SUPPORTED,
+	ERROR_TOKEN_EXPIRED,
+)
+
+task = {
+	'type':       'HCaptchaTaskProxyless',
+	'websiteURL': 'https://decaptcha.test/',
+	'websiteKey': 'key',
+}
+
+class AntiCaptcha(unittest.TestCase):
+	def setUp(self):
+		self.solving = []
+
+	async def solve(self, task):
+		fut = asyncio.get_running_loop().create_future()
+		self.solving.append((task, fut))
+		return await fut
+
+	async def client(self, **kwargs) -> TestClient:
+		""" :param kwargs: passed to TestServer """
+		app = web.Application()
+		self.task_queue = add_routes(app, self.solve)
+		client = TestClient(TestServer(app, **kwargs))
+		await client.start_server()
+		return client
+
+	async def atest_create_task(self):
+		client = await self.client()
+		try:
+			resp = await client.post('/createTask', json={'task': dict(task, type='ImageToTextTask')})
+			self.assertEqual(await resp.json(), ERROR_TASK_NOT_SUPPORTED)
+
+			resp = await client.post('/createTask', json={'task': dict(task, websiteKey=1)})
+			self.assertEqual(resp.status, 400)
+
+			resp = await client.post('/createTask', json={'task': task})
+			task_id = (await resp.json())['taskId']
+			await asyncio.sleep(0)
+			self.assertEqual(self.solving[0][0], task)
+			self.solving[0][1].set_result({'gRecaptchaResponse': 'token'})
+
+			resp = await client.post('/getTaskResult', json={'taskId': task_id})
+			self.assertEqual(await resp.json(), {
+				'errorId': 0,
+				'status': 'ready',
+				'solution': {'gRecaptchaResponse': 'token'},
+			})
+		finally:
+			await client.close()
+
+	async def atest_poll(self):
+		client = await self.client()
+		try:
+			resp = await client.post('/createTask', json={'task': task})
+			task_id = (await resp.json())['taskId']
+			resp = await client.post('/getTaskResult', json={'taskId': task_id})
+			self.assertEqual(await resp.json(), {'errorId': 0, 'status': 'processing'})
+
+			self.task_queue.ticker.interval = 0.01
+			resp = await client.post('/getTaskResult', json={'taskId': task_id, 'longPoll': True})
+			await asyncio.sleep(0.05)
+			self.solving[0][1].set_result({'gRecaptchaResponse': 'token'})
+			body = await resp.text()
+			self.assertTrue(body.startswith('  '))
+			self.assertEqual(json.loads(body)['solution'], {'gRecaptchaResponse': 'token'})
+		finally:
+			await client.close()
+
+	async def atest_interrupted_poll(self):
+		client = await self.client()
+		try:
+			resp = await client.post('/createTask', json={'task': task})
+			task_id = (await resp.json())['taskId']
+			poll = asyncio.ensure_future(client.post('/getTaskResult', json={'taskId': task_id, 'longPoll': True}))
+			await asyncio.sleep(0.05)
+		finally:
+			# stopping the server cancels the long poll, but not the task
+			await client.close()
+		poll.cancel()
+		self.assertIn(task_id, self.task_queue.tasks)
+		self.assertFalse(self.solving[0][1].cancelled())
+		self.assertEqual(self.task_queue.counters['cancelled'], 0)
+
+	async def atest_disconnected_poll(self):
+		# the handler is cancelled, or notices it at the next keep-alive
+		for handler_cancellation in (True, False):
+			self.solving.clear()
+			client = await self.client(handler_cancellation=handler_cancellation)
+			try:
+				self.task_queue.ticker.interval = 0.01
+				resp = await client.post('/createTask', json={'task': task})
+				task_id = (await resp.json())['taskId']
+				resp = await client.post('/getTaskResult', json={'taskId': task_id, 'longPoll': True})
+				await asyncio.sleep(0.05)
+				resp.close()
+				await asyncio.sleep(0.05)
+				self.assertNotIn(task_id, self.task_queue.tasks)
+				self.assertTrue(self.solving[0][1].cancelled())
+				self.assertEqual(self.task_queue.counters['cancelled'], 1)
+			finally:
+				await client.close()
+
+	async def atest_callback(self):
+		received = []
+		async def receive(request):
+			received.append(await request.json())
+			# fail the first delivery
+			return web.Response(status=500 if len(received) == 1 else 200)
+		receiver = web.Application()
+		receiver.router.add_route('POST', '/callback', receive)
+		server = TestServer(receiver)
+		await server.start_server()
+
+		async def solve(task):
+			return {'gRecaptchaResponse': 'token'}
+		task_queue = TaskQueue(solve, callbacks=CallbackDispatcher(backoff=0.01))
+		try:
+			task_id = await task_queue.enqueue_task(task, str(server.make_url('/callback')))
+			task_lost = await task_queue.enqueue_task(task, 'http://127.0.0.1:1/')
+			task_queue.callbacks.attempts = 2
+			await asyncio.sleep(0.2)
+			self.assertEqual(len(received), 2)
+			self.assertEqual(received[1], {
+				'errorId': 0,
+				'status': 'ready',
+				'solution': {'gRecaptchaResponse': 'token'},
+				'taskId': task_id,
+			})
+			# released after delivery
+			self.assertNotIn(task_id, task_queue.tasks)
+			self.assertIn(task_lost, task_queue.tasks)
+			self.assertEqual([letter.url for letter in task_queue.callbacks.dead_letters],
+			                 ['http://127.0.0.1:1/'])
+		finally:
+			await task_queue.stop()
+			await server.close()
+
+	async def atest_store(self):
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'tasks.sqlite')
+			task_queue = TaskQueue(self.solve, store=TaskStore(path))
+			await task_queue.start()
+			finished = await task_queue.enqueue_task(task)
+			pending  = await task_queue.enqueue_task(task)
+			collected = await task_queue.enqueue_task(task)
+			await asyncio.sleep(0)
+			self.solving[0][1].set_result({'gRecaptchaResponse': 'token'})
+			await asyncio.sleep(0.01)
+			task_queue.discard(collected)
+			await task_queue.stop()
+
+			# restart
+			self.solving.clear()
+			task_queue = TaskQueue(self.solve, store=TaskStore(path))
+			await task_queue.start()
+			try:
+				self.assertEqual(set(task_queue.tasks), {finished, pending})
+				self.assertEqual(task_queue[finished].result(), {'gRecaptchaResponse': 'token'})
+				await asyncio.sleep(0)
+				self.assertEqual([t for t, _ in self.solving], [task])
+			finally:
+				await task_queue.stop()
+
+	async def atest_store_shutdown(self):
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'tasks.sqlite')
+			app = web.Application()
+			# the batch is still collected when the server shuts down
+			add_routes(app, self.solve, store=TaskStore(path, batch_interval=60.0))
+			client = TestClient(TestServer(app))
+			await client.start_server()
+			try:
+				resp = await client.post('/createTask', json={'task': task})
+				task_id = (await resp.json())['taskId']
+			finally:
+				await client.close()
+			self.assertEqual([stored.task_id for stored in TaskStore(path).load()], [task_id])
+
+	async def atest_expiry(self):
+		client = await self.client()
+		try:
+			task_ids = []
+			for _ in range(2):
+				resp = await client.post('/createTask', json={'task': task})
+				task_ids.append((await resp.json())['taskId'])
+			await asyncio.sleep(0)
+			now = time.time()
+			self.solving[0][1].set_result(Solved({'gRecaptchaResponse': 'token'}, now, now + 60))
+			# within expiry_margin
+			self.solving[1][1].set_result(Solved({'gRecaptchaResponse': 'stale'}, now - 115, now + 5))
+			resp = await client.post('/getTaskResults', json={'taskIds': task_ids})
+			self.assertEqual((await resp.json())['tasks'], [
+				{'taskId': task_ids[0], 'errorId': 0, 'status': 'ready',
+				 'solution': {'gRecaptchaResponse': 'token'}, 'solvedAt': now, 'expiresAt': now + 60},
+				dict(ERROR_TOKEN_EXPIRED, taskId=task_ids[1],
+				     errorDescription='the token expired before it was collected'),
+			])
+			resp = await client.get('/metrics')
+			self.assertIn('anticaptcha_tasks_total{event="expired"} 1.0', (await resp.text()).splitlines())
+		finally:
+			await client.close()
+
+		self.solving.clear()
+		task_queue = TaskQueue(self.solve, requeue_stale=True)
+		task_id = await task_queue.enqueue_task(task)
+		await asyncio.sleep(0)
+		self.solving[0][1].set_result(Solved({'gRecaptchaResponse': 'stale'}, now - 120, now))
+		await asyncio.sleep(0.01)
+		task_queue.expire()
+		# solved again under the same taskId
+		self.assertFalse(task_queue[task_id].done())
+		await asyncio.sleep(0)
+		self.assertEqual([t for t, _ in self.solving], [task, task])
+		self.assertEqual(task_queue.counters['requeued'], 1)
+		task_queue[task_id].cancel()
+
+	async def atest_cancel_task(self):
+		client = await self.client()
+		try:
+			resp = await client.post('/createTask', json={'task': task})
+			task_id = (await resp.json())['taskId']
+			await asyncio.sleep(0)
+			resp = await client.post('/cancelTask', json={'taskId': task_id})
+			self.assertEqual(await resp.json(), {'errorId': 0})
+			self.assertTrue(self.solving[0][1].cancelled())
+			resp = await client.post('/getTaskResult', json={'taskId': task_id})
+			self.assertEqual(await resp.json(), ERROR_NO_SUCH_CAPCHA_ID)
+		finally:
+			await client.close()
+
+	async def atest_batch(self):
+		batches = []
+		def solve_many(tasks):
+			batches.append(tasks)
+			return [self.solve(task) for task in tasks]
+		app = web.Application()
+		self.task_queue = add_routes(app, self.solve, solve_many=solve_many, max_tasks=2)
+		client = TestClient(TestServer(app))
+		await client.start_server()
+		try:
+			resp = await client.post('/createTasks', json={'tasks': [
+				task,
+				dict(task, type='ImageToTextTask'),
+				dict(task, websiteKey=1),
+				dict(task, websiteKey='second'),
+				task,
+			]})
+			results = (await resp.json())['tasks']
+			self.assertEqual(results[1], ERROR_TASK_NOT_SUPPORTED)
+			self.assertEqual(results[2]['errorCode'], ERROR_TASK_NOT_SUPPORTED['errorCode'])
+			self.assertEqual(results[4], ERROR_NO_SLOT_AVAILABLE)
+			self.assertEqual(batches, [[task, dict(task, websiteKey='second')]])
+			first, second = results[0]['taskId'], results[3]['taskId']
+
+			await asyncio.sleep(0)
+			self.solving[0][1].set_result({'gRecaptchaResponse': 'token'})
+			await asyncio.sleep(0.01)
+			resp = await client.post('/getTaskResults', json={'taskIds': [first, second, 'unknown']})
+			self.assertEqual((await resp.json())['tasks'], [
+				{'taskId': first, 'errorId': 0, 'status': 'ready', 'solution': {'gRecaptchaResponse': 'token'}},
+				{'taskId': second, 'errorId': 0, 'status': 'processing'},
+				dict(ERROR_NO_SUCH_CAPCHA_ID, taskId='unknown'),
+			])
+		finally:
+			await client.close()
+
+	async def atest_clients(self):
+		scheduler = FairScheduler(1, {'key': ClientLimits(max_tasks=2)}, default=None)
+		app = web.Application()
+		self.task_queue = add_routes(app, self.solve, scheduler=scheduler)
+		client = TestClient(TestServer(app))
+		await client.start_server()
+		try:
+			resp = await client.post('/createTask', json={'task': task})
+			self.assertEqual(await resp.json(), ERROR_KEY_DOES_NOT_EXIST)
+
+			resp = await client.post('/createTasks', json={'clientKey': 'key', 'tasks': [task] * 3})
+			results = (await resp.json())['tasks']
+			self.assertEqual([r['errorId'] for r in results], [0, 0, ERROR_NO_SLOT_AVAILABLE['errorId']])
+			await asyncio.sleep(0)
+			self.assertEqual(len(self.solving), 1) # the other waits in the scheduler
+
+			resp = await client.post('/cancelTask', json={'taskId': results[0]['taskId']})
+			await asyncio.sleep(0.01)
+			self.assertEqual(len(self.solving), 2)
+			resp = await client.get('/metrics')
+			self.assertIn('anticaptcha_rejected_total{reason="max_tasks"} 1.0', (await resp.text()).splitlines())
+		finally:
+			await client.close()
+
+	async def atest_batch_max_wait(self):
+		scheduler = FairScheduler(1, max_wait=60, solve_time=20)
+		task_queue = TaskQueue(self.solve, scheduler=scheduler)
+		# the first is started at once, the next three wait 20, 40 and 60 seconds
+		task_ids = await task_queue.enqueue_tasks([task] * 200)
+		self.assertEqual(sum(task_id is not None for task_id in task_ids), 4)
+		self.assertEqual(task_ids[4:], [None] * 196)
+		self.assertEqual(scheduler.rejected['max_wait'], 196)
+		for task_id in task_ids[:4]:
+			task_queue.cancel(task_id)
+
+	async def atest_metrics(self):
+		client = await self.client()
+		try:
+			resp = await client.post('/createTask', json={'task': task})
+			await client.post('/createTask', json={'task': task})
+			await asyncio.sleep(0)
+			self.solving[0][1].set_result({'gRecaptchaResponse': 'token'})
+			await asyncio.sleep(0.01)
+
+			resp = await client.get('/metrics')
+			self.assertTrue(resp.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+			lines = (await resp.text()).splitlines()
+			self.assertIn('# TYPE anticaptcha_task_seconds histogram', lines)
+			self.assertIn('anticaptcha_tasks{state="pending"} 1.0', lines)
+			self.assertIn('anticaptcha_tasks{state="finished"} 1.0', lines)
+			self.assertIn('anticaptcha_tasks_total{event="created"} 2.0', lines)
+			self.assertIn('anticaptcha_task_seconds_bucket{le="+Inf"} 1.0', lines)
+			self.assertIn('anticaptcha_task_seconds_count 1.0', lines)
+		finally:
+			await client.close()
+
+	async def atest_retention(self):
+		async def solve(task):
+			return {'gRecaptchaResponse': task['websiteKey']}
+		task_queue = TaskQueue(solve, result_ttl=0.05, max_tasks=2, sweep_interval=0.01)
+		await task_queue.start()
+		try:
+			first  = await task_queue.enqueue_task(task)
+			second = await task_queue.enqueue_task(task)
+			await asyncio.sleep(0.01)
+			# full, the oldest finished result is evicted
+			third = await task_queue.enqueue_task(task)
+			self.assertNotIn(first, task_queue.tasks)
+			self.assertIn(second, task_queue.tasks)
+			await asyncio.sleep(0.1)
+			self.assertEqual(task_queue.gauges(), {'tasks': 0, 'pending': 0, 'finished': 0, 'evicted': 3})
+		finally:
+			await task_queue.stop()
+
+		task_queue = TaskQueue(self.solve, max_tasks=1)
+		await task_queue.enqueue_task(task)
+		with self.assertRaises(NoSlotAvailable):
+			await task_queue.enqueue_task(task)
+
+	def test_create_task(self):
+		asyncio.run(self.atest_create_task())
+
+	def test_cancel_task(self):
+		asyncio.run(self.atest_cancel_task())
+
+	def test_expiry(self):
+		asyncio.run(self.atest_expiry())
+
+	def test_batch(self):
+		asyncio.run(self.atest_batch())
+
+	def test_clients(self):
+		asyncio.run(self.atest_clients())
+
+	def test_batch_max_wait(self):
+		asyncio.run(self.atest_batch_max_wait())
+
+	def test_metrics(self):
+		asyncio.run(self.atest_metrics())
+
+	def test_retention(self):
+		asyncio.run(self.atest_retention())
+
+	def test_poll(self):
+		asyncio.run(self.atest_poll())
+
+	def test_interrupted_poll(self):
+		asyncio.run(self.atest_interrupted_poll())
+
+	def test_disconnected_poll(self):
+		asyncio.run(self.atest_disconnected_poll())
+
+	def test_callback(self):
+		asyncio.run(self.atest_callback())
+
+	def test_store(self):
+		asyncio.run(self.atest_store())
+
+	def test_store_shutdown(self):
+		asyncio.run(self.atest_store_shutdown())
@@ -0,0 +1,99 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import time
+import unittest
+
+from decaptcha.anticaptcha.clients import (
+	ClientLimits,
+	FairScheduler,
+	KeyDoesNotExist,
+	NoSlotAvailable,
+)
+
+class Clients(unittest.TestCase):
+	def setUp(self):
+		self.started = []
+
+	def start(self, name):
+		fut = asyncio.get_running_loop().create_future()
+		self.started.append((name, fut))
+		return fut
+
+	def queue(self, scheduler, key, name):
+		client = scheduler.client(key)
+		scheduler.admit(client)
+		return scheduler.schedule(client, lambda: self.start(name))
+
+	async def atest_weighted_fair(self):
+		scheduler = FairScheduler(1, {'heavy': ClientLimits(weight=2)})
+		blocker = self.queue(scheduler, 'light', 'blocker')
+		# the noisy client queues first, but does not starve the others
+		for i in range(4):
+			self.queue(scheduler, 'heavy', 'heavy%d' % i)
+		for i in range(2):
+			self.queue(scheduler, 'light', 'light%d' % i)
+		self.assertEqual(scheduler.queued, 6)
+
+		for name, fut in self.started:
+			fut.set_result(name)
+			await asyncio.sleep(0)
+		self.assertEqual(await blocker, 'blocker')
+		self.assertEqual([name for name, _ in self.started],
+		                 ['blocker', 'heavy0', 'heavy1', 'light0', 'heavy2', 'heavy3', 'light1'])
+		self.assertEqual(scheduler.running, 0)
+
+	async def atest_limits(self):
+		scheduler = FairScheduler(1, {'key': ClientLimits(max_tasks=2, rate=0.001, burst=3)},
+		                          default=None, max_wait=30, solve_time=20)
+		with self.assertRaises(KeyDoesNotExist):
+			scheduler.client('other')
+
+		first = self.queue(scheduler, 'key', 'first')
+		second = self.queue(scheduler, 'key', 'second')
+		with self.assertRaises(NoSlotAvailable):
+			self.queue(scheduler, 'key', 'third') # max_tasks
+		second.cancel()
+		await asyncio.sleep(0)
+		self.assertEqual(scheduler.queued, 0)
+		self.queue(scheduler, 'key', 'third').cancel()
+		await asyncio.sleep(0)
+		with self.assertRaises(NoSlotAvailable):
+			scheduler.admit(scheduler.client('key')) # burst used up
+
+		scheduler.limits['key'] = ClientLimits()
+		del scheduler._clients['key']
+		# 1 running, the next waits 20 seconds, the one after it 40
+		self.queue(scheduler, 'key', 'fourth')
+		with self.assertRaises(NoSlotAvailable):
+			self.queue(scheduler, 'key', 'fifth')
+		scheduler.max_wait = None
+		with self.assertRaises(NoSlotAvailable):
+			scheduler.admit(scheduler.client('key'), deadline=time.time() + 10)
+		self.assertEqual(dict(scheduler.rejected),
+		                 {'unknown_key': 1, 'max_tasks': 1, 'rate': 1, 'max_wait': 1, 'deadline': 1})
+		first.cancel()
+		await asyncio.sleep(0)
+		self.assertTrue(self.started[0][1].cancelled())
+
+	def test_weighted_fair(self):
+		asyncio.run(self.atest_weighted_fair())
+
+	def test_limits(self):
+		asyncio.run(self.atest_limits())
@@ -0,0 +1,253 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import unittest
+
+from decaptcha import (
+	CaptchaException,
+	DeCaptcha,
+	FakeBackend,
+	ReCaptchaHTMLGenerator,
+)
+
+class FakeGUI(unittest.TestCase):
+	"""
+	The request loop of DeCaptcha with windows that solve their CAPTCHAs by
+	themselves.
+	"""
+
+	async def atest_solve(self):
+		backend = FakeBackend(load_latency=0.01, solve_latency=0.02,
+		                      response=lambda url: 'token ' + url)
+		decaptcha = DeCaptcha(ReCaptchaHTMLGenerator(), windows=2, idle_timeout=0.05, backend=backend,
+		                      preload_timeout=0)
+		gui = decaptcha.run()
+		try:
+			responses = await asyncio.gather(*(
+				decaptcha.solve({'url': 'https://decaptcha.test/%d' % i}) for i in range(5)
+			))
+			self.assertEqual([response['response'] for response in responses],
+			                 ['token https://decaptcha.test/%d' % i for i in range(5)])
+			self.assertEqual(len(backend.windows), 2)
+			self.assertEqual(decaptcha.counters['solved'], 5)
+			self.assertEqual(decaptcha.histograms['page_load'].count, 5)
+			self.assertEqual(decaptcha.histograms['solve'].count, 5)
+
+			# the hidden windows are reused, then closed after idle_timeout
+			await decaptcha.solve({'url': 'https://decaptcha.test/'})
+			self.assertEqual(decaptcha.counters['windows_reused'], 1)
+			await asyncio.sleep(0.1)
+			self.assertTrue(all(window.destroyed for window in backend.windows))
+		finally:
+			decaptcha.stop()
+			await gui
+
+	async def atest_cancel_and_close(self):
+		backend = FakeBackend(solve_latency=10)
+		decaptcha = DeCaptcha(ReCaptchaHTMLGenerator(), backend=backend, preload_timeout=0)
+		gui = decaptcha.run()
+		try:
+			first  = decaptcha.solve({'url': 'https://decaptcha.test/1'})
+			second = decaptcha.solve({'url': 'https://decaptcha.test/2'})
+			third  = decaptcha.solve({'url': 'https://decaptcha.test/3'})
+			await asyncio.sleep(0.01)
+			second.cancel()
+			first.cancel()
+			await asyncio.sleep(0.01)
+			self.assertEqual(backend.windows[0].loads, 2) # second was never displayed
+			self.assertEqual(decaptcha.counters['cancelled'], 2)
+
+			backend.idle_add(backend.windows[0].close)
+			with self.assertRaises(CaptchaException):
+				await third
+			self.assertEqual(decaptcha.counters['windows_closed'], 1)
+		finally:
+			decaptcha.stop()
+			await gui
+
+	async def atest_solve_many(self):
+		backend = FakeBackend()
+		hops = []
+		idle_add = backend.idle_add
+		def count_hops(callback):
+			hops.append(callback)
+			idle_add(callback)
+		backend.idle_add = count_hops
+		decaptcha = DeCaptcha(ReCaptchaHTMLGenerator(), windows=4, backend=backend)
+		gui = decaptcha.run()
+		try:
+			hops.clear()
+			futures = decaptcha.solve_many([{'url': 'https://decaptcha.test/%d' % i} for i in range(3)]
+			                               + [{'url': 'https://decaptcha.test/', 'options': {'priority': 'high'}}])
+			self.assertEqual(len(hops), 1) # a single hop to the GUI thread
+			with self.assertRaises(CaptchaException):
+				await futures.pop()
+			self.assertEqual([response['response'] for response in await asyncio.gather(*futures)], ['fake-token'] * 3)
+		finally:
+			decaptcha.stop()
+			await gui
+
+	async def atest_preload(self):
+		backend = FakeBackend(load_latency=0.01, solve_latency=0.05,
+		                      response=lambda url: 'token ' + url)
+		decaptcha = DeCaptcha(ReCaptchaHTMLGenerator(), backend=backend, preload_timeout=0.02)
+		gui = decaptcha.run()
+		try:
+			futures = [decaptcha.solve({'url': 'https://decaptcha.test/%d' % i}) for i in range(3)]
+			await asyncio.sleep(0.045)
+			# the second CAPTCHA is loaded in a hidden window, and reloaded
+			# after preload_timeout
+			displayed, preloading = backend.windows
+			self.assertTrue(displayed.visible)
+			self.assertFalse(preloading.visible)
+			self.assertGreaterEqual(preloading.loads, 2)
+			self.assertGreaterEqual(decaptcha.counters['preloads_expired'], 1)
+
+			# cancelling the preloaded CAPTCHA preloads the next one
+			futures[1].cancel()
+			await asyncio.sleep(0.01)
+			self.assertEqual(decaptcha.counters['preloads_discarded'], 1)
+
+			responses = await asyncio.gather(futures[0], futures[2])
+			self.assertEqual([response['response'] for response in responses],
+			                 ['token https://decaptcha.test/%d' % i for i in (0, 2)])
+			# the third CAPTCHA was shown in the window it was preloaded in
+			self.assertEqual(decaptcha.counters['preloads_shown'], 1)
+			self.assertEqual(len(backend.windows), 2)
+		finally:
+			decaptcha.stop()
+			await gui
+
+	async def atest_recycle(self):
+		backend = FakeBackend(page_memory=100)
+		decaptcha = DeCaptcha(ReCaptchaHTMLGenerator(), backend=backend, preload_timeout=0,
+		                      max_loads=3, max_memory=150)
+		gui = decaptcha.run()
+		try:
+			for i in range(4):
+				await decaptcha.solve({'url': 'https://decaptcha.test/%d' % i})
+			window, = backend.windows
+			self.assertEqual(window.loads, 4)
+			# two pages exceed max_memory, recycled before the third
+			self.assertEqual(window.recycled, 1)
+			self.assertEqual(decaptcha.counters['recycled_memory'], 1)
+			self.assertEqual(decaptcha.histograms['recycle_memory'].sum, 200)
+
+			decaptcha.max_memory = None
+			for i in range(4):
+				await decaptcha.solve({'url': 'https://decaptcha.test/%d' % i})
+			self.assertEqual(decaptcha.counters['recycled_loads'], 1)
+			self.assertIn('decaptcha_web_process_memory_bytes 300.0\n', decaptcha.collect_metrics())
+		finally:
+			decaptcha.stop()
+			await gui
+
+	async def atest_recycle_memory(self):
+		backend = FakeBackend(page_memory=100)
+		decaptcha = DeCaptcha(ReCaptchaHTMLGenerator(), windows=2, backend=backend, preload_timeout=0,
+		                      max_memory=250)
+		gui = decaptcha.run()
+		try:
+			for _ in range(4):
+				await asyncio.gather(*(decaptcha.solve({'url': 'https://decaptcha.test/%d' % i})
+				                       for i in range(2)))
+			# 6 pages exceed 250 bytes per window before the fourth round,
+			# only one window is recycled and the other stays below the limit
+			self.assertEqual([window.loads for window in backend.windows], [4, 4])
+			self.assertEqual(sorted(window.recycled for window in backend.windows), [0, 1])
+			self.assertEqual(decaptcha.counters['recycled_memory'], 1)
+		finally:
+			decaptcha.stop()
+			await gui
+
+	async def atest_offscreen(self):
+		backend = FakeBackend(solve_latency=0.05, response=lambda url: 'token ' + url,
+		                      challenge=lambda url: url.endswith('challenge'))
+		decaptcha = DeCaptcha(ReCaptchaHTMLGenerator(), backend=backend, preload_timeout=0, offscreen=2)
+		gui = decaptcha.run()
+		try:
+			interactive = [decaptcha.solve({'url': 'https://decaptcha.test/%d' % i}) for i in range(2)]
+			invisible = [
+				decaptcha.solve({'url': 'https://decaptcha.test/invisible/%d' % i, 'options': {'invisible': True}})
+				for i in range(2)
+			]
+			# the invisible CAPTCHAs do not wait behind the interactive ones
+			responses = await asyncio.gather(*invisible)
+			self.assertEqual([response['response'] for response in responses],
+			                 ['token https://decaptcha.test/invisible/%d' % i for i in range(2)])
+			self.assertFalse(interactive[1].done())
+			self.assertEqual(decaptcha.counters['solved_offscreen'], 2)
+			self.assertEqual(len(backend.windows), 3)
+			self.assertFalse(any(window.visible for window in backend.windows[1:]))
+
+			# a challenge is displayed in the interactive window
+			response = await decaptcha.solve({'url': 'https://decaptcha.test/challenge',
+			                                  'options': {'invisible': True}})
+			self.assertEqual(response['response'], 'token https://decaptcha.test/challenge')
+			self.assertEqual(list(response['timings']), ['api', 'onload', 'challenge', 'submit'])
+			self.assertEqual(decaptcha.counters['escalated_challenge'], 1)
+			self.assertTrue(all(fut.done() for fut in interactive))
+		finally:
+			decaptcha.stop()
+			await gui
+
+	async def atest_timings(self):
+		backend = FakeBackend(load_latency=0.01, solve_latency=0.02)
+		decaptcha = DeCaptcha(ReCaptchaHTMLGenerator(), backend=backend)
+		decaptcha.max_sitekeys = 1
+		gui = decaptcha.run()
+		try:
+			response = await decaptcha.solve({'url': 'https://decaptcha.test/', 'options': {'sitekey': 'key'}})
+			timings = response['timings']
+			self.assertEqual(list(timings), ['api', 'onload', 'submit'])
+			self.assertGreaterEqual(timings['api'], 0.01)
+			self.assertGreaterEqual(timings['submit'], 0.02)
+			self.assertEqual(response['expiresAt'], response['solvedAt'] + ReCaptchaHTMLGenerator.token_lifetime)
+			await decaptcha.solve({'url': 'https://decaptcha.test/', 'options': {'sitekey': 'other key'}})
+			self.assertEqual(sorted(decaptcha.stage_histograms),
+			                 [(stage, sitekey) for stage in ('api', 'onload', 'submit') for sitekey in ('key', 'other')])
+			self.assertIn('decaptcha_page_stage_seconds_count{stage="submit",sitekey="key"} 1.0\n',
+			              decaptcha.collect_metrics())
+		finally:
+			decaptcha.stop()
+			await gui
+
+	def test_solve(self):
+		asyncio.run(self.atest_solve())
+
+	def test_solve_many(self):
+		asyncio.run(self.atest_solve_many())
+
+	def test_preload(self):
+		asyncio.run(self.atest_preload())
+
+	def test_recycle(self):
+		asyncio.run(self.atest_recycle())
+
+	def test_recycle_memory(self):
+		asyncio.run(self.atest_recycle_memory())
+
+	def test_offscreen(self):
+		asyncio.run(self.atest_offscreen())
+
+	def test_timings(self):
+		asyncio.run(self.atest_timings())
+
+	def test_cancel_and_close(self):
+		asyncio.run(self.atest_cancel_and_close())
@@ -0,0 +1,45 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import unittest
+
+from decaptcha import (
+	HTMLGenerator,
+	ReCaptchaHTMLGenerator,
+)
+
+class HTML(unittest.TestCase):
+	def test_escape_xml(self):
+		self.assertEqual(HTMLGenerator.escape_xml('<a href="x">\'&\'</a>'),
+		                 '&lt;a href=&quot;x&quot;&gt;&#39;&amp;&#39;&lt;/a&gt;')
+
+	def test_generate(self):
+		htmlgen = ReCaptchaHTMLGenerator()
+		req = {'url': 'https://decaptcha.test/', 'options': {'sitekey': 'key', 'invisible': True}}
+		html = htmlgen.generate(req, inline=False)
+		self.assertIn('data-sitekey="key"', html)
+		self.assertIn('data-size="invisible"', html)
+		self.assertNotIn(htmlgen.js, html)
+		self.assertIn(htmlgen.js, htmlgen.generate(req))
+		self.assertIs(htmlgen.generate(req, inline=False), html)
+
+	def test_resource_urls(self):
+		htmlgen = ReCaptchaHTMLGenerator()
+		self.assertEqual(htmlgen.resource_urls(), [htmlgen.script_url])
+		req = {'url': 'https://decaptcha.test/', 'options': {'sitekey': 'key'}}
+		self.assertIn('src="%s"' % HTMLGenerator.escape_xml(htmlgen.script_url), htmlgen.generate(req))
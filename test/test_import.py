@@ -0,0 +1,48 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os.path
+import subprocess
+import sys
+import unittest
+
+class Import(unittest.TestCase):
+	"""
+	The data types, the HTML generators, and the anticaptcha front must be
+	importable without loading GObject introspection.
+	"""
+
+	# generous upper bound, importing gi and WebKit alone takes longer
+	max_seconds = 1.0
+
+	def test_import_without_gui(self):
+		script = '''
+import sys, time
+start = time.perf_counter()
+import decaptcha, decaptcha.anticaptcha
+print(time.perf_counter() - start)
+print(' '.join(sorted(name for name in ('gi', 'youtube_dl') if name in sys.modules)))
+'''
+		directory = os.path.join(os.path.dirname(__file__), '..')
+		out = subprocess.run([sys.executable, '-c', script],
+		                     cwd=directory, stdout=subprocess.PIPE,
+		                     stderr=subprocess.DEVNULL, check=True,
+		                     universal_newlines=True).stdout.split('\n')
+		seconds = float(out[0])
+		self.assertEqual(out[1], '')
+		self.assertLess(seconds, self.max_seconds)
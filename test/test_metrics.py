@@ -0,0 +1,66 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import unittest
+
+from decaptcha.metrics import format_histograms, format_labelled, Histogram, Registry
+
+class Metrics(unittest.TestCase):
+	def test_histogram(self):
+		histogram = Histogram([0.1, 1.0])
+		for value in (0.05, 0.1, 0.5, 2.0):
+			histogram.observe(value)
+		self.assertEqual(histogram.format('t', 'help'), '''\
+# HELP t help
+# TYPE t histogram
+t_bucket{le="0.1"} 2.0
+t_bucket{le="1.0"} 3.0
+t_bucket{le="+Inf"} 4.0
+t_sum 2.65
+t_count 4.0
+''')
+
+	def test_histograms(self):
+		histograms = {('b', 'x'): Histogram([1.0]), ('a', 'y'): Histogram([1.0])}
+		histograms['b', 'x'].observe(2.0)
+		self.assertEqual(format_histograms('t', 'help', ['stage', 'key'], histograms), '''\
+# HELP t help
+# TYPE t histogram
+t_bucket{stage="a",key="y",le="1.0"} 0.0
+t_bucket{stage="a",key="y",le="+Inf"} 0.0
+t_sum{stage="a",key="y"} 0.0
+t_count{stage="a",key="y"} 0.0
+t_bucket{stage="b",key="x",le="1.0"} 0.0
+t_bucket{stage="b",key="x",le="+Inf"} 1.0
+t_sum{stage="b",key="x"} 2.0
+t_count{stage="b",key="x"} 1.0
+''')
+
+	def test_registry(self):
+		registry = Registry()
+		registry.register(lambda: format_labelled('c', 'counter', 'help', 'event', {'b': 2, 'a': 1}))
+		registry.register(lambda: format_labelled('l', 'gauge', 'help', 'name', {'"\n': 0}))
+		self.assertEqual(registry.render(), '''\
+# HELP c help
+# TYPE c counter
+c{event="a"} 1.0
+c{event="b"} 2.0
+# HELP l help
+# TYPE l gauge
+l{name="\\"\\n"} 0.0
+''')
@@ -0,0 +1,103 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import unittest
+
+from aiohttp import web # type: ignore
+from aiohttp.test_utils import TestClient, TestServer # type: ignore
+
+from decaptcha import CaptchaException
+from decaptcha.anticaptcha.nodes import add_node_routes, NodePool, RemoteNode
+from decaptcha.node import run_node
+
+class Nodes(unittest.TestCase):
+	async def atest_requeue(self):
+		pool = NodePool()
+		app = web.Application()
+		add_node_routes(app, pool)
+		server = TestServer(app)
+		await server.start_server()
+		url = str(server.make_url('/nodes'))
+
+		stuck = asyncio.Event()
+		async def solve_stuck(req):
+			stuck.set()
+			await asyncio.sleep(3600)
+		async def solve(req):
+			return {'response': 'solved ' + req['url']}
+
+		first = asyncio.create_task(run_node(url, solve_stuck, reconnect_delay=3600))
+		second = None
+		try:
+			result = asyncio.ensure_future(pool.solve({'url': 'https://decaptcha.test/', 'options': {}}))
+			await asyncio.wait_for(stuck.wait(), 5)
+			self.assertEqual(pool.capacity, 1)
+			second = asyncio.create_task(run_node(url, solve, capacity=2))
+			while pool.capacity < 3:
+				await asyncio.sleep(0.01)
+			# the first node dies, its request is requeued to the second one
+			first.cancel()
+			self.assertEqual(await asyncio.wait_for(result, 5), {'response': 'solved https://decaptcha.test/'})
+			self.assertEqual(pool.capacity, 2)
+		finally:
+			first.cancel()
+			if second is not None:
+				second.cancel()
+			await server.close()
+
+	def test_requeue(self):
+		asyncio.run(self.atest_requeue())
+
+	async def atest_malformed(self):
+		pool = NodePool()
+		app = web.Application()
+		add_node_routes(app, pool)
+		client = TestClient(TestServer(app))
+		await client.start_server()
+		try:
+			ws = await client.ws_connect('/nodes')
+			with self.assertLogs('NodePool', 'ERROR'):
+				await ws.send_str('not json')
+				await ws.send_json({'hello': {'capacity': 1}})
+				result = pool.solve({'url': 'https://decaptcha.test/', 'options': {}})
+				msg = await asyncio.wait_for(ws.receive_json(), 5)
+				await ws.send_json({'response': 'no id'})
+				await ws.send_json({'id': msg['id'], 'response': 'token'})
+				# the node stays connected through both malformed messages
+				self.assertEqual(await asyncio.wait_for(result, 5), {'response': 'token'})
+			self.assertEqual(pool.capacity, 1)
+			await ws.close()
+		finally:
+			await client.close()
+
+	def test_malformed(self):
+		asyncio.run(self.atest_malformed())
+
+	async def atest_send_failed(self):
+		class ClosedWebSocket:
+			async def send_str(self, data):
+				raise ConnectionResetError('Cannot write to closing transport')
+		pool = NodePool()
+		pool.nodes.add(RemoteNode('node#1', ClosedWebSocket(), 1))
+		with self.assertLogs('NodePool.node#1', 'ERROR'):
+			with self.assertRaises(CaptchaException):
+				await asyncio.wait_for(pool.solve({'url': 'https://decaptcha.test/', 'options': {}}), 5)
+
+	def test_send_failed(self):
+		asyncio.run(self.atest_send_failed())
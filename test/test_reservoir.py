@@ -0,0 +1,107 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import time
+import unittest
+
+from decaptcha.reservoir import TokenReservoir
+
+class Reservoir(unittest.TestCase):
+	def setUp(self):
+		self.solved = []
+
+	async def solve(self, req):
+		self.solved.append(req)
+		return {'response': 'token-%d' % len(self.solved)}
+
+	async def atest_hit_and_expiry(self):
+		req = {'url': 'https://decaptcha.test/', 'options': {'sitekey': 'key'}}
+		reservoir = TokenReservoir(self.solve, lifetime=0.2, margin=0.1)
+		reservoir.keep(req, 2)
+		await asyncio.sleep(0.01)
+		self.assertEqual([r['options']['priority'] for r in self.solved], [-1000, -1000])
+
+		tokens = [await reservoir.solve(req) for _ in range(2)]
+		self.assertEqual(len({t['response'] for t in tokens}), 2) # handed out only once
+		await asyncio.sleep(0.01)
+		self.assertEqual(len(self.solved), 4) # refilled
+
+		await asyncio.sleep(0.15)
+		stats = reservoir.stats[('https://decaptcha.test/', 'key')]
+		self.assertEqual(stats['hits'],    2)
+		self.assertEqual(stats['expired'], 2)
+		reservoir.close()
+
+	async def atest_stop_keeping(self):
+		req = {'url': 'https://decaptcha.test/', 'options': {'sitekey': 'key'}}
+		pending = []
+		async def solve(req):
+			if pending:
+				pending.append(asyncio.get_running_loop().create_future())
+				return await pending[-1]
+			return await self.solve(req)
+		reservoir = TokenReservoir(solve)
+		reservoir.keep(req, 1)
+		await asyncio.sleep(0.01)
+		self.assertIn('decaptcha_reservoir_stock{url="https://decaptcha.test/",sitekey="key"} 1.0\n',
+		              reservoir.collect_metrics())
+
+		# refills from now on wait
+		pending.append(None)
+		reservoir.keep(req, 2)
+		await asyncio.sleep(0)
+		reservoir.keep(req, 0)
+		await asyncio.sleep(0)
+		# the pending refill is cancelled and the stock discarded
+		self.assertTrue(pending[1].cancelled())
+		self.assertEqual(reservoir.stats[('https://decaptcha.test/', 'key')]['discarded'], 1)
+		self.assertIn('decaptcha_reservoir_tokens_total{url="https://decaptcha.test/",sitekey="key",event="discarded"} 1.0\n',
+		              reservoir.collect_metrics())
+		pending.clear()
+		self.assertEqual(await reservoir.solve(req), {'response': 'token-2'})
+		reservoir.close()
+
+	async def atest_expires_at(self):
+		req = {'url': 'https://decaptcha.test/', 'options': {'sitekey': 'key'}}
+		async def solve(req):
+			# evicted margin seconds before its expiresAt, not after lifetime
+			return {'response': 'token', 'expiresAt': time.time() + 0.15}
+		reservoir = TokenReservoir(solve, lifetime=3600.0, margin=0.1)
+		reservoir.keep(req, 1)
+		await asyncio.sleep(0.1)
+		self.assertGreaterEqual(reservoir.stats[('https://decaptcha.test/', 'key')]['expired'], 1)
+		reservoir.close()
+
+	async def atest_cold_key(self):
+		reservoir = TokenReservoir(self.solve)
+		self.assertEqual(await reservoir.solve({'url': 'https://decaptcha.test/', 'options': {}}),
+		                 {'response': 'token-1'})
+		self.assertEqual(reservoir.stats, {})
+
+	def test_hit_and_expiry(self):
+		asyncio.run(self.atest_hit_and_expiry())
+
+	def test_stop_keeping(self):
+		asyncio.run(self.atest_stop_keeping())
+
+	def test_expires_at(self):
+		asyncio.run(self.atest_expires_at())
+
+	def test_cold_key(self):
+		asyncio.run(self.atest_cold_key())
@@ -0,0 +1,74 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import itertools
+import unittest
+
+from decaptcha.scheduler import RequestQueue
+
+class Scheduler(unittest.TestCase):
+	def test_order(self):
+		queue = RequestQueue() # type: RequestQueue[str]
+		queue.push('fifo-1')
+		queue.push('late',   deadline=200)
+		queue.push('urgent', priority=1)
+		queue.push('early',  deadline=100)
+		queue.push('fifo-2')
+		self.assertEqual(list(queue), ['urgent', 'early', 'late', 'fifo-1', 'fifo-2'])
+		self.assertEqual([queue.pop().item for _ in range(len(queue))],
+		                 ['urgent', 'early', 'late', 'fifo-1', 'fifo-2'])
+		self.assertRaises(IndexError, queue.pop)
+
+	def test_remove(self):
+		queue = RequestQueue() # type: RequestQueue[str]
+		a = queue.push('a')
+		b = queue.push('b')
+		self.assertTrue(queue.remove(a))
+		self.assertFalse(queue.remove(a))
+		self.assertEqual(len(queue), 1)
+		self.assertIs(queue.peek(), b)
+		self.assertIs(queue.pop(), b)
+		self.assertFalse(queue.remove(b))
+		self.assertFalse(queue)
+
+	def test_requeue(self):
+		queue = RequestQueue() # type: RequestQueue[str]
+		a = queue.push('a')
+		queue.push('b')
+		self.assertIs(queue.pop(), a)
+		queue.requeue(a)
+		self.assertEqual(list(queue), ['a', 'b'])
+		self.assertTrue(queue.remove(a))
+		self.assertEqual(len(queue), 1)
+
+		# an entry moved between queues sharing the counter keeps its place
+		seq = itertools.count()
+		interactive = RequestQueue(seq) # type: RequestQueue[str]
+		invisible   = RequestQueue(seq) # type: RequestQueue[str]
+		interactive.push('interactive-0')
+		late = invisible.push('invisible-late')
+		interactive.push('interactive-1')
+		self.assertIs(invisible.pop(), late)
+		interactive.requeue(late)
+		self.assertEqual(list(interactive), ['interactive-0', 'invisible-late', 'interactive-1'])
+
+	def test_expired(self):
+		queue = RequestQueue() # type: RequestQueue[str]
+		self.assertTrue(queue.push('a', deadline=10).expired(11))
+		self.assertFalse(queue.push('b', deadline=10).expired(9))
+		self.assertFalse(queue.push('c').expired(11))
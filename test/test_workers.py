@@ -0,0 +1,104 @@
+"""
+decaptcha
+Copyright (C) 2021  schnusch
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import sys
+import unittest
+
+from decaptcha import CaptchaException
+from decaptcha.workers import WorkerPool, WorkerProcess
+
+# answers every request with its URL, or an error for URLs ending in /error
+echo_worker = r'''
+import json, sys
+for line in sys.stdin:
+	msg = json.loads(line)
+	if 'request' not in msg:
+		continue
+	url = msg['request']['url']
+	reply = {'id': msg['id'], 'error': 'failed'} if url.endswith('/error') else {'id': msg['id'], 'response': url}
+	sys.stdout.write(json.dumps(reply) + '\n')
+	sys.stdout.flush()
+'''
+
+class Workers(unittest.TestCase):
+	async def atest_pool(self):
+		pool = WorkerPool([
+			WorkerProcess(i, [sys.executable, '-c', echo_worker], capacity=2)
+			for i in range(2)
+		])
+		await pool.start()
+		try:
+			futures = [pool.solve({'url': 'https://decaptcha.test/%d' % i, 'options': {}}) for i in range(4)]
+			# least loaded dispatch spreads the requests evenly
+			self.assertEqual([worker.load for worker in pool.workers], [1.0, 1.0])
+			results = await asyncio.gather(*futures)
+			self.assertEqual([r['response'] for r in results],
+			                 ['https://decaptcha.test/%d' % i for i in range(4)])
+			with self.assertRaises(CaptchaException):
+				await pool.solve({'url': 'https://decaptcha.test/error', 'options': {}})
+		finally:
+			await pool.stop()
+
+	def test_pool(self):
+		asyncio.run(self.atest_pool())
+
+	async def atest_cancelled_reply(self):
+		worker = WorkerProcess(0, [sys.executable, '-c', echo_worker])
+		await worker.start()
+		try:
+			with self.assertLogs('WorkerProcess#0', 'DEBUG') as logs:
+				worker.solve({'url': 'https://decaptcha.test/cancelled', 'options': {}}).cancel()
+				# the worker answers the cancelled request anyway
+				result = await worker.solve({'url': 'https://decaptcha.test/', 'options': {}})
+			self.assertEqual(result['response'], 'https://decaptcha.test/')
+			self.assertEqual([record.levelname for record in logs.records], ['DEBUG'])
+		finally:
+			await worker.stop()
+
+	def test_cancelled_reply(self):
+		asyncio.run(self.atest_cancelled_reply())
+
+	async def atest_restart(self):
+		worker = WorkerProcess(0, [sys.executable, '-c', 'pass'])
+		worker.restart_delay     = 0.01
+		worker.max_restart_delay = 0.02
+		await worker.start()
+		try:
+			# respawning fails until the command is fixed
+			worker.command = ['/nonexistent/decaptcha-worker']
+			with self.assertLogs('WorkerProcess#0', 'ERROR') as logs:
+				await asyncio.sleep(0.1)
+			self.assertIn('restarting failed', logs.output[-1])
+			with self.assertRaises(CaptchaException):
+				await worker.solve({'url': 'https://decaptcha.test/', 'options': {}})
+
+			worker.command = [sys.executable, '-c', echo_worker]
+			for _ in range(100):
+				await asyncio.sleep(0.01)
+				try:
+					result = await worker.solve({'url': 'https://decaptcha.test/', 'options': {}})
+					break
+				except CaptchaException:
+					pass
+			self.assertEqual(result['response'], 'https://decaptcha.test/')
+		finally:
+			await worker.stop()
+
+	def test_restart(self):
+		asyncio.run(self.atest_restart())